@@ -0,0 +1,12 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+benchmarks
+~~~~~~~~~~
+
+Performance benchmarks for pyprometheus
+
+:copyright: (c) 2017 by Alexandr Lispython.
+:license: , see LICENSE for more details.
+:github: http://github.com/Lispython/pyprometheus
+"""
@@ -0,0 +1,220 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+benchmarks.hotpath
+~~~~~~~~~~~~~~~~~~
+
+Micro benchmarks of metrics hot path operations for each storage.
+
+Run and compare with stored baseline::
+
+    python -m benchmarks.hotpath --output results.json --baseline baseline.json --tolerance 0.2
+
+Every run measures reference operation without library code, comparison
+uses timings relative to it.
+
+:copyright: (c) 2017 by Alexandr Lispython.
+:license: , see LICENSE for more details.
+:github: http://github.com/Lispython/pyprometheus
+"""
+import argparse
+import fnmatch
+import itertools
+import struct
+import sys
+from collections import OrderedDict
+from threading import Lock
+
+from benchmarks import uwsgi_standin
+from benchmarks.utils import (REFERENCE, measure, summarize, write_results, load_results,
+                              compare_results, format_report, parse_tolerance)
+from pyprometheus.metrics import Counter, Gauge, Histogram, Summary
+from pyprometheus.registry import BaseRegistry
+from pyprometheus.storage import LocalMemoryStorage
+
+
+def reset_sharedarea(sharedarea_id):
+    """Drop sharedarea content by zero area size
+    """
+    uwsgi = uwsgi_standin.install()
+    uwsgi.sharedarea_memoryview(sharedarea_id)[0:4] = struct.pack(b"i", 0)
+
+
+def make_local_storage():
+    return LocalMemoryStorage()
+
+
+def make_uwsgi_storage():
+    from pyprometheus.contrib.uwsgi_features import UWSGIStorage
+    reset_sharedarea(UWSGIStorage.SHAREDAREA_ID)
+    return UWSGIStorage()
+
+
+def make_uwsgi_vector_storage():
+    from pyprometheus.contrib.uwsgi_features import UWSGIVectorStorage
+    reset_sharedarea(UWSGIVectorStorage.SHAREDAREA_ID)
+    return UWSGIVectorStorage()
+
+
+def make_uwsgi_flush_storage():
+    from pyprometheus.contrib.uwsgi_features import UWSGIFlushStorage, UWSGIStorage
+    reset_sharedarea(UWSGIStorage.SHAREDAREA_ID)
+    return UWSGIFlushStorage()
+
+
+def make_uwsgi_mule_storage():
+    from pyprometheus.contrib.uwsgi_features import UWSGIMuleStorage
+    uwsgi_standin.install()
+    return UWSGIMuleStorage()
+
+
+STORAGES = OrderedDict([
+    ("local", make_local_storage),
+    ("uwsgi", make_uwsgi_storage),
+    ("uwsgi_vector", make_uwsgi_vector_storage),
+    ("uwsgi_flush", make_uwsgi_flush_storage),
+    ("uwsgi_mule", make_uwsgi_mule_storage)
+])
+
+
+def make_buckets(size):
+    """Make `size` exponential buckets including +Inf
+    """
+    return [0.0005 * 1.5 ** i for i in range(size - 1)] + [float("inf")]
+
+
+def observations(size=1024):
+    """Cycle over values spread across bucket ranges
+    """
+    return itertools.cycle([0.0005 * 1.5 ** (i % 60) for i in range(size)])
+
+
+def reference():
+    """Locked dict increment, scale of interpreter and machine speed
+    """
+    lock, data = Lock(), {}
+
+    def benchmark():
+        with lock:
+            data["key"] = data.get("key", 0) + 1
+    return benchmark
+
+
+def counter_inc(registry):
+    return Counter("counter", "Counter", ("method", "code"), registry=registry).labels(method="GET", code="200").inc
+
+
+def gauge_set(registry):
+    child = Gauge("gauge", "Gauge", ("method", ), registry=registry).labels(method="GET")
+    return lambda: child.set(42)
+
+
+def labels_hit(registry):
+    metric = Counter("counter", "Counter", ("method", "code"), registry=registry)
+    metric.labels(method="GET", code="200")
+    return lambda: metric.labels(method="GET", code="200")
+
+
+def labels_miss(registry):
+    metric = Counter("counter", "Counter", ("id", ), registry=registry)
+    ids = itertools.count()
+    return lambda: metric.labels(id=next(ids))
+
+
+def histogram_observe(buckets):
+    def benchmark(registry):
+        child = Histogram("histogram", "Histogram", ("method", ), buckets=make_buckets(buckets),
+                          registry=registry).labels(method="GET")
+        values = observations()
+        return lambda: child.observe(next(values))
+    return benchmark
+
+
+def summary_observe(registry):
+    child = Summary("summary", "Summary", ("method", ), registry=registry).labels(method="GET")
+    values = observations()
+    return lambda: child.observe(next(values))
+
+
+def timer_manager(registry):
+    child = Histogram("timer", "Timer", ("method", ), registry=registry).labels(method="GET")
+
+    def benchmark():
+        with child.time():
+            pass
+    return benchmark
+
+
+BENCHMARKS = OrderedDict([
+    ("counter_inc", counter_inc),
+    ("gauge_set", gauge_set),
+    ("labels_hit", labels_hit),
+    ("labels_miss", labels_miss),
+    ("histogram_observe_10", histogram_observe(10)),
+    ("histogram_observe_30", histogram_observe(30)),
+    ("histogram_observe_100", histogram_observe(100)),
+    ("summary_observe", summary_observe),
+    ("timer_manager", timer_manager)
+])
+
+
+def run(storages=("*", ), benchmarks=("*", ), number=10000, repeat=5, output=None):
+    """Run matched benchmarks for matched storages
+
+    :param storages: storage name patterns
+    :param benchmarks: benchmark name patterns
+    :return: dict of `<storage>.<benchmark>` and `reference` results
+    """
+    results = OrderedDict()
+
+    def report(name, result):
+        results[name] = result
+        if output:
+            output.write("{0:<45} {1:>10.1f} ns/op {2:>12.0f} ops/s\n".format(
+                name, result["ns_per_op"], result["ops_per_second"]))
+
+    # Reference is measured around benchmarks, best of both is kept
+    timings = measure(reference(), number, repeat)
+
+    for storage_name, make_storage in STORAGES.items():
+        if not any(fnmatch.fnmatch(storage_name, x) for x in storages):
+            continue
+        for benchmark_name, benchmark in BENCHMARKS.items():
+            if not any(fnmatch.fnmatch(benchmark_name, x) for x in benchmarks):
+                continue
+            op = benchmark(BaseRegistry(storage=make_storage()))
+            report("{0}.{1}".format(storage_name, benchmark_name), summarize(measure(op, number, repeat), number))
+
+    timings.extend(measure(reference(), number, repeat))
+    report(REFERENCE, summarize(timings, number))
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="pyprometheus hot path benchmarks")
+    parser.add_argument("-s", "--storage", action="append", help="storage name pattern: {0}".format(", ".join(STORAGES)))
+    parser.add_argument("-b", "--benchmark", action="append", help="benchmark name pattern")
+    parser.add_argument("-n", "--number", type=int, default=10000, help="operations per repeat")
+    parser.add_argument("-r", "--repeat", type=int, default=5, help="repeats, best is reported")
+    parser.add_argument("-o", "--output", help="write json results to file, - for stdout")
+    parser.add_argument("--baseline", help="json results to compare with")
+    parser.add_argument("--tolerance", action="append", type=parse_tolerance, default=[],
+                        help="allowed slowdown fraction, `0.2` or `<pattern>=0.5`")
+    args = parser.parse_args(argv)
+
+    results = run(args.storage or ("*", ), args.benchmark or ("*", ), args.number, args.repeat,
+                  sys.stderr if args.output == "-" else sys.stdout)
+
+    if args.output:
+        write_results(args.output, results)
+
+    if args.baseline:
+        report = compare_results(results, load_results(args.baseline), 0.2, args.tolerance)
+        sys.stderr.write(format_report(report) + "\n")
+        if any(x[4] for x in report):
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
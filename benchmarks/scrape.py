@@ -0,0 +1,187 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+benchmarks.scrape
+~~~~~~~~~~~~~~~~~
+
+Scrape at scale benchmark.
+
+Builds registries with mixed metric types and measures every scrape
+stage separately: raw `get_items`, grouped `BaseStorage.items`,
+`BaseRegistry.collect` and full `registry_to_text` with its
+peak memory, tracemalloc allocations and output size::
+
+    python -m benchmarks.scrape --size 10000 --size 100000 --size 1000000 --output scrape.json
+
+:copyright: (c) 2017 by Alexandr Lispython.
+:license: , see LICENSE for more details.
+:github: http://github.com/Lispython/pyprometheus
+"""
+import argparse
+import gc
+import sys
+from collections import OrderedDict
+from timeit import default_timer
+
+from benchmarks.hotpath import STORAGES
+from benchmarks.utils import write_results
+from pyprometheus.metrics import Counter, Gauge, Histogram, Summary
+from pyprometheus.registry import BaseRegistry
+from pyprometheus.utils.exposition import registry_to_text
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+try:
+    xrange = xrange
+except Exception:
+    xrange = range
+
+
+# Share of series by metric type
+SERIES_SHARES = (
+    (Counter, 0.3),
+    (Gauge, 0.2),
+    (Histogram, 0.4),
+    (Summary, 0.1)
+)
+
+
+def series_per_child(metric_class):
+    if metric_class is Histogram:
+        return len(Histogram.DEFAULT_BUCKETS) + 2
+    if metric_class is Summary:
+        return 2
+    return 1
+
+
+def build_registry(storage, size, families=10):
+    """Create registry with about `size` series
+
+    Series are split between metric types by `SERIES_SHARES`
+    and between `families` metrics of each type.
+    """
+    registry = BaseRegistry(storage=storage)
+    for metric_class, share in SERIES_SHARES:
+        children = max(1, int(size * share / series_per_child(metric_class) / families))
+        for family in xrange(families):
+            metric = metric_class("{0}_{1}".format(metric_class.TYPE, family),
+                                  "Scrape benchmark {0}".format(metric_class.TYPE),
+                                  ("handler", "id"), registry=registry)
+            for i in xrange(children):
+                child = metric.labels(handler="/api/v1/handler", id=str(i))
+                if metric_class is Gauge:
+                    child.set(i)
+                elif metric_class is Counter:
+                    child.inc(i)
+                else:
+                    child.observe(i % 100 / 10.0)
+    return registry
+
+
+def consume_collect(registry):
+    samples = 0
+    for collector in registry.collect():
+        samples += len(collector.get_samples())
+    return samples
+
+
+def best_time(func, repeat):
+    timings = []
+    for _ in xrange(repeat):
+        start = default_timer()
+        func()
+        timings.append(default_timer() - start)
+    return min(timings)
+
+
+def measure_render(registry):
+    """Render registry once under tracemalloc
+
+    Allocations are difference of snapshots taken before render and
+    after it with rendered output alive.
+
+    :return: (output, peak traced memory bytes, allocated blocks, allocated bytes)
+    """
+    if tracemalloc is None:
+        return registry_to_text(registry), None, None, None
+
+    gc.collect()
+    tracemalloc.start()
+    try:
+        before = tracemalloc.take_snapshot()
+        if hasattr(tracemalloc, "reset_peak"):
+            # Exclude snapshot itself from peak on python 3.9+
+            tracemalloc.reset_peak()
+        output = registry_to_text(registry)
+        peak = tracemalloc.get_traced_memory()[1]
+        stats = tracemalloc.take_snapshot().compare_to(before, "filename")
+    finally:
+        tracemalloc.stop()
+    return (output, peak, sum(stat.count_diff for stat in stats),
+            sum(stat.size_diff for stat in stats))
+
+
+def run_size(make_storage, size, repeat=3):
+    """Measure scrape stages for registry of `size` series
+    """
+    start = default_timer()
+    registry = build_registry(make_storage(), size)
+    build = default_timer() - start
+    storage = registry.storage
+
+    # Warm up, first collect also creates labels caches
+    consume_collect(registry)
+
+    output, peak, blocks, allocated = measure_render(registry)
+
+    result = OrderedDict([
+        ("series", len(storage)),
+        ("build_seconds", build),
+        ("get_items_seconds", best_time(lambda: list(storage.get_items()), repeat)),
+        ("items_seconds", best_time(lambda: list(storage.items()), repeat)),
+        ("collect_seconds", best_time(lambda: consume_collect(registry), repeat)),
+        ("render_seconds", best_time(lambda: registry_to_text(registry), repeat)),
+        ("peak_memory_bytes", peak),
+        ("allocated_blocks", blocks),
+        ("allocated_bytes", allocated),
+        ("output_bytes", len(output.encode("utf-8")))
+    ])
+    # Scrape time spent outside storage and in text formatting
+    result["collect_only_seconds"] = result["collect_seconds"] - result["items_seconds"]
+    result["format_seconds"] = result["render_seconds"] - result["collect_seconds"]
+    return result
+
+
+def run(storages=("local", ), sizes=(10000, 100000, 1000000), repeat=3, output=None):
+    results = OrderedDict()
+    for storage_name in storages:
+        for size in sizes:
+            name = "{0}.{1}".format(storage_name, size)
+            results[name] = result = run_size(STORAGES[storage_name], size, repeat)
+            if output:
+                output.write("{0:<20} {1}\n".format(name, " ".join(
+                    "{0}={1:.4g}".format(key, value) for key, value in result.items() if value is not None)))
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="pyprometheus scrape at scale benchmark")
+    parser.add_argument("-s", "--storage", action="append", choices=list(STORAGES))
+    parser.add_argument("--size", action="append", type=int, help="number of series")
+    parser.add_argument("-r", "--repeat", type=int, default=3)
+    parser.add_argument("-o", "--output", help="write json results to file, - for stdout")
+    args = parser.parse_args(argv)
+
+    results = run(args.storage or ("local", ), args.size or (10000, 100000, 1000000), args.repeat,
+                  sys.stderr if args.output == "-" else sys.stdout)
+
+    if args.output:
+        write_results(args.output, results)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
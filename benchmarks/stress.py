@@ -0,0 +1,285 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+benchmarks.stress
+~~~~~~~~~~~~~~~~~
+
+Multi process stress harness for sharedarea storages.
+
+Forks workers that do mixed counter `inc`, histogram `observe` and
+new keys creation on one sharedarea and reports throughput,
+lock wait time and correctness of final totals. With `--scrape-interval`
+one more process scrapes storage during the run and its sharedarea lock
+hold time is reported separately::
+
+    python -m benchmarks.stress --workers 16 --ops 5000
+    python -m benchmarks.stress --workers 16 --ops 5000 --storage uwsgi_double_buffer --scrape-interval 0.01
+
+:copyright: (c) 2017 by Alexandr Lispython.
+:license: , see LICENSE for more details.
+:github: http://github.com/Lispython/pyprometheus
+"""
+import argparse
+import json
+import os
+import random
+import select
+import sys
+from collections import OrderedDict
+from timeit import default_timer
+
+from benchmarks import uwsgi_standin
+from benchmarks.hotpath import reset_sharedarea
+from benchmarks.utils import write_results
+from pyprometheus.const import TYPES
+from pyprometheus.metrics import Counter, Histogram
+from pyprometheus.registry import BaseRegistry
+
+try:
+    xrange = xrange
+except Exception:
+    xrange = range
+
+
+HANDLERS = ["/api/{0}".format(x) for x in xrange(10)]
+
+BUCKETS = (0.1, 0.5, 1.0, float("inf"))
+
+
+def make_storage(name, sharedarea_ids, shard_by="key"):
+    from pyprometheus.contrib.uwsgi_features import (UWSGIStorage, UWSGIFlushStorage, UWSGIShardedStorage,
+                                                     UWSGIDoubleBufferStorage)
+    if name == "uwsgi_flush":
+        return UWSGIFlushStorage(sharedarea_ids[0])
+    if name == "uwsgi_double_buffer":
+        return UWSGIDoubleBufferStorage(sharedarea_ids[0])
+    if name == "uwsgi_sharded":
+        return UWSGIShardedStorage(sharedarea_ids, shard_by=shard_by)
+    return UWSGIStorage(sharedarea_ids[0])
+
+
+def worker(worker_id, storage_name, sharedarea_ids, ops, observe_ratio, new_key_ratio, flush_every, shard_by):
+    """Run ops in forked worker
+
+    :return: dict with expected totals and lock stats
+    """
+    uwsgi_standin.set_worker_id(worker_id)
+    uwsgi_standin.reset_stats()
+
+    registry = BaseRegistry(storage=make_storage(storage_name, sharedarea_ids, shard_by))
+    requests = Counter("stress_requests_total", "Requests", ("handler", ), registry=registry)
+    latency = Histogram("stress_latency_seconds", "Latency", ("handler", ), buckets=BUCKETS, registry=registry)
+    created = Counter("stress_created_total", "New keys", ("worker", "seq"), registry=registry)
+
+    rnd = random.Random(worker_id)
+    expected = {"requests": {}, "observations": {}, "observed_sum": {}, "created": 0}
+
+    start = default_timer()
+    for i in xrange(ops):
+        handler = rnd.choice(HANDLERS)
+        choice = rnd.random()
+        if choice < new_key_ratio:
+            created.labels(worker=str(worker_id), seq=str(i)).inc()
+            expected["created"] += 1
+        elif choice < new_key_ratio + observe_ratio:
+            # Values exactly representable in binary to sum without rounding
+            value = rnd.randint(0, 8) / 8.0
+            latency.labels(handler=handler).observe(value)
+            expected["observations"][handler] = expected["observations"].get(handler, 0) + 1
+            expected["observed_sum"][handler] = expected["observed_sum"].get(handler, 0) + value
+        else:
+            requests.labels(handler=handler).inc()
+            expected["requests"][handler] = expected["requests"].get(handler, 0) + 1
+
+        if flush_every and storage_name == "uwsgi_flush" and i % flush_every == 0:
+            registry.storage.flush()
+
+    if storage_name == "uwsgi_flush":
+        registry.storage.flush()
+
+    expected["seconds"] = default_timer() - start
+    expected.update(uwsgi_standin.stats)
+    return expected
+
+
+def scraper(storage_name, sharedarea_ids, shard_by, interval, stop_fds):
+    """Scrape storage every `interval` seconds until write end of `stop_fds` pipe is closed
+
+    :return: dict with scrapes count and lock stats of scrape process
+    """
+    stop_fd, stop_write_fd = stop_fds
+    os.close(stop_write_fd)
+    uwsgi_standin.reset_stats()
+    storage = make_storage(storage_name, sharedarea_ids, shard_by)
+    result = {"scrapes": 0, "scrape_seconds": 0.0}
+
+    while not select.select([stop_fd], [], [], interval)[0]:
+        start = default_timer()
+        for _ in storage.get_items():
+            pass
+        result["scrape_seconds"] += default_timer() - start
+        result["scrapes"] += 1
+
+    result.update(uwsgi_standin.stats)
+    return result
+
+
+def merge_expected(results):
+    total = {"requests": {}, "observations": {}, "observed_sum": {}, "created": 0}
+    for result in results:
+        for name in ("requests", "observations", "observed_sum"):
+            for handler, value in result[name].items():
+                total[name][handler] = total[name].get(handler, 0) + value
+        total["created"] += result["created"]
+    return total
+
+
+def read_totals(storage):
+    totals = {"requests": {}, "observations": {}, "observed_sum": {}, "created": 0}
+    for key, value in storage.get_items():
+        labels = dict(key[3])
+        if key[1] == "stress_requests_total":
+            totals["requests"][labels["handler"]] = value
+        elif key[0] == TYPES.HISTOGRAM_COUNTER:
+            totals["observations"][labels["handler"]] = value
+        elif key[0] == TYPES.HISTOGRAM_SUM:
+            totals["observed_sum"][labels["handler"]] = value
+        elif key[1] == "stress_created_total":
+            totals["created"] += value
+    return totals
+
+
+def fork_worker(target, *args):
+    """Fork child that writes json result of `target` to pipe
+
+    :return: (pid, read fd)
+    """
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_fd)
+        code = 0
+        try:
+            result = target(*args)
+            with os.fdopen(write_fd, "w") as f:
+                f.write(json.dumps(result))
+        except Exception:
+            import traceback
+            traceback.print_exc()
+            code = 1
+        finally:
+            os._exit(code)
+    os.close(write_fd)
+    return pid, read_fd
+
+
+def read_result(pid, read_fd):
+    """Wait forked child
+
+    :return: decoded result or None if child failed
+    """
+    with os.fdopen(read_fd, "r") as f:
+        data = f.read()
+    _, status = os.waitpid(pid, 0)
+    if status != 0 or not data:
+        return None
+    return json.loads(data)
+
+
+def run(workers=8, ops=2000, storage="uwsgi", observe_ratio=0.3, new_key_ratio=0.05,
+        flush_every=100, shards=1, shard_by="key", scrape_interval=None):
+    uwsgi = uwsgi_standin.install()
+    sharedarea_ids = list(xrange(shards if storage == "uwsgi_sharded" else 1))
+    # Double buffer area has own layout
+    area_storage = storage if storage == "uwsgi_double_buffer" else "uwsgi"
+    for sharedarea_id in sharedarea_ids:
+        reset_sharedarea(sharedarea_id)
+        # Init area in master before fork like uwsgi does
+        make_storage(area_storage, [sharedarea_id])
+
+    scrape = None
+    if scrape_interval is not None:
+        stop_fd, stop_write_fd = os.pipe()
+        scrape = fork_worker(scraper, storage, sharedarea_ids, shard_by, scrape_interval, (stop_fd, stop_write_fd))
+        os.close(stop_fd)
+
+    start = default_timer()
+    children = [fork_worker(worker, x + 1, storage, sharedarea_ids, ops, observe_ratio, new_key_ratio,
+                            flush_every, shard_by)
+                for x in xrange(workers)]
+
+    results, failed = [], 0
+    for pid, read_fd in children:
+        result = read_result(pid, read_fd)
+        if result is None:
+            failed += 1
+            continue
+        results.append(result)
+
+    wall = default_timer() - start
+
+    scrapes = {"scrapes": 0, "scrape_seconds": 0.0, "lock_hold": 0.0}
+    if scrape is not None:
+        os.close(stop_write_fd)
+        scrapes = read_result(*scrape)
+        if scrapes is None:
+            failed += 1
+            scrapes = {"scrapes": 0, "scrape_seconds": 0.0, "lock_hold": 0.0}
+
+    expected = merge_expected(results)
+    actual = read_totals(make_storage(area_storage if storage == "uwsgi_double_buffer" else "uwsgi_sharded",
+                                      sharedarea_ids, shard_by))
+    locks = sum(x["locks"] for x in results)
+
+    return OrderedDict([
+        ("storage", storage),
+        ("standin", getattr(uwsgi, "__name__", "") == uwsgi_standin.__name__),
+        ("workers", workers),
+        ("shards", len(sharedarea_ids)),
+        ("failed_workers", failed),
+        ("ops", ops * workers),
+        ("wall_seconds", wall),
+        ("ops_per_second", ops * workers / wall),
+        ("locks", locks),
+        ("lock_wait_seconds", sum(x["lock_wait"] for x in results)),
+        ("lock_hold_seconds", sum(x["lock_hold"] for x in results)),
+        ("mean_lock_wait_us", sum(x["lock_wait"] for x in results) / locks * 1e6 if locks else 0),
+        ("scrapes", scrapes["scrapes"]),
+        ("scrape_seconds", scrapes["scrape_seconds"]),
+        ("scrape_lock_hold_seconds", scrapes["lock_hold"]),
+        ("correct", not failed and expected == actual),
+        ("expected", expected),
+        ("actual", actual)
+    ])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="pyprometheus sharedarea multi process stress")
+    parser.add_argument("-w", "--workers", type=int, default=8)
+    parser.add_argument("-n", "--ops", type=int, default=2000, help="operations per worker")
+    parser.add_argument("-s", "--storage", choices=["uwsgi", "uwsgi_flush", "uwsgi_sharded", "uwsgi_double_buffer"],
+                        default="uwsgi")
+    parser.add_argument("--shards", type=int, default=4, help="sharedareas of uwsgi_sharded storage")
+    parser.add_argument("--shard-by", choices=["key", "name"], default="key")
+    parser.add_argument("--observe-ratio", type=float, default=0.3)
+    parser.add_argument("--new-key-ratio", type=float, default=0.05)
+    parser.add_argument("--flush-every", type=int, default=100, help="ops between uwsgi_flush flushes")
+    parser.add_argument("--scrape-interval", type=float, help="seconds between scrapes of concurrent scraper")
+    parser.add_argument("-o", "--output", help="write json results to file, - for stdout")
+    args = parser.parse_args(argv)
+
+    result = run(args.workers, args.ops, args.storage, args.observe_ratio,
+                 args.new_key_ratio, args.flush_every, args.shards, args.shard_by, args.scrape_interval)
+
+    output = sys.stderr if args.output == "-" else sys.stdout
+    for name, value in result.items():
+        if name not in ("expected", "actual"):
+            output.write("{0:<20} {1}\n".format(name, value))
+
+    if args.output:
+        write_results(args.output, {"{0}.{1}".format(args.storage, args.workers): result})
+    return 0 if result["correct"] else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
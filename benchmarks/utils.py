@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+benchmarks.utils
+~~~~~~~~~~~~~~~~
+
+Timing, results serialization and baseline comparison helpers
+
+:copyright: (c) 2017 by Alexandr Lispython.
+:license: , see LICENSE for more details.
+:github: http://github.com/Lispython/pyprometheus
+"""
+import fnmatch
+import gc
+import json
+import platform
+import sys
+import time
+from timeit import default_timer
+
+try:
+    xrange = xrange
+except Exception:
+    xrange = range
+
+
+def measure(op, number=10000, repeat=5):
+    """Run `op` `number` times `repeat` times with disabled gc
+
+    :return: list of nanoseconds per operation for each repeat
+    """
+    timings = []
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        for _ in xrange(repeat):
+            start = default_timer()
+            for _ in xrange(number):
+                op()
+            timings.append((default_timer() - start) * 1e9 / number)
+    finally:
+        if gc_enabled:
+            gc.enable()
+    return timings
+
+
+def summarize(timings, number):
+    """Make result record from per repeat timings
+    """
+    timings = sorted(timings)
+    best = timings[0]
+    return {
+        "ns_per_op": best,
+        "median_ns_per_op": timings[len(timings) // 2],
+        "ops_per_second": 1e9 / best if best else 0,
+        "number": number,
+        "repeat": len(timings)
+    }
+
+
+def environment():
+    return {
+        "python": sys.version.split()[0],
+        "implementation": platform.python_implementation(),
+        "platform": platform.platform(),
+        "created": time.time()
+    }
+
+
+def write_results(path, results):
+    """Write results to json file, `-` for stdout
+    """
+    data = json.dumps({"environment": environment(), "results": results}, indent=2, sort_keys=True)
+    if path == "-":
+        print(data)
+        return
+    with open(path, "w") as f:
+        f.write(data)
+
+
+def load_results(path):
+    with open(path, "r") as f:
+        return json.load(f)["results"]
+
+
+def get_tolerance(name, default, tolerances):
+    """Get tolerance for benchmark name
+
+    :param tolerances: list of (pattern, tolerance) pairs, last matched wins
+    """
+    tolerance = default
+    for pattern, value in tolerances:
+        if fnmatch.fnmatch(name, pattern):
+            tolerance = value
+    return tolerance
+
+
+# Result of operation measured in every run to scale timings of other runs
+REFERENCE = "reference"
+
+
+def compare_results(results, baseline, tolerance=0.2, tolerances=()):
+    """Compare results with baseline
+
+    Benchmark is regressed if it is slower than baseline
+    by more than tolerance fraction. When both results have `REFERENCE`
+    timing, ratios are scaled by reference ratio, so machine and
+    interpreter speed differences between runs are cancelled out.
+
+    :return: list of (name, baseline ns, current ns, ratio, regressed) tuples
+    """
+    scale = 1.0
+    if REFERENCE in results and REFERENCE in baseline and results[REFERENCE]["ns_per_op"]:
+        scale = baseline[REFERENCE]["ns_per_op"] / results[REFERENCE]["ns_per_op"]
+
+    report = []
+    for name in sorted(set(results) & set(baseline) - set([REFERENCE])):
+        current, previous = results[name]["ns_per_op"], baseline[name]["ns_per_op"]
+        ratio = current * scale / previous if previous else 1.0
+        report.append((name, previous, current, ratio,
+                       ratio > 1 + get_tolerance(name, tolerance, tolerances)))
+    return report
+
+
+def format_report(report):
+    lines = ["{0:<45} {1:>12} {2:>12} {3:>8}".format("benchmark", "baseline ns", "current ns", "ratio")]
+    for name, previous, current, ratio, regressed in report:
+        lines.append("{0:<45} {1:>12.1f} {2:>12.1f} {3:>8.2f}{4}".format(
+            name, previous, current, ratio, "  REGRESSION" if regressed else ""))
+    return "\n".join(lines)
+
+
+def parse_tolerance(value):
+    """Parse `0.2` or `pattern=0.2` command line value
+    """
+    if "=" in value:
+        pattern, value = value.rsplit("=", 1)
+        return pattern, float(value)
+    return "*", float(value)
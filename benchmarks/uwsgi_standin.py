@@ -0,0 +1,230 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+benchmarks.uwsgi_standin
+~~~~~~~~~~~~~~~~~~~~~~~~
+
+Pure python stand-in for uwsgi sharedarea API to run
+`UWSGIStorage` outside of uwsgi process.
+
+Areas are shared `mmap` of unlinked temporary files, locks are `fcntl`
+record locks on the same file, so areas created before `fork()`
+are shared and locked between child processes like uwsgi sharedareas.
+User locks are `fcntl` locks of files created on import.
+Threads of one process are serialized by additional thread lock.
+Mule messages are datagrams of unix socket pair.
+
+:copyright: (c) 2017 by Alexandr Lispython.
+:license: , see LICENSE for more details.
+:github: http://github.com/Lispython/pyprometheus
+"""
+import fcntl
+import mmap
+import os
+import socket
+import sys
+import tempfile
+import threading
+from timeit import default_timer
+
+# Same as uwsgi --sharedarea=100 used by tests
+DEFAULT_AREA_SIZE = int(os.environ.get("UWSGI_STANDIN_AREA_SIZE", 100 * 4096))
+
+_areas = {}
+
+_worker_id = None
+
+_mules = {}
+
+_mule_id = 0
+
+# Same as uwsgi default mule message buffer
+MULE_MSG_SIZE = 65536
+
+# Lock 0 and locks added by uwsgi --locks option
+LOCKS = 1 + int(os.environ.get("UWSGI_STANDIN_LOCKS", 4))
+
+# Lock stats of current process
+stats = {
+    "locks": 0,
+    "lock_wait": 0.0,
+    "lock_hold": 0.0
+}
+
+
+class SharedArea(object):
+
+    def __init__(self, size=DEFAULT_AREA_SIZE):
+        fd, path = tempfile.mkstemp(prefix="uwsgi-standin-")
+        os.unlink(path)
+        os.ftruncate(fd, size)
+        self.fd = fd
+        self.mmap = mmap.mmap(fd, size, mmap.MAP_SHARED, mmap.PROT_READ | mmap.PROT_WRITE)
+        try:
+            self.memoryview = memoryview(self.mmap)
+        except TypeError:
+            # python 2 mmap has no buffer interface, area is not shared
+            self.memoryview = memoryview(bytearray(size))
+        self.thread_lock = threading.Lock()
+        self.locked_at = None
+
+    def lock(self, operation):
+        start = default_timer()
+        self.thread_lock.acquire()
+        fcntl.lockf(self.fd, operation)
+        self.locked_at = default_timer()
+        stats["locks"] += 1
+        stats["lock_wait"] += self.locked_at - start
+
+    def unlock(self):
+        if self.locked_at is None:
+            return
+        stats["lock_hold"] += default_timer() - self.locked_at
+        self.locked_at = None
+        fcntl.lockf(self.fd, fcntl.LOCK_UN)
+        self.thread_lock.release()
+
+
+class UserLock(object):
+
+    def __init__(self):
+        fd, path = tempfile.mkstemp(prefix="uwsgi-standin-lock-")
+        os.unlink(path)
+        self.fd = fd
+        self.thread_lock = threading.Lock()
+
+    def acquire(self):
+        self.thread_lock.acquire()
+        fcntl.lockf(self.fd, fcntl.LOCK_EX)
+
+    def release(self):
+        fcntl.lockf(self.fd, fcntl.LOCK_UN)
+        self.thread_lock.release()
+
+
+# Created on import to be shared by processes forked later
+_locks = [UserLock() for _ in range(LOCKS)]
+
+
+def get_area(id):
+    try:
+        return _areas[id]
+    except KeyError:
+        _areas[id] = area = SharedArea()
+        return area
+
+
+def sharedarea_memoryview(id):
+    return get_area(id).memoryview
+
+
+def sharedarea_wlock(id):
+    get_area(id).lock(fcntl.LOCK_EX)
+
+
+def sharedarea_rlock(id):
+    get_area(id).lock(fcntl.LOCK_SH)
+
+
+def sharedarea_unlock(id):
+    get_area(id).unlock()
+
+
+def get_lock(num):
+    if not 0 <= num < len(_locks):
+        raise ValueError("The lock number is invalid")
+    return _locks[num]
+
+
+def lock(num=0):
+    get_lock(num).acquire()
+
+
+def unlock(num=0):
+    get_lock(num).release()
+
+
+def worker_id():
+    return _worker_id if _worker_id is not None else os.getpid()
+
+
+def mule_id():
+    return _mule_id
+
+
+def get_mule(id):
+    """Get mule messages socket pair, create before fork to share with children
+    """
+    try:
+        return _mules[id]
+    except KeyError:
+        _mules[id] = pair = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+        pair[0].setblocking(False)
+        pair[1].setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, MULE_MSG_SIZE * 16)
+        return pair
+
+
+def mule_msg(message, id=1):
+    if len(message) > MULE_MSG_SIZE:
+        raise ValueError("Mule message is too big")
+    try:
+        get_mule(id)[0].send(message)
+    except socket.error:
+        # Mule queue is full, uwsgi does not block workers too
+        return None
+    return True
+
+
+def mule_get_msg(signals=True, farms=True, buffer_size=MULE_MSG_SIZE, timeout=-1):
+    """Receive message sent to current mule
+
+    :param timeout: seconds to wait, -1 to block
+    :return: message bytes or None after timeout
+    """
+    sock = get_mule(_mule_id)[1]
+    sock.settimeout(None if timeout < 0 else timeout)
+    try:
+        return sock.recv(buffer_size)
+    except socket.timeout:
+        return None
+
+
+def set_worker_id(value):
+    """Set worker id in forked child
+    """
+    global _worker_id
+    _worker_id = value
+
+
+def set_mule_id(value):
+    """Make current process mule with given id
+    """
+    global _mule_id
+    _mule_id = value
+
+
+def reset_stats():
+    for name in stats:
+        stats[name] = type(stats[name])()
+
+
+def reset(id=None):
+    """Fill area with zeros
+
+    :param id: sharedarea id, all areas if None
+    """
+    for area_id, area in _areas.items():
+        if id is None or area_id == id:
+            area.memoryview[:] = b"\x00" * len(area.memoryview)
+
+
+def install():
+    """Use stand-in as `uwsgi` module if real uwsgi is not available
+
+    :return: uwsgi module used by `pyprometheus.contrib.uwsgi_features`
+    """
+    from pyprometheus.contrib import uwsgi_features
+
+    if uwsgi_features.uwsgi is None:
+        uwsgi_features.uwsgi = sys.modules[__name__]
+    return uwsgi_features.uwsgi
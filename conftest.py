@@ -1,10 +1,11 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 import os
+import sys
 
 import pytest
-import uwsgi
 import time
+from pyprometheus.compat import PY2
 from pyprometheus.storage import BaseStorage
 from pyprometheus.utils import measure_time as measure_time_manager
 try:
@@ -12,6 +13,16 @@ try:
 except Exception:
     xrange = range
 
+try:
+    import uwsgi
+except ImportError:
+    # Run sharedarea tests outside of uwsgi process
+    from benchmarks import uwsgi_standin as uwsgi
+    sys.modules["uwsgi"] = uwsgi.install()
+
+if PY2:
+    collect_ignore = ["tests/test_asyncio_server.py"]
+
 
 @pytest.fixture
 def project_root():
@@ -21,8 +32,7 @@ def project_root():
 @pytest.yield_fixture(autouse=True)
 def run_around_tests():
     m = uwsgi.sharedarea_memoryview(0)
-    for x in xrange(len(m)):
-        m[x] = "\x00"
+    m[:] = b"\x00" * len(m)
 
     yield
 
@@ -0,0 +1,434 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+pyprometheus.contrib.aggregator
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+Unix socket aggregation daemon for multi process applications
+(gunicorn, celery prefork, multiprocessing) and its client storage.
+
+Run daemon::
+
+    python -m pyprometheus.contrib.aggregator --socket /tmp/pyprometheus.sock --address 0.0.0.0:9100
+
+:copyright: (c) 2017 by Alexandr Lispython.
+:license: , see LICENSE for more details.
+:github: http://github.com/Lispython/pyprometheus
+"""
+import argparse
+import errno
+import marshal
+import os
+import signal
+import socket
+import struct
+import sys
+from itertools import chain
+from logging import getLogger
+from threading import Event, Thread
+from wsgiref.simple_server import make_server
+
+from pyprometheus.const import TYPES
+from pyprometheus.contrib.uwsgi_features import ThreadingWSGIServer, QuietWSGIRequestHandler
+from pyprometheus.metrics import Counter, Gauge, Histogram, Summary
+from pyprometheus.registry import BaseRegistry
+from pyprometheus.storage import BufferedStorage, LocalMemoryStorage
+from pyprometheus.utils import recv_batch
+from pyprometheus.utils.exposition import MetricsWSGIApp
+
+
+logger = getLogger("pyprometheus.aggregator")
+
+MAGIC = b"PPA1"
+
+INC = 0
+WRITE = 1
+
+# Record: operation, value, serialized key size and key
+RECORD_HEADER = struct.Struct("!BdH")
+
+METRIC_CLASSES = {
+    TYPES.GAUGE: Gauge,
+    TYPES.COUNTER: Counter,
+    TYPES.SUMMARY_SUM: Summary,
+    TYPES.SUMMARY_COUNTER: Summary,
+    TYPES.SUMMARY_QUANTILE: Summary,
+    TYPES.HISTOGRAM_SUM: Histogram,
+    TYPES.HISTOGRAM_COUNTER: Histogram,
+    TYPES.HISTOGRAM_BUCKET: Histogram
+}
+
+# Subtype labels that are not metric label names
+SUBTYPE_LABELS = ("bucket", "quantile")
+
+# Daemon is not running or socket path is stale
+UNAVAILABLE_ERRORS = (errno.ENOENT, errno.ECONNREFUSED)
+
+# Daemon receive queue is full
+BACKPRESSURE_ERRORS = (errno.EAGAIN, errno.EWOULDBLOCK, errno.ENOBUFS)
+
+
+class AggregatorDecodeError(Exception):
+    pass
+
+
+def encode_record(operation, key, value):
+    serialized_key = marshal.dumps(key, 2)
+    return RECORD_HEADER.pack(operation, value, len(serialized_key)) + serialized_key
+
+
+def decode_packet(packet):
+    """Decode packet to list of (operation, key, value)
+    """
+    if not packet.startswith(MAGIC):
+        raise AggregatorDecodeError("Invalid packet magic")
+
+    records, position, size = [], len(MAGIC), len(packet)
+    try:
+        while position < size:
+            operation, value, key_size = RECORD_HEADER.unpack_from(packet, position)
+            position += RECORD_HEADER.size
+            key = marshal.loads(packet[position:position + key_size])
+            position += key_size
+            records.append((operation, key, value))
+    except (struct.error, ValueError, EOFError, TypeError) as e:
+        raise AggregatorDecodeError("Invalid packet: {0}".format(e))
+    return records
+
+
+class AggregatorServer(object):
+    """Unix datagram daemon that owns registry values
+
+    Packets are read in batches of up to `batch_size` per wakeup and
+    applied to registry storage. Metrics not declared in registry are
+    created from key types.
+    """
+
+    def __init__(self, registry, path, address=None, min_interval=0,
+                 batch_size=1000, recv_buffer=4 * 1024 * 1024, timeout=0.5):
+        self._registry = registry
+        self._path = path
+        self._address = address
+        self._app = MetricsWSGIApp(registry, min_interval=min_interval)
+        self._batch_size = batch_size
+        self._recv_buffer = recv_buffer
+        self._timeout = timeout
+
+        self._metrics = dict((collector.name, collector) for _, collector in registry.collectors()
+                             if hasattr(collector, "build_samples"))
+        self._socket = None
+        self._server = None
+        self._stopped = Event()
+        self._threads = []
+
+        self.packets = 0
+        self.errors = 0
+
+    @property
+    def server_address(self):
+        return self._server.server_address if self._server else self._address
+
+    def bind(self):
+        if self._socket is None:
+            if os.path.exists(self._path):
+                os.unlink(self._path)
+            self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            try:
+                self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self._recv_buffer)
+            except socket.error:
+                pass
+            self._socket.bind(self._path)
+
+        if self._address and self._server is None:
+            self._server = make_server(self._address[0], self._address[1], self._app,
+                                       server_class=ThreadingWSGIServer,
+                                       handler_class=QuietWSGIRequestHandler)
+        return self._socket
+
+    def close(self):
+        if self._server is not None:
+            self._server.server_close()
+            self._server = None
+        if self._socket is not None:
+            self._socket.close()
+            self._socket = None
+            if os.path.exists(self._path):
+                os.unlink(self._path)
+
+    def recv_batch(self):
+        """Wait for packet and drain up to `batch_size` queued packets
+        """
+        return recv_batch(self._socket, self._batch_size, self._timeout)
+
+    def receive(self):
+        while not self._stopped.is_set():
+            try:
+                packets = self.recv_batch()
+                if packets:
+                    self.handle_packets(packets)
+            except Exception as e:
+                logger.error(e, exc_info=True)
+
+    def serve_forever(self):
+        """Receive packets and serve exposition in thread
+        """
+        self.bind()
+        if self._server is not None:
+            thread = Thread(target=self._server.serve_forever)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+            logger.info("Serve metrics on {0}:{1}".format(*self._server.server_address))
+        self.receive()
+
+    def start(self):
+        self.bind()
+        self._stopped.clear()
+        thread = Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self._threads.append(thread)
+        return self
+
+    def stop(self):
+        self._stopped.set()
+        if self._server is not None:
+            self._server.shutdown()
+        for thread in self._threads:
+            if thread.ident is not None:
+                thread.join()
+        self._threads = []
+        self.close()
+
+    def handle_packets(self, packets):
+        """Decode packets and apply aggregated updates to storage at once
+        """
+        writes, incs = {}, {}
+
+        for packet in packets:
+            self.packets += 1
+            try:
+                records = decode_packet(packet)
+            except AggregatorDecodeError as e:
+                self.errors += 1
+                logger.debug(e)
+                continue
+
+            for operation, key, value in records:
+                if operation == WRITE:
+                    incs.pop(key, None)
+                    writes[key] = value
+                elif key in writes:
+                    writes[key] += value
+                else:
+                    incs[key] = incs.get(key, 0) + value
+
+        self._registry.storage.apply_changes(self.get_declared(writes), self.get_declared(incs))
+
+    def get_declared(self, items):
+        """Get items of keys with declared metrics, skip invalid keys
+        """
+        declared = []
+        for key, value in items.items():
+            try:
+                self.declare_metric(key)
+            except (ValueError, RuntimeError, KeyError) as e:
+                self.errors += 1
+                logger.debug("Invalid key {0!r}: {1}".format(key, e))
+                continue
+            declared.append((key, value))
+        return declared
+
+    def declare_metric(self, key):
+        """Create metric for key name if it is not declared
+        """
+        if key[1] in self._metrics:
+            return self._metrics[key[1]]
+
+        label_names = tuple(label for label, _ in key[3] if label not in SUBTYPE_LABELS)
+        metric_class = METRIC_CLASSES[key[0]]
+        self._metrics[key[1]] = metric = metric_class(key[1], "Aggregated metric {0}".format(key[1]),
+                                                      label_names, registry=self._registry)
+        return metric
+
+
+class AggregatorStorage(BufferedStorage):
+    """Storage that sends changes to `AggregatorServer`
+
+    Changes are sent as packets up to `max_packet_size` bytes over
+    non-blocking unix datagram socket.
+
+    Changes that daemon can not take, because it is not running or
+    its queue is full, are applied to local `fallback` storage and
+    sent again with next flush, so workers never block and keep values.
+    """
+
+    def __init__(self, path, max_packet_size=16384, max_pending=10000, flush_interval=1.0, autoflush=True):
+        self._path = path
+        self._max_packet_size = max_packet_size
+
+        self._fallback = LocalMemoryStorage()
+        self._fallback_writes = set()
+
+        self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self._socket.setblocking(False)
+
+        self.sent = 0
+        self.deferred = 0
+        self.available = True
+        super(AggregatorStorage, self).__init__(max_pending, flush_interval, autoflush)
+
+    @property
+    def fallback(self):
+        return self._fallback
+
+    def get_items(self):
+        """Get values kept locally while daemon is not available
+        """
+        return self._fallback.get_items()
+
+    def remove_items(self, keys):
+        with self._lock:
+            for key in keys:
+                self._incs.pop(key, None)
+                self._writes.pop(key, None)
+                self._fallback_writes.discard(key)
+            self._fallback.remove_items(keys)
+
+    def clear(self):
+        with self._lock:
+            self._incs.clear()
+            self._writes.clear()
+            self._fallback.clear()
+            self._fallback_writes.clear()
+
+    def after_fork_in_child(self):
+        # Fallback values of parent are sent by parent
+        super(AggregatorStorage, self).after_fork_in_child()
+        self._fallback.clear()
+        self._fallback_writes.clear()
+
+    def take_changes(self):
+        """Swap buffers and merge pending changes after fallback ones
+
+        :return: (writes, incs)
+        """
+        with self._lock:
+            writes, self._writes = self._writes, {}
+            incs, self._incs = self._incs, {}
+
+            if not len(self._fallback):
+                return writes, incs
+
+            fallback_writes, fallback_incs = {}, {}
+            for key, value in self._fallback.get_items():
+                if key in self._fallback_writes:
+                    fallback_writes[key] = value
+                else:
+                    fallback_incs[key] = value
+            self._fallback.clear()
+            self._fallback_writes.clear()
+
+        for key, value in writes.items():
+            fallback_incs.pop(key, None)
+            fallback_writes[key] = value
+
+        for key, value in incs.items():
+            if key in fallback_writes:
+                fallback_writes[key] += value
+            else:
+                fallback_incs[key] = fallback_incs.get(key, 0) + value
+        return fallback_writes, fallback_incs
+
+    def get_packets(self, writes, incs):
+        """Pack records into packets up to `max_packet_size` bytes
+
+        :return: [(packet, writes, incs), ...]
+        """
+        records = chain(((WRITE, key, value) for key, value in writes.items()),
+                        ((INC, key, value) for key, value in incs.items()))
+
+        packet, size, packet_records = [MAGIC], len(MAGIC), ([], [])
+        for operation, key, value in records:
+            record = encode_record(operation, key, value)
+            if size > len(MAGIC) and size + len(record) > self._max_packet_size:
+                yield b"".join(packet), packet_records[WRITE], packet_records[INC]
+                packet, size, packet_records = [MAGIC], len(MAGIC), ([], [])
+            packet.append(record)
+            packet_records[operation].append((key, value))
+            size += len(record)
+
+        if size > len(MAGIC):
+            yield b"".join(packet), packet_records[WRITE], packet_records[INC]
+
+    def send(self, writes, incs):
+        """Send pending and fallback changes to daemon
+        """
+        unsent = None
+
+        for packet, packet_writes, packet_incs in self.get_packets(writes, incs):
+            if unsent is None:
+                try:
+                    self._socket.sendto(packet, self._path)
+                    self.sent += 1
+                    self.available = True
+                    continue
+                except socket.error as e:
+                    if e.args[0] in UNAVAILABLE_ERRORS:
+                        self.available = False
+                    elif e.args[0] not in BACKPRESSURE_ERRORS:
+                        raise
+                    unsent = e.args[0]
+            self.deferred += 1
+            self.apply_fallback(packet_writes, packet_incs)
+
+    def apply_fallback(self, writes, incs):
+        """Keep not sent changes before changes made since flush
+        """
+        with self._lock:
+            for key, value in writes:
+                self._fallback.write_value(key, value)
+                self._fallback_writes.add(key)
+            for key, value in incs:
+                self._fallback.inc_value(key, value)
+
+
+def parse_address(value):
+    host, _, port = value.rpartition(":")
+    return host or "0.0.0.0", int(port)
+
+
+def main(argv=None):
+    import logging
+
+    parser = argparse.ArgumentParser(description="pyprometheus unix socket aggregation daemon")
+    parser.add_argument("-s", "--socket", required=True, help="unix datagram socket path")
+    parser.add_argument("-a", "--address", type=parse_address, default=("0.0.0.0", 9100),
+                        help="exposition host:port")
+    parser.add_argument("--min-interval", type=float, default=0, help="seconds to reuse rendered scrape")
+    parser.add_argument("--batch-size", type=int, default=1000)
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+
+    server = AggregatorServer(BaseRegistry(storage=LocalMemoryStorage()), args.socket, args.address,
+                              args.min_interval, args.batch_size)
+    server.bind()
+
+    def stop(signum, frame):
+        server._stopped.set()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    sys.stdout.write("Listen {0} and serve metrics on {1}:{2}\n".format(args.socket, *server.server_address))
+    sys.stdout.flush()
+    try:
+        server.serve_forever()
+    finally:
+        server.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -4,27 +4,163 @@
 pyprometheus.contrib.graphite
 ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 
-Bridge to push metrics over TCP in the Graphite plaintext format.
+Bridge to push metrics over TCP in the Graphite plaintext or pickle format.
 
 :copyright: (c) 2017 by Alexandr Lispython.
 :license: , see LICENSE for more details.
 :github: http://github.com/Lispython/pyprometheus
 """
+import re
+import socket
+import struct
+import time
+from logging import getLogger
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+try:
+    xrange = xrange
+except Exception:
+    xrange = range
+
+
+logger = getLogger("pyprometheus.graphite")
+
+INVALID_CHARS = re.compile(r"[^a-zA-Z0-9_\-:.+]")
+
 
 class GraphitePusher(object):
+    """Push registry samples to graphite carbon over persistent connection
+
+    :param protocol: `plaintext` (port 2003) or `pickle` (port 2004)
+    :param prefix: path prefix for all metrics
+    :param tags: use graphite tags `name;label=value` instead of `name.label.value` paths
+    :param batch_size: datapoints per one send
+    """
 
-    def __init__(self, address, registry, connection_timeout=30):
+    PLAINTEXT = "plaintext"
+    PICKLE = "pickle"
+
+    def __init__(self, address, registry, connection_timeout=30, protocol=PLAINTEXT,
+                 prefix="", tags=True, batch_size=1000, retries=3, max_backoff=30):
         self._connection_timeout = connection_timeout
         self._address = address
         self._registry = registry
+        self._protocol = protocol
+        self._prefix = prefix
+        self._tags = tags
+        self._batch_size = batch_size
+        self._retries = retries
+        self._max_backoff = max_backoff
+        self._backoff = 0
+        self._socket = None
+
+    def sanitize(self, value):
+        value = INVALID_CHARS.sub("_", str(value))
+        return value if self._tags else value.replace(".", "_")
+
+    def format_path(self, name, labels):
+        """Make graphite path from metric name and labels
 
-    def format_sample(self, sample):
+        :param name: sanitized metric name with prefix and postfix
+        :param labels: tuple of (label, value) pairs
+        """
+        if self._tags:
+            return ";".join([name] + ["{0}={1}".format(self.sanitize(label), self.sanitize(value))
+                                      for label, value in labels])
+        return ".".join([name] + [self.sanitize(x) for pair in labels for x in pair])
+
+    def format_sample(self, sample, timestamp=None):
         """Format single sample to graphite format
+
+        :param sample: metric value object
+        :return: list of (path, (timestamp, value)) datapoints
         """
-        raise NotImplementedError
+        return self.format_samples(sample.metric, [sample], timestamp)
 
+    def format_samples(self, metric, samples, timestamp=None):
+        """Format whole metric family samples to graphite datapoints
 
-    def push(self):
+        Family name is sanitized once and labels are formatted in one pass.
+        """
+        timestamp = int(timestamp or time.time())
+        name = self._prefix + self.sanitize(metric.name)
+        return [(self.format_path(name + value.POSTFIX,
+                                  [(value.format_export_label(label), value.format_export_value(label_value))
+                                   for label, label_value in value.labels]),
+                 (timestamp, float(value.value)))
+                for sample in samples for value in sample.flatten()]
+
+    def get_datapoints(self, timestamp=None):
+        """Yield datapoints lists per registry collector
+        """
+        timestamp = int(timestamp or time.time())
+        for collector, samples in self._registry.get_samples():
+            yield self.format_samples(collector, samples, timestamp)
+
+    def encode(self, datapoints):
+        """Encode datapoints batch to bytes in pusher protocol
+        """
+        if self._protocol == self.PICKLE:
+            payload = pickle.dumps(datapoints, protocol=2)
+            return struct.pack("!L", len(payload)) + payload
+        return "".join(["{0} {1} {2}\n".format(path, value, ts)
+                        for path, (ts, value) in datapoints]).encode("utf-8")
+
+    def get_batches(self, timestamp=None):
+        """Split registry datapoints into batches of `batch_size`
+        """
+        batch = []
+        for datapoints in self.get_datapoints(timestamp):
+            batch.extend(datapoints)
+            if len(batch) < self._batch_size:
+                continue
+            tail = len(batch) - len(batch) % self._batch_size
+            for start in xrange(0, tail, self._batch_size):
+                yield batch[start:start + self._batch_size]
+            batch = batch[tail:]
+        if batch:
+            yield batch
+
+    def connect(self):
+        if self._socket is None:
+            self._socket = socket.create_connection(self._address, self._connection_timeout)
+        return self._socket
+
+    def close(self):
+        if self._socket is not None:
+            try:
+                self._socket.close()
+            except socket.error:
+                pass
+            self._socket = None
+
+    def send(self, data):
+        """Send data with reconnects and exponential backoff
+        """
+        for attempt in xrange(self._retries + 1):
+            try:
+                self.connect().sendall(data)
+                self._backoff = 0
+                return
+            except (socket.error, socket.timeout) as e:
+                self.close()
+                if attempt == self._retries:
+                    raise
+                self._backoff = min(self._max_backoff, (self._backoff * 2) or 0.1)
+                logger.warning("Graphite send failed: {0}, reconnect in {1} seconds".format(e, self._backoff))
+                time.sleep(self._backoff)
+
+    def push(self, timestamp=None):
         """Push samples from registry to graphite
+
+        :return: number of pushed datapoints
         """
-        raise NotImplementedError
+        count = 0
+        for batch in self.get_batches(timestamp):
+            self.send(self.encode(batch))
+            count += len(batch)
+        return count
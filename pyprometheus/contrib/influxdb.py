@@ -0,0 +1,178 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+pyprometheus.contrib.influxdb
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+Bridge to push metrics over UDP or HTTP in the InfluxDB line protocol.
+
+:copyright: (c) 2017 by Alexandr Lispython.
+:license: , see LICENSE for more details.
+:github: http://github.com/Lispython/pyprometheus
+"""
+import math
+import socket
+import time
+from logging import getLogger
+
+try:
+    import http.client as httplib
+except ImportError:
+    import httplib
+
+try:
+    from urllib.parse import urlencode
+except ImportError:
+    from urllib import urlencode
+
+
+logger = getLogger("pyprometheus.influxdb")
+
+
+class InfluxDBError(Exception):
+    pass
+
+
+def escape_measurement(value):
+    return str(value).replace(",", r"\,").replace(" ", r"\ ")
+
+
+def escape_key(value):
+    return str(value).replace(",", r"\,").replace("=", r"\=").replace(" ", r"\ ")
+
+
+class InfluxDBPusher(object):
+    """Push registry samples in InfluxDB line protocol
+
+    Metric name is measurement, labels are tags. Histogram and summary
+    series are one point with `sum`, `count` and bucket or quantile fields.
+    Lines are streamed from `registry.get_samples()` into reusable buffer
+    and sent in batches up to `batch_size` bytes.
+
+    :param protocol: `udp` or `http`
+    :param database: database name for http writes
+    :param precision: timestamps precision, `s`, `ms`, `u` or `ns`.
+                      Defaults to `ns` for udp (udp listener has no precision
+                      parameter) and to `ms` for http
+    """
+
+    UDP = "udp"
+    HTTP = "http"
+
+    PRECISIONS = {"s": 1, "ms": 1000, "u": 1000000, "ns": 1000000000}
+
+    def __init__(self, address, registry, protocol=UDP, database=None, prefix="",
+                 batch_size=None, timeout=30, precision=None):
+        self._address = address
+        self._registry = registry
+        self._protocol = protocol
+        self._precision = precision or ("ns" if protocol == self.UDP else "ms")
+        if self._precision not in self.PRECISIONS:
+            raise ValueError("Invalid precision {0}".format(self._precision))
+        self._multiplier = self.PRECISIONS[self._precision]
+        self._database = database
+        self._prefix = prefix
+        self._timeout = timeout
+        # Keep udp datagrams below common MTU
+        self._batch_size = batch_size or (1400 if protocol == self.UDP else 512 * 1024)
+        self._buffer = bytearray()
+        self._socket = None
+        self._connection = None
+
+    def format_fields(self, sample):
+        """Format sample fields
+
+        :param sample: metric value object
+        """
+        values = sample.flatten()
+        if len(values) == 1:
+            fields = [("value", values[0].value)]
+        else:
+            fields = []
+            for value in values:
+                if value.POSTFIX in ("_sum", "_count"):
+                    fields.append((value.POSTFIX[1:], value.value))
+                else:
+                    fields.append((value.format_export_value(dict(value.labels).get(
+                        "bucket", dict(value.labels).get("quantile"))), value.value))
+
+        return ",".join(["{0}={1!r}".format(escape_key(name), float(value))
+                         for name, value in fields
+                         if not (math.isinf(float(value)) or math.isnan(float(value)))])
+
+    def get_timestamp(self):
+        return int(time.time() * self._multiplier)
+
+    def format_samples(self, metric, samples, timestamp=None):
+        """Yield encoded lines for metric family samples
+
+        :param timestamp: integer timestamp in `precision` units
+        """
+        timestamp = int(timestamp or self.get_timestamp())
+        measurement = escape_measurement(self._prefix + metric.name)
+        for sample in samples:
+            fields = self.format_fields(sample)
+            if not fields:
+                continue
+            tags = "".join([",{0}={1}".format(escape_key(label), escape_key(value))
+                            for label, value in sample.labels if value != ""])
+            yield "{0}{1} {2} {3}\n".format(measurement, tags, fields, timestamp).encode("utf-8")
+
+    def get_lines(self, timestamp=None):
+        timestamp = int(timestamp or self.get_timestamp())
+        for collector, samples in self._registry.get_samples():
+            for line in self.format_samples(collector, samples, timestamp):
+                yield line
+
+    def push(self, timestamp=None):
+        """Push samples from registry to influxdb
+
+        :return: number of pushed points
+        """
+        count = 0
+        buf = self._buffer
+        del buf[:]
+        for line in self.get_lines(timestamp):
+            if buf and len(buf) + len(line) > self._batch_size:
+                self.send(buf)
+                del buf[:]
+            buf.extend(line)
+            count += 1
+        if buf:
+            self.send(buf)
+            del buf[:]
+        return count
+
+    def send(self, data):
+        if self._protocol == self.UDP:
+            if self._socket is None:
+                self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self._socket.sendto(data, self._address)
+            return
+
+        for attempt in (1, 2):
+            if self._connection is None:
+                self._connection = httplib.HTTPConnection(self._address[0], self._address[1], timeout=self._timeout)
+            try:
+                self._connection.request("POST", "/write?" + urlencode({"db": self._database, "precision": self._precision}),
+                                         bytes(data), {"Content-Type": "text/plain; charset=utf-8"})
+                response = self._connection.getresponse()
+                body = response.read()
+            except (httplib.HTTPException, IOError):
+                self.close()
+                if attempt == 2:
+                    raise
+                continue
+            if response.will_close:
+                self.close()
+            if response.status >= 300:
+                raise InfluxDBError("InfluxDB write failed with {0}: {1}".format(response.status, body))
+            return
+
+    def close(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+        if self._socket is not None:
+            self._socket.close()
+            self._socket = None
@@ -0,0 +1,246 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+pyprometheus.contrib.pushgateway
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+Client to push registry metrics to Prometheus Pushgateway.
+
+:copyright: (c) 2017 by Alexandr Lispython.
+:license: , see LICENSE for more details.
+:github: http://github.com/Lispython/pyprometheus
+"""
+import base64
+import gzip
+import random
+import time
+from io import BytesIO
+from logging import getLogger
+from threading import Event, Lock, Thread
+
+from pyprometheus.const import TYPES, CONTENT_TYPE
+from pyprometheus.metrics import Counter, Summary
+from pyprometheus.utils.exposition import registry_to_text
+
+try:
+    import http.client as httplib
+except ImportError:
+    import httplib
+
+try:
+    from urllib.parse import quote, urlparse
+except ImportError:
+    from urllib import quote
+    from urlparse import urlparse
+
+
+logger = getLogger("pyprometheus.pushgateway")
+
+
+class PushgatewayError(Exception):
+    pass
+
+
+class PushgatewayClient(object):
+    """Push registry to pushgateway over one persistent connection
+
+    Client is collector too, register it to get push stats.
+    """
+
+    def __init__(self, address, registry, job, timeout=30, gzip=True, namespace="pushgateway", labels={}):
+        if "://" not in address:
+            address = "http://" + address
+        url = urlparse(address)
+
+        self._scheme = url.scheme
+        self._host = url.hostname
+        self._port = url.port
+        self._prefix = url.path.rstrip("/")
+        self._registry = registry
+        self._job = job
+        self._timeout = timeout
+        self._gzip = gzip
+        self._namespace = namespace
+        self._labels = tuple(sorted(labels.items(), key=lambda x: x[0]))
+
+        self._connection = None
+        self._lock = Lock()
+
+        self._pushes = {}
+        self._failures = {}
+        self._durations = {}
+
+        self._collectors = self.declare_metrics()
+
+    @property
+    def uid(self):
+        return "pushgateway-client:{0}".format(self._namespace)
+
+    @property
+    def text_export_header(self):
+        return "# {0} stats metrics".format(self.__class__.__name__)
+
+    def metric_name(self, name):
+        """Make metric name with namespace
+
+        :param name:
+        """
+        return ":".join([self._namespace, name])
+
+    def declare_metrics(self):
+        return {
+            "push_duration": Summary(self.metric_name("push_duration_seconds"), "Pushgateway request duration", ("method", ) + self._labels),
+            "push_failures": Counter(self.metric_name("push_failures_total"), "Pushgateway failed requests", ("method", ) + self._labels)
+        }
+
+    def collect(self):
+        with self._lock:
+            pushes, failures = dict(self._pushes), dict(self._failures)
+            durations = dict(self._durations)
+
+        metric = self._collectors["push_duration"]
+        for method, duration in durations.items():
+            labels = self._labels + (("method", method), )
+            metric.add_sample(labels, metric.build_sample(labels, (
+                ((TYPES.SUMMARY_SUM, metric.name, "_sum", labels), duration),
+                ((TYPES.SUMMARY_COUNTER, metric.name, "_count", labels), pushes[method]))))
+
+        yield metric
+
+        metric = self._collectors["push_failures"]
+        for method, count in failures.items():
+            labels = self._labels + (("method", method), )
+            metric.add_sample(labels, metric.build_sample(labels, (
+                (TYPES.COUNTER, metric.name, "", labels, count), )))
+
+        yield metric
+
+    def get_path(self, grouping_key=None):
+        """Build url path for job and grouping key
+
+        :param grouping_key: dict of grouping labels
+        """
+        parts = [self._prefix, "metrics"] + self.format_label("job", self._job)
+        for name, value in sorted((grouping_key or {}).items()):
+            parts.extend(self.format_label(name, value))
+        return "/".join(parts)
+
+    def format_label(self, name, value):
+        value = str(value)
+        if not value or "/" in value:
+            value = base64.urlsafe_b64encode(value.encode("utf-8")).decode("ascii")
+            return [name + "@base64", value or "="]
+        return [name, quote(value, safe="")]
+
+    def encode(self):
+        """Render registry to pushgateway request body
+        """
+        body = registry_to_text(self._registry, timestamp=False).encode("utf-8")
+        if not self._gzip:
+            return body
+
+        buf = BytesIO()
+        with gzip.GzipFile(fileobj=buf, mode="wb", compresslevel=6) as f:
+            f.write(body)
+        return buf.getvalue()
+
+    def get_connection(self):
+        if self._connection is None:
+            connection_class = httplib.HTTPSConnection if self._scheme == "https" else httplib.HTTPConnection
+            self._connection = connection_class(self._host, self._port, timeout=self._timeout)
+        return self._connection
+
+    def close(self):
+        with self._lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
+
+    def push(self, grouping_key=None):
+        """Replace all metrics of grouping key
+        """
+        return self.request("PUT", grouping_key, self.encode())
+
+    def pushadd(self, grouping_key=None):
+        """Replace metrics with the same names of grouping key
+        """
+        return self.request("POST", grouping_key, self.encode())
+
+    def delete(self, grouping_key=None):
+        """Delete all metrics of grouping key
+        """
+        return self.request("DELETE", grouping_key, None)
+
+    def request(self, method, grouping_key, body):
+        headers = {}
+        if body is not None:
+            headers["Content-Type"] = CONTENT_TYPE
+            if self._gzip:
+                headers["Content-Encoding"] = "gzip"
+
+        start_time = time.time()
+        failed = True
+        # Stats are updated under connection lock, `collect` reads them under it too
+        with self._lock:
+            try:
+                status, data = self.send(method, self.get_path(grouping_key), body, headers)
+                failed = status >= 400
+            finally:
+                self._pushes[method] = self._pushes.get(method, 0) + 1
+                self._durations[method] = self._durations.get(method, 0) + time.time() - start_time
+                if failed:
+                    self._failures[method] = self._failures.get(method, 0) + 1
+
+        if failed:
+            raise PushgatewayError("Pushgateway {0} failed with {1}: {2}".format(method, status, data))
+        return status
+
+    def send(self, method, path, body, headers):
+        """Send request and reconnect once if kept alive connection was closed
+        """
+        for attempt in (1, 2):
+            connection = self.get_connection()
+            try:
+                connection.request(method, path, body, headers)
+                response = connection.getresponse()
+                data = response.read()
+                if response.will_close:
+                    self._connection = None
+                return response.status, data
+            except (httplib.HTTPException, IOError):
+                connection.close()
+                self._connection = None
+                if attempt == 2:
+                    raise
+
+
+class PushgatewayPusher(Thread):
+    """Background thread to push registry every interval seconds
+
+    :param interval: seconds between pushes
+    :param jitter: max random seconds added or subtracted from interval
+    """
+
+    def __init__(self, client, interval=15, jitter=0, method="push", grouping_key=None):
+        super(PushgatewayPusher, self).__init__()
+        self.daemon = True
+        self._client = client
+        self._interval = interval
+        self._jitter = jitter
+        self._method = method
+        self._grouping_key = grouping_key
+        self._stopped = Event()
+
+    def get_delay(self):
+        return max(0, self._interval + random.uniform(-self._jitter, self._jitter))
+
+    def run(self):
+        while not self._stopped.wait(self.get_delay()):
+            try:
+                getattr(self._client, self._method)(self._grouping_key)
+            except Exception as e:
+                logger.error(e, exc_info=True)
+
+    def stop(self, timeout=None):
+        self._stopped.set()
+        self.join(timeout)
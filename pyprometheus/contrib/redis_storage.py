@@ -0,0 +1,428 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+pyprometheus.contrib.redis_storage
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+Storage backed by Redis hash to share values between
+short-lived processes and hosts.
+
+:copyright: (c) 2017 by Alexandr Lispython.
+:license: , see LICENSE for more details.
+:github: http://github.com/Lispython/pyprometheus
+"""
+import hashlib
+import marshal
+import os
+import socket
+import time
+from contextlib import contextmanager
+from logging import getLogger
+from threading import Condition, Lock
+
+from pyprometheus.storage import BufferedStorage, expand_vectors
+
+
+logger = getLogger("pyprometheus.redis")
+
+
+class RedisError(Exception):
+    pass
+
+
+class RedisConnectionError(RedisError):
+    pass
+
+
+def encode_arg(value):
+    if isinstance(value, bytes):
+        return value
+    if isinstance(value, float):
+        value = repr(value)
+    elif not isinstance(value, type(u"")):
+        value = str(value)
+    return value.encode("utf-8")
+
+
+def encode_command(args):
+    """Encode command to RESP array of bulk strings
+    """
+    args = [encode_arg(x) for x in args]
+    parts = [("*{0}\r\n".format(len(args))).encode()]
+    parts.extend(b"".join([("${0}\r\n".format(len(x))).encode(), x, b"\r\n"]) for x in args)
+    return b"".join(parts)
+
+
+class RedisConnection(object):
+    """Blocking connection that speaks RESP protocol
+    """
+
+    def __init__(self, host="127.0.0.1", port=6379, db=0, password=None, socket_timeout=5):
+        self._host = host
+        self._port = port
+        self._db = db
+        self._password = password
+        self._socket_timeout = socket_timeout
+        self._socket = None
+        self._file = None
+
+    def connect(self):
+        if self._socket is not None:
+            return
+        try:
+            self._socket = socket.create_connection((self._host, self._port), self._socket_timeout)
+        except socket.error as e:
+            raise RedisConnectionError("Error connecting to {0}:{1}: {2}".format(self._host, self._port, e))
+        self._socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._file = self._socket.makefile("rb")
+
+        if self._password:
+            self.execute("AUTH", self._password)
+        if self._db:
+            self.execute("SELECT", self._db)
+
+    def disconnect(self):
+        if self._socket is not None:
+            try:
+                self._file.close()
+                self._socket.close()
+            except socket.error:
+                pass
+        self._socket = None
+        self._file = None
+
+    def readline(self):
+        line = self._file.readline()
+        if not line.endswith(b"\r\n"):
+            raise RedisConnectionError("Connection closed by server")
+        return line[:-2]
+
+    def read_response(self):
+        line = self.readline()
+        prefix, rest = line[:1], line[1:]
+
+        if prefix == b"+":
+            return rest
+        elif prefix == b"-":
+            return RedisError(rest.decode("utf-8", "replace"))
+        elif prefix == b":":
+            return int(rest)
+        elif prefix == b"$":
+            size = int(rest)
+            if size == -1:
+                return None
+            data = self._file.read(size + 2)
+            if len(data) != size + 2:
+                raise RedisConnectionError("Connection closed by server")
+            return data[:-2]
+        elif prefix == b"*":
+            size = int(rest)
+            if size == -1:
+                return None
+            return [self.read_response() for _ in range(size)]
+        raise RedisConnectionError("Invalid response {0!r}".format(line))
+
+    def pipeline(self, commands):
+        """Send commands at once and read all responses
+
+        :return: list of responses, errors are returned as `RedisError`
+        """
+        self.connect()
+        try:
+            self._socket.sendall(b"".join(encode_command(x) for x in commands))
+            return [self.read_response() for _ in commands]
+        except (socket.error, RedisConnectionError) as e:
+            self.disconnect()
+            raise RedisConnectionError(str(e))
+
+    def execute(self, *args):
+        response = self.pipeline([args])[0]
+        if isinstance(response, RedisError):
+            raise response
+        return response
+
+
+class RedisConnectionPool(object):
+    """Pool of connections reused by threads
+
+    Thread waits up to `timeout` seconds for free connection when
+    `max_connections` are in use. Pool is dropped in forked child,
+    connections are not shared between processes.
+    """
+
+    def __init__(self, host="127.0.0.1", port=6379, db=0, password=None, socket_timeout=5, max_connections=10,
+                 timeout=5):
+        self._params = {"host": host, "port": port, "db": db, "password": password, "socket_timeout": socket_timeout}
+        self._max_connections = max_connections
+        self._timeout = timeout
+        self._lock = Condition(Lock())
+        self._reset()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._available = []
+        self._created = 0
+
+    def after_fork_in_child(self):
+        """Drop parent connections without closing them
+        """
+        self._lock = Condition(Lock())
+        self._reset()
+
+    def get_connection(self):
+        deadline = time.time() + self._timeout
+        with self._lock:
+            if self._pid != os.getpid():
+                self._reset()
+            while not self._available and self._created >= self._max_connections:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise RedisConnectionError("No free connection in {0} seconds".format(self._timeout))
+                self._lock.wait(remaining)
+            if self._available:
+                return self._available.pop()
+            self._created += 1
+        return RedisConnection(**self._params)
+
+    def release(self, connection):
+        with self._lock:
+            if self._pid != os.getpid():
+                return
+            if connection._socket is None:
+                self._created -= 1
+            else:
+                self._available.append(connection)
+            self._lock.notify()
+
+    @contextmanager
+    def connection(self):
+        connection = self.get_connection()
+        try:
+            yield connection
+        finally:
+            self.release(connection)
+
+    def disconnect(self):
+        with self._lock:
+            for connection in self._available:
+                connection.disconnect()
+            self._created -= len(self._available)
+            self._available = []
+            self._lock.notify_all()
+
+
+class RedisStorage(BufferedStorage):
+    """Storage that keeps values in one Redis hash
+
+    Fields are marshaled keys. Buffered changes are sent as one pipeline of
+    `HINCRBYFLOAT` and `HSET` commands in `MULTI` transaction. With
+    `flush_interval=None` changes are sent immediately, errors are logged,
+    and `inc_items` runs as one server-side script.
+    `get_items` flushes buffer and reads hash by `HSCAN` pages of `scan_count`,
+    `count` gets hash size.
+    """
+
+    # Increment many fields by one call
+    INC_SCRIPT = "\n".join([
+        "for i = 1, #ARGV, 2 do",
+        "    redis.call('HINCRBYFLOAT', KEYS[1], ARGV[i], ARGV[i + 1])",
+        "end",
+        "return #ARGV / 2"])
+
+    INC_SCRIPT_SHA = hashlib.sha1(INC_SCRIPT.encode("utf-8")).hexdigest()
+
+    def __init__(self, host="127.0.0.1", port=6379, db=0, password=None, key="pyprometheus",
+                 pool=None, max_connections=10, flush_interval=1.0, max_pending=10000, scan_count=1000,
+                 autoflush=True):
+        self._pool = pool or RedisConnectionPool(host, port, db, password, max_connections=max_connections)
+        self._key = key
+        self._scan_count = scan_count
+        self._keys_cache = {}
+        super(RedisStorage, self).__init__(max_pending, flush_interval, autoflush)
+
+    @property
+    def pool(self):
+        return self._pool
+
+    @property
+    def buffered(self):
+        return self._flush_interval is not None
+
+    def serialize_key(self, key):
+        try:
+            return self._keys_cache[key]
+        except KeyError:
+            self._keys_cache[key] = val = marshal.dumps(key, 2)
+            return val
+
+    def unserialize_key(self, serialized_key):
+        return marshal.loads(serialized_key)
+
+    def execute(self, *args):
+        with self._pool.connection() as connection:
+            return connection.execute(*args)
+
+    def pipeline(self, commands):
+        with self._pool.connection() as connection:
+            responses = connection.pipeline(commands)
+        for response in responses:
+            if isinstance(response, RedisError):
+                raise response
+        return responses
+
+    def inc_value(self, key, value):
+        if not self.buffered:
+            try:
+                return float(self.execute("HINCRBYFLOAT", self._key, self.serialize_key(key), float(value)))
+            except Exception as e:
+                logger.error(e, exc_info=True)
+                return
+        return super(RedisStorage, self).inc_value(key, value)
+
+    def write_value(self, key, value):
+        if not self.buffered:
+            try:
+                self.execute("HSET", self._key, self.serialize_key(key), float(value))
+            except Exception as e:
+                logger.error(e, exc_info=True)
+            return value
+        return super(RedisStorage, self).write_value(key, value)
+
+    def apply_changes(self, writes, incs, vectors=()):
+        if self.buffered:
+            return super(RedisStorage, self).apply_changes(writes, incs, vectors)
+
+        if vectors:
+            incs = list(incs) + expand_vectors(vectors)
+        self.write_items(writes)
+        self.inc_items(incs)
+
+    def inc_items(self, items):
+        """Increment many keys by one script call
+        """
+        if self.buffered:
+            return super(RedisStorage, self).inc_items(items)
+
+        args = []
+        for key, value in items:
+            args.extend((self.serialize_key(key), float(value)))
+        if args:
+            try:
+                self.eval_inc_script(args)
+            except Exception as e:
+                logger.error(e, exc_info=True)
+
+    def write_items(self, items):
+        if self.buffered:
+            return super(RedisStorage, self).write_items(items)
+
+        args = []
+        for key, value in items:
+            args.extend((self.serialize_key(key), float(value)))
+        if args:
+            try:
+                self.execute("HSET", self._key, *args)
+            except Exception as e:
+                logger.error(e, exc_info=True)
+
+    def inc_vector(self, key, values, series_keys=None):
+        self.apply_changes((), (), ((key, values, series_keys), ))
+
+    def eval_inc_script(self, args):
+        try:
+            return self.execute("EVALSHA", self.INC_SCRIPT_SHA, 1, self._key, *args)
+        except RedisError as e:
+            if not str(e).startswith("NOSCRIPT"):
+                raise
+        # Script cache is empty after server restart
+        return self.execute("EVAL", self.INC_SCRIPT, 1, self._key, *args)
+
+    def get_value(self, key):
+        with self._lock:
+            if key in self._writes:
+                return self._writes[key]
+            pending = self._incs.get(key, 0.0)
+        value = self.execute("HGET", self._key, self.serialize_key(key))
+        return (float(value) if value is not None else 0.0) + pending
+
+    def stop(self):
+        if self.buffered:
+            super(RedisStorage, self).stop()
+
+    def prepare_fork(self):
+        if self.buffered:
+            self.flush()
+
+    def after_fork_in_child(self):
+        super(RedisStorage, self).after_fork_in_child()
+        self._pool.after_fork_in_child()
+
+    def send(self, writes, incs):
+        """Send buffered changes as one pipeline in `MULTI` transaction
+
+        Redis discards transaction if connection breaks before `EXEC`,
+        then all changes are returned to buffer. If `EXEC` reply is lost,
+        applied changes are sent again, so delivery is at-least-once.
+        Only changes of failed commands are returned if Redis returns
+        errors for them.
+        """
+        # Command and (writes, incs) it sends
+        commands = []
+        if writes:
+            args = ["HSET", self._key]
+            for key, value in writes.items():
+                args.extend((self.serialize_key(key), float(value)))
+            commands.append((args, (writes, {})))
+
+        for key, value in incs.items():
+            commands.append((("HINCRBYFLOAT", self._key, self.serialize_key(key), float(value)), ({}, {key: value})))
+
+        try:
+            with self._pool.connection() as connection:
+                responses = connection.pipeline([("MULTI", )] + [command for command, _ in commands] + [("EXEC", )])
+        except Exception as e:
+            logger.warning("Failed to flush metrics to redis: {0}".format(e))
+            self.restore(writes, incs)
+            return
+
+        if not isinstance(responses[-1], list):
+            # Transaction is aborted, nothing is applied
+            logger.warning("Failed to flush metrics to redis: {0}".format(responses[-1]))
+            self.restore(writes, incs)
+            return
+
+        failed_writes, failed_incs = {}, {}
+        for (_, (command_writes, command_incs)), response in zip(commands, responses[-1]):
+            if isinstance(response, RedisError):
+                logger.warning("Failed to flush metrics to redis: {0}".format(response))
+                failed_writes.update(command_writes)
+                failed_incs.update(command_incs)
+
+        if failed_writes or failed_incs:
+            self.restore(failed_writes, failed_incs)
+
+    def get_items(self):
+        if self.buffered:
+            self.flush()
+
+        cursor = b"0"
+        while True:
+            cursor, fields = self.execute("HSCAN", self._key, cursor, "COUNT", self._scan_count)
+            for i in range(0, len(fields), 2):
+                yield self.unserialize_key(fields[i]), float(fields[i + 1])
+            if cursor == b"0":
+                break
+
+    def remove_items(self, keys):
+        super(RedisStorage, self).remove_items(keys)
+        if keys:
+            self.execute("HDEL", self._key, *[self.serialize_key(key) for key in keys])
+
+    def count(self):
+        """Get number of keys stored in Redis hash
+        """
+        return self.execute("HLEN", self._key)
+
+    def clear(self):
+        super(RedisStorage, self).clear()
+        self.execute("DEL", self._key)
@@ -0,0 +1,341 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+pyprometheus.contrib.statsd
+~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+StatsD protocol bridge
+
+:copyright: (c) 2017 by Alexandr Lispython.
+:license: , see LICENSE for more details.
+:github: http://github.com/Lispython/pyprometheus
+"""
+import errno
+import math
+import re
+import socket
+from logging import getLogger
+from threading import Event, Thread
+
+from pyprometheus.const import TYPES
+from pyprometheus.metrics import Counter, Gauge, Histogram
+from pyprometheus.storage import BufferedStorage
+from pyprometheus.utils import recv_batch
+
+
+logger = getLogger("pyprometheus.statsd")
+
+INVALID_NAME_CHARS = re.compile(r"[^a-zA-Z0-9_:]")
+
+
+class StatsDParseError(Exception):
+    pass
+
+
+class StatsDServer(object):
+    """UDP server that parses StatsD lines into registry metrics
+
+    Supports `c`, `g`, `ms` and `h` types, sample rates and DogStatsD tags::
+
+        name:value|type|@rate|#tag1:value1,tag2:value2
+
+    Packets are read in batches of up to `batch_size` per wakeup,
+    updates are aggregated per series and applied to storage once per batch.
+    `ms` timers are converted to seconds. Counters and timers observations
+    with sample rate are counted with weight `1 / rate`.
+    """
+
+    TYPES = {
+        "c": Counter,
+        "g": Gauge,
+        "ms": Histogram,
+        "h": Histogram
+    }
+
+    def __init__(self, registry, address=("0.0.0.0", 8125), buckets=Histogram.DEFAULT_BUCKETS,
+                 batch_size=1000, cache_size=100000, recv_buffer=4 * 1024 * 1024, timeout=0.5):
+        self._registry = registry
+        self._address = address
+        self._buckets = buckets
+        self._batch_size = batch_size
+        self._cache_size = cache_size
+        self._recv_buffer = recv_buffer
+        self._timeout = timeout
+
+        self._metrics = {}
+        # Parsed line without value -> (type, series, rate)
+        self._cache = {}
+        self._socket = None
+        self._stopped = Event()
+        self._thread = None
+
+        self.packets = 0
+        self.errors = 0
+
+    @property
+    def address(self):
+        return self._socket.getsockname() if self._socket else self._address
+
+    def bind(self):
+        if self._socket is None:
+            self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            try:
+                self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self._recv_buffer)
+            except socket.error:
+                pass
+            self._socket.bind(self._address)
+        return self._socket
+
+    def close(self):
+        if self._socket is not None:
+            self._socket.close()
+            self._socket = None
+
+    def recv_batch(self):
+        """Wait for packet and drain up to `batch_size` queued packets
+        """
+        return recv_batch(self._socket, self._batch_size, self._timeout)
+
+    def serve_forever(self):
+        self.bind()
+        while not self._stopped.is_set():
+            try:
+                packets = self.recv_batch()
+                if packets:
+                    self.handle_packets(packets)
+            except Exception as e:
+                logger.error(e, exc_info=True)
+
+    def start(self):
+        self.bind()
+        self._stopped.clear()
+        self._thread = Thread(target=self.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.close()
+
+    def handle_packets(self, packets):
+        """Parse packets and apply aggregated updates to registry
+        """
+        counters, gauges, observations = {}, {}, {}
+
+        for packet in packets:
+            self.packets += 1
+            for line in packet.decode("utf-8", "replace").split("\n"):
+                if not line:
+                    continue
+                try:
+                    metric_type, series, rate, value = self.parse_line(line)
+                except (StatsDParseError, ValueError, RuntimeError) as e:
+                    self.errors += 1
+                    logger.debug("Invalid statsd line {0!r}: {1}".format(line, e))
+                    continue
+
+                if metric_type == "c":
+                    counters[series] = counters.get(series, 0) + value / rate
+                elif metric_type == "g":
+                    if line.split(":", 1)[1][:1] in "+-":
+                        current = gauges.get(series)
+                        gauges[series] = (current if current is not None else series.get()) + value
+                    else:
+                        gauges[series] = value
+                else:
+                    observations.setdefault(series, []).append((value, 1.0 / rate))
+
+        # Transaction sums observations of each series into one vector increment
+        with self._registry.batch():
+            for series, value in counters.items():
+                series.inc(value)
+
+            for series, value in gauges.items():
+                series.set(value)
+
+            for series, values in observations.items():
+                for value, weight in values:
+                    series.observe(value, weight)
+
+    def parse_line(self, line):
+        """Parse StatsD line
+
+        :return: (type, metric labels child, sample rate, value)
+        """
+        try:
+            name, rest = line.split(":", 1)
+            value, suffix = rest.split("|", 1)
+        except ValueError:
+            raise StatsDParseError("Invalid line format")
+
+        try:
+            metric_type, series, rate = self._cache[(name, suffix)]
+        except KeyError:
+            metric_type, series, rate = self.parse_suffix(name, suffix)
+            if len(self._cache) >= self._cache_size:
+                self._cache.clear()
+            self._cache[(name, suffix)] = (metric_type, series, rate)
+
+        value = float(value)
+        if metric_type == "ms":
+            value /= 1000.0
+        return metric_type, series, rate, value
+
+    def parse_suffix(self, name, suffix):
+        """Parse type, sample rate and tags and get metric series
+        """
+        parts = suffix.split("|")
+        metric_type = parts[0]
+
+        if metric_type not in self.TYPES:
+            raise StatsDParseError("Unsupported type {0}".format(metric_type))
+
+        rate = 1.0
+        labels = {}
+        for part in parts[1:]:
+            if part.startswith("@"):
+                rate = float(part[1:]) or 1.0
+            elif part.startswith("#"):
+                for tag in part[1:].split(","):
+                    label, _, label_value = tag.partition(":")
+                    labels[self.sanitize(label)] = label_value
+
+        metric = self.get_metric(self.sanitize(name), metric_type, tuple(sorted(labels)))
+        return metric_type, metric.labels(**labels), rate
+
+    def sanitize(self, name):
+        name = INVALID_NAME_CHARS.sub("_", name)
+        if name[:1].isdigit():
+            name = "_" + name
+        return name
+
+    def get_metric(self, name, metric_type, label_names):
+        """Get or create metric for name
+        """
+        metric_class = self.TYPES[metric_type]
+        try:
+            metric = self._metrics[name]
+        except KeyError:
+            if metric_class is Histogram:
+                metric = Histogram(name, "StatsD metric {0}".format(name), label_names,
+                                   buckets=self._buckets, registry=self._registry)
+            else:
+                metric = metric_class(name, "StatsD metric {0}".format(name), label_names, registry=self._registry)
+            self._metrics[name] = metric
+
+        if not isinstance(metric, metric_class) or metric.label_names != label_names:
+            raise StatsDParseError("Metric {0} already declared with another type or tags".format(name))
+        return metric
+
+
+class StatsDStorage(BufferedStorage):
+    """Write only storage that forwards updates to StatsD
+
+    Increments are pre-aggregated per key and gauges keep last written value
+    until flush, so many `inc` calls become one line. Lines are packed into
+    packets up to `max_packet_size` bytes and sent over non-blocking UDP socket
+    by background thread every `flush_interval` seconds, when
+    `max_pending` keys are buffered and at exit.
+    """
+
+    def __init__(self, address=("127.0.0.1", 8125), prefix="", tags=True,
+                 max_packet_size=1432, max_pending=10000, flush_interval=1.0, autoflush=True):
+        self._address = address
+        self._prefix = prefix
+        self._tags = tags
+        self._max_packet_size = max_packet_size
+        self._names = {}
+
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._socket.setblocking(False)
+
+        self.sent = 0
+        self.dropped = 0
+        super(StatsDStorage, self).__init__(max_pending, flush_interval, autoflush)
+
+    def get_items(self):
+        return []
+
+    def remove_items(self, keys):
+        super(StatsDStorage, self).remove_items(keys)
+        with self._lock:
+            for key in keys:
+                self._names.pop(key, None)
+
+    def format_name(self, key):
+        """Format StatsD line prefix for key
+
+        :param key: (type, name, postfix, labels) tuple
+        """
+        try:
+            return self._names[key]
+        except KeyError:
+            pass
+
+        labels = [("le" if label == "bucket" else label,
+                   "+Inf" if value == float("inf") else value) for label, value in key[3]]
+        name = self._prefix + key[1] + key[2]
+
+        if self._tags:
+            tags = ",".join("{0}:{1}".format(label, value) for label, value in labels)
+            self._names[key] = name = (name, "|#" + tags if tags else "")
+        else:
+            self._names[key] = name = (".".join([name] + [str(x) for pair in labels for x in pair]), "")
+        return name
+
+    def get_lines(self, writes, incs):
+        """Format changes to StatsD lines
+
+        Gauges increments are sent as signed deltas, so negative gauge
+        write is sent after reset to zero to not be read as delta.
+        """
+        lines = []
+        for key, value in writes.items():
+            name, tags = self.format_name(key)
+            value = self.format_value(value)
+            if value < 0:
+                # Both lines are kept in one packet
+                lines.append("{0}:0|g{1}\n{0}:{2}|g{1}".format(name, tags, value))
+            else:
+                lines.append("{0}:{1}|g{2}".format(name, value, tags))
+
+        for key, value in incs.items():
+            name, tags = self.format_name(key)
+            template = "{0}:{1:+}|g{2}" if key[0] == TYPES.GAUGE else "{0}:{1}|c{2}"
+            lines.append(template.format(name, self.format_value(value), tags))
+        return lines
+
+    def format_value(self, value):
+        if not (math.isinf(value) or math.isnan(value)) and value == int(value):
+            return int(value)
+        return value
+
+    def get_packets(self, lines):
+        """Pack lines into packets up to `max_packet_size` bytes
+        """
+        packet, size = [], 0
+        for line in lines:
+            line = line.encode("utf-8")
+            if packet and size + len(line) + 1 > self._max_packet_size:
+                yield b"\n".join(packet)
+                packet, size = [], 0
+            packet.append(line)
+            size += len(line) + 1
+        if packet:
+            yield b"\n".join(packet)
+
+    def send(self, writes, incs):
+        """Send changes to StatsD, packets not taken by socket are dropped
+        """
+        for packet in self.get_packets(self.get_lines(writes, incs)):
+            try:
+                self._socket.sendto(packet, self._address)
+                self.sent += 1
+            except socket.error as e:
+                if e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK, errno.ENOBUFS, errno.ECONNREFUSED):
+                    raise
+                self.dropped += 1
@@ -14,13 +14,27 @@ UWSGI server process collector and storage
 import marshal
 import os
 import struct
+import threading
+import time
 import uuid
+import zlib
 import copy
 from contextlib import contextmanager
+from itertools import chain
+from multiprocessing.pool import ThreadPool
 from logging import getLogger
+from timeit import default_timer
+from wsgiref.simple_server import WSGIServer, WSGIRequestHandler, make_server
 from pyprometheus.const import TYPES
 from pyprometheus.metrics import Gauge, Counter
-from pyprometheus.storage import BaseStorage, LocalMemoryStorage
+from pyprometheus.storage import (BaseStorage, BufferedStorage, LocalMemoryStorage, expand_vector_key, expand_vectors,
+                                  register_fork_hooks, after_fork_in_child)
+from pyprometheus.utils.exposition import MetricsWSGIApp
+
+try:
+    from socketserver import ThreadingMixIn
+except ImportError:
+    from SocketServer import ThreadingMixIn
 
 
 try:
@@ -40,6 +54,33 @@ class InvalidUWSGISharedareaPagesize(Exception):
 logger = getLogger("pyprometheus.uwsgi_features")
 
 
+def install_postfork_hook():
+    """Reset storages in uwsgi workers and mules after fork
+
+    uwsgi forks them without `os.fork`, so `os.register_at_fork`
+    hooks are not called by every uwsgi version.
+    """
+    if uwsgi is None:
+        return False
+
+    try:
+        from uwsgidecorators import postfork
+    except ImportError:
+        previous = getattr(uwsgi, "post_fork_hook", None)
+
+        def post_fork_hook():
+            after_fork_in_child()
+            if previous is not None:
+                previous()
+        uwsgi.post_fork_hook = post_fork_hook
+    else:
+        postfork(after_fork_in_child)
+    return True
+
+
+install_postfork_hook()
+
+
 class UWSGICollector(object):
     """Grap UWSGI stats and export to prometheus
     """
@@ -155,6 +196,8 @@ class UWSGICollector(object):
 class UWSGIStorage(BaseStorage):
     """A dict of doubles, backend by uwsgi sharedarea"""
 
+    shared = True
+
     SHAREDAREA_ID = int(os.environ.get("PROMETHEUS_UWSGI_SHAREDAREA", 0))
     KEY_SIZE_SIZE = 4
     KEY_VALUE_SIZE = 8
@@ -162,6 +205,8 @@ class UWSGIStorage(BaseStorage):
     AREA_SIZE_SIZE = 4
     SIGN_POSITION = 4
     AREA_SIZE_POSITION = 0
+    # Keys are written after area size and sign
+    HEADER_SIZE = AREA_SIZE_SIZE + SIGN_SIZE
 
     def __init__(self, sharedarea_id=SHAREDAREA_ID, namespace="", stats=False, labels={}):
         self._sharedarea_id = sharedarea_id
@@ -177,10 +222,13 @@ class UWSGIStorage(BaseStorage):
         self._labels = tuple(sorted(labels.items(), key=lambda x: x[0]))
 
         self._syncs = 0
+        # Set by `pyprometheus.instrumentation.Instrumentation`
+        self._instrumentation = None
 
         self._m = uwsgi.sharedarea_memoryview(self._sharedarea_id)
 
         self.init_memory()
+        register_fork_hooks(self)
 
         self._collectors = self.declare_metrics()
 
@@ -313,7 +361,7 @@ class UWSGIStorage(BaseStorage):
 
             if self._used == 0:
                 self.update_area_sign()
-                self.update_area_size(self.SIGN_SIZE + self.AREA_SIZE_SIZE)
+                self.update_area_size(self.HEADER_SIZE)
 
             if validation:
                 self.validate_actuality()
@@ -325,7 +373,7 @@ class UWSGIStorage(BaseStorage):
         if self.get_area_size() == 0:
             self.init_memory(False)
 
-        pos = self.AREA_SIZE_POSITION + self.AREA_SIZE_SIZE + self.SIGN_SIZE
+        pos = self.AREA_SIZE_POSITION + self.HEADER_SIZE
         self._used = self.get_area_size()
         self._sign = self.get_area_sign()
         self._positions.clear()
@@ -374,7 +422,16 @@ class UWSGIStorage(BaseStorage):
 
         :param key: key string
         """
+        positions = self.append_key(key, init_value)
+        self.update_area_sign()
+        return positions
 
+    def append_key(self, key, init_value=0.0):
+        """Write key to the end of area without sign update
+
+        :param key: serialized key string
+        :param init_value: initial key value
+        """
         value = self.get_binary_string(key, init_value)
 
         key_string_position = self._used + self.AREA_SIZE_POSITION
@@ -384,7 +441,6 @@ class UWSGIStorage(BaseStorage):
         self.update_area_size(self._used + len(value))
         self._positions[key] = [key_string_position, key_string_position + self.KEY_SIZE_SIZE,
                                 self._used - self.KEY_VALUE_SIZE, self._used]
-        self.update_area_sign()
         return self._positions[key]
 
     def read_key_string(self, position, size):
@@ -394,7 +450,7 @@ class UWSGIStorage(BaseStorage):
         :param size:  int key size in bytes to read
         """
         key_string_bytes = self.m[self.get_slice(position, size)]
-        return struct.unpack(b"{0}s".format(size), key_string_bytes)[0]
+        return struct.unpack("{0}s".format(size).encode(), key_string_bytes)[0]
 
 
     def read_key_value(self, position):
@@ -516,6 +572,8 @@ class UWSGIStorage(BaseStorage):
         """
         if not self.is_actual:
             self.load_exists_positions()
+            if self._instrumentation is not None:
+                self._instrumentation.inc_rescans(self._sharedarea_id)
 
         return True
 
@@ -524,12 +582,19 @@ class UWSGIStorage(BaseStorage):
         lock_id = uuid.uuid4().hex
         if not self.wlocked and not self.rlocked:
             self.wlocked, self.rlocked = lock_id, lock_id
+            instrumentation = self._instrumentation
+            if instrumentation is not None:
+                start = default_timer()
             uwsgi.sharedarea_wlock(self._sharedarea_id)
+            if instrumentation is not None:
+                locked_at = default_timer()
             try:
                 yield
             except Exception as e:
                 logger.error(e, exc_info=True)
             uwsgi.sharedarea_unlock(self._sharedarea_id)
+            if instrumentation is not None:
+                instrumentation.observe_lock(self._sharedarea_id, "write", locked_at - start, default_timer() - locked_at)
             self.wlocked, self.rlocked = False, False
         else:
             yield
@@ -539,12 +604,19 @@ class UWSGIStorage(BaseStorage):
         lock_id = uuid.uuid4().hex
         if not self.rlocked:
             self.rlocked = lock_id
+            instrumentation = self._instrumentation
+            if instrumentation is not None:
+                start = default_timer()
             uwsgi.sharedarea_rlock(self._sharedarea_id)
+            if instrumentation is not None:
+                locked_at = default_timer()
             try:
                 yield
             except Exception as e:
                 logger.error(e, exc_info=True)
             uwsgi.sharedarea_unlock(self._sharedarea_id)
+            if instrumentation is not None:
+                instrumentation.observe_lock(self._sharedarea_id, "read", locked_at - start, default_timer() - locked_at)
             self.rlocked = False
         else:
             yield
@@ -553,6 +625,23 @@ class UWSGIStorage(BaseStorage):
         self._wlocked, self._rlocked = False, False
         uwsgi.sharedarea_unlock(self._sharedarea_id)
 
+    def get_serialized_keys(self):
+        return self._positions.keys()
+
+    def prepare_fork(self):
+        """Load keys positions and serialized keys cache
+
+        Children forked after it don't rescan area and don't marshal known keys.
+        """
+        with self.lock():
+            self.validate_actuality()
+            for serialized_key in self.get_serialized_keys():
+                self._keys_cache[self.unserialize_key(serialized_key)] = serialized_key
+
+    def after_fork_in_child(self):
+        # Lock taken by other thread of parent is not held in child
+        self._wlocked, self._rlocked = False, False
+
     def __len__(self):
         return len(self._positions)
 
@@ -569,6 +658,35 @@ class UWSGIStorage(BaseStorage):
         for key, position in self._positions.items():
             yield self.unserialize_key(key), self.read_key_value(position[2])
 
+    def remove_items(self, keys):
+        """Remove keys from sharedarea
+
+        Area is append only, so rest keys are rewritten from the area start
+        and sign is updated to force other processes to reload positions.
+        """
+        with self.lock():
+            self.validate_actuality()
+            removed = set(self.serialize_key(key) for key in keys) & set(self._positions)
+
+            for key in keys:
+                self._keys_cache.pop(key, None)
+
+            if not removed:
+                return 0
+
+            items = [(key, self.read_key_value(positions[2]))
+                     for key, positions in sorted(self._positions.items(), key=lambda x: x[1][0])
+                     if key not in removed]
+
+            self._positions.clear()
+            self.update_area_size(self.HEADER_SIZE)
+
+            for key, value in items:
+                self.append_key(key, value)
+
+            self.update_area_sign()
+            return len(removed)
+
     def inc_items(self, items):
 
         with self.lock():
@@ -603,34 +721,1115 @@ class UWSGIStorage(BaseStorage):
                     logger.error(e, exc_info=True)
                     return 0
 
+    def apply_changes(self, writes, incs, vectors=()):
+        with self.lock():
+            self.write_items(writes)
+            self.inc_items(incs)
+            if vectors:
+                self.inc_vectors(vectors)
+
+    def init_keys(self, keys, vectors=()):
+        """Create missing keys by one lock and one sign update
+
+        Other processes rescan area once instead of once per key.
+
+        :return: number of created keys
+        """
+        keys = list(keys)
+        for key in vectors:
+            keys.extend(expand_vector_key(key))
+
+        created = 0
+        with self.lock():
+            self.validate_actuality()
+            for key in keys:
+                serialized_key = self.serialize_key(key)
+                if serialized_key not in self._positions:
+                    self.append_key(serialized_key)
+                    created += 1
+            if created:
+                self.update_area_sign()
+        return created
+
+
+class UWSGISeqlockStorage(UWSGIStorage):
+    """UWSGI storage with lock-free readers
+
+    Header has sequence counter after area size and sign. Writers make it
+    odd before area changes and even after under write lock. Readers don't
+    take lock: they copy values and retry while counter is odd or changed
+    during copy, so scrapes never block request workers.
+
+    Area layout differs from `UWSGIStorage`, don't share one sharedarea between them.
+    """
+
+    SEQUENCE_POSITION = 16
+    SEQUENCE_SIZE = 4
+    HEADER_SIZE = SEQUENCE_POSITION + SEQUENCE_SIZE
+
+    # Lock-free attempts before reading under read lock
+    READ_RETRIES = 100
+
+    def __init__(self, *args, **kwargs):
+        # Process local index of readers, writers use `_positions`
+        self._read_positions = {}
+        self._read_sign = None
+        self._retries = 0
+        super(UWSGISeqlockStorage, self).__init__(*args, **kwargs)
+
+    def declare_metrics(self):
+        metrics = super(UWSGISeqlockStorage, self).declare_metrics()
+        metrics["read_retries"] = Counter(self.metric_name("read_retries"), "UWSGI lock-free read retries", ("sharedarea", "id") + self._labels)
+        return metrics
+
+    def collect(self):
+        for metric in super(UWSGISeqlockStorage, self).collect():
+            yield metric
+
+        labels = self._labels + (("sharedarea", self._sharedarea_id), ("id", self.get_unique_id()))
+        metric = self._collectors["read_retries"]
+        metric.add_sample(labels, metric.build_sample(labels, ((TYPES.COUNTER, metric.name, "", labels, self._retries), )))
+
+        yield metric
+
+    def read_sequence(self):
+        return struct.unpack(b"I", self.m[self.get_slice(self.SEQUENCE_POSITION, self.SEQUENCE_SIZE)])[0]
+
+    def write_sequence(self, value):
+        self.m[self.get_slice(self.SEQUENCE_POSITION, self.SEQUENCE_SIZE)] = struct.pack(b"I", value % 2 ** 32)
+
+    @contextmanager
+    def lock(self):
+        if not self.wlocked and not self.rlocked:
+            with super(UWSGISeqlockStorage, self).lock():
+                self.write_sequence(self.read_sequence() + 1)
+                try:
+                    yield
+                finally:
+                    self.write_sequence(self.read_sequence() + 1)
+        else:
+            yield
+
+    def read_area(self):
+        """Copy used area bytes with stable sequence
+        """
+        for _ in xrange(self.READ_RETRIES):
+            sequence = self.read_sequence()
+            if sequence % 2:
+                self._retries += 1
+                time.sleep(0)
+                continue
+            data = self.m[self.get_slice(0, self.get_area_size())].tobytes()
+            if self.read_sequence() == sequence:
+                return data
+            self._retries += 1
+
+        with self.rlock():
+            return self.m[self.get_slice(0, self.get_area_size())].tobytes()
+
+    def load_read_positions(self, data):
+        """Build readers index from area copy
+        """
+        self._syncs += 1
+        positions = {}
+        used = struct.unpack_from(b"i", data, self.AREA_SIZE_POSITION)[0]
+        pos = self.AREA_SIZE_POSITION + self.HEADER_SIZE
+        while pos < used:
+            key_size = struct.unpack_from(b"i", data, pos)[0]
+            key_value_position = pos + self.KEY_SIZE_SIZE + key_size
+            positions[data[pos + self.KEY_SIZE_SIZE:key_value_position]] = [
+                pos, pos + self.KEY_SIZE_SIZE, key_value_position, key_value_position + self.KEY_VALUE_SIZE]
+            pos = key_value_position + self.KEY_VALUE_SIZE
+
+        self._read_positions = positions
+        self._read_sign = data[self.get_slice(self.SIGN_POSITION, self.SIGN_SIZE)]
+        if self._instrumentation is not None:
+            self._instrumentation.inc_rescans(self._sharedarea_id)
+        return positions
+
+    def get_read_positions(self, data):
+        if data[self.get_slice(self.SIGN_POSITION, self.SIGN_SIZE)] != self._read_sign:
+            return self.load_read_positions(data)
+        return self._read_positions
+
+    def get_items(self):
+        data = self.read_area()
+        for key, position in self.get_read_positions(data).items():
+            yield self.unserialize_key(key), struct.unpack_from(b"d", data, position[2])[0]
+
+    def get_value(self, key):
+        """Read value without lock, keys that not exists are 0
+        """
+        key = self.serialize_key(key)
+        for _ in xrange(self.READ_RETRIES):
+            sequence = self.read_sequence()
+            if sequence % 2:
+                self._retries += 1
+                time.sleep(0)
+                continue
+
+            if self.get_area_sign() != self._read_sign:
+                positions = self.get_read_positions(self.read_area()).get(key)
+            else:
+                positions = self._read_positions.get(key)
+            value = self.read_key_value(positions[2]) if positions else 0.0
+
+            if self.read_sequence() == sequence:
+                return value
+            self._retries += 1
+
+        return super(UWSGISeqlockStorage, self).get_value(self.unserialize_key(key))
+
+
+class UWSGIDoubleBufferStorage(UWSGIStorage):
+    """UWSGI storage with two value slots and accumulator per key
+
+    Workers increment active slot under sharedarea lock. Scrape takes uwsgi
+    user lock `scrape_lock`, flips active slot index in header under sharedarea
+    lock and drains inactive slot into accumulator without sharedarea lock:
+    after flip nobody increments inactive slot, and inactive slot and accumulator
+    are changed only under scrape lock. So increments wait for scrape only
+    while it flips. Writes, reads and removal of keys take scrape lock too.
+    Value of key is sum of slots and accumulator.
+
+    Run uwsgi with `--locks` option to use `scrape_lock` other than 0.
+    Area layout differs from `UWSGIStorage`, don't share one sharedarea between them.
+    """
+
+    ACTIVE_POSITION = 16
+    ACTIVE_SIZE = 4
+    HEADER_SIZE = ACTIVE_POSITION + ACTIVE_SIZE
+
+    SLOT_SIZE = 8
+    ACCUMULATOR = 2
+    # Two slots and accumulator
+    KEY_VALUE_SIZE = 3 * SLOT_SIZE
+
+    SCRAPE_LOCK_ID = int(os.environ.get("PROMETHEUS_UWSGI_SCRAPE_LOCK", 0))
+
+    def __init__(self, sharedarea_id=UWSGIStorage.SHAREDAREA_ID, scrape_lock=SCRAPE_LOCK_ID, **kwargs):
+        self._scrape_lock_id = scrape_lock
+        self._scrape_locked = False
+        super(UWSGIDoubleBufferStorage, self).__init__(sharedarea_id, **kwargs)
+
+    @contextmanager
+    def scrape_lock(self):
+        """Take uwsgi user lock, that guards inactive slots and accumulators
+        """
+        thread_id = threading.current_thread().ident
+        if self._scrape_locked == thread_id:
+            yield
+            return
+
+        uwsgi.lock(self._scrape_lock_id)
+        self._scrape_locked = thread_id
+        try:
+            yield
+        finally:
+            self._scrape_locked = False
+            uwsgi.unlock(self._scrape_lock_id)
+
+    def after_fork_in_child(self):
+        super(UWSGIDoubleBufferStorage, self).after_fork_in_child()
+        self._scrape_locked = False
+
+    def init_memory(self, validation=True):
+        with self.lock():
+            if self.get_area_size() == 0:
+                self.m[self.get_slice(self.ACTIVE_POSITION, self.ACTIVE_SIZE)] = struct.pack(b"i", 0)
+            super(UWSGIDoubleBufferStorage, self).init_memory(validation)
+
+    def get_active_index(self):
+        return struct.unpack(b"i", self.m[self.get_slice(self.ACTIVE_POSITION, self.ACTIVE_SIZE)])[0]
+
+    def flip(self):
+        """Switch active slot
+
+        :return: index of inactive slot to drain
+        """
+        inactive = self.get_active_index()
+        self.m[self.get_slice(self.ACTIVE_POSITION, self.ACTIVE_SIZE)] = struct.pack(b"i", 1 - inactive)
+        return inactive
+
+    def get_binary_string(self, key, value):
+        item_template = "=i{0}sddd".format(len(key)).encode()
+
+        return struct.pack(item_template, len(key), key, 0.0, 0.0, value)
+
+    def read_slot(self, position, index):
+        return struct.unpack(b"d", self.m[self.get_slice(position + index * self.SLOT_SIZE, self.SLOT_SIZE)])[0]
+
+    def write_slot(self, position, index, value):
+        self.m[self.get_slice(position + index * self.SLOT_SIZE, self.SLOT_SIZE)] = struct.pack(b"d", value)
+
+    def read_slots(self, position):
+        return list(struct.unpack(b"ddd", self.m[self.get_slice(position, self.KEY_VALUE_SIZE)]))
+
+    def write_slots(self, position, slots):
+        self.m[self.get_slice(position, self.KEY_VALUE_SIZE)] = struct.pack(b"ddd", *slots)
+
+    def read_key_value(self, position):
+        """Read key value as sum of slots and accumulator
+        """
+        return sum(self.read_slots(position))
+
+    def write_key_value(self, position, value):
+        """Reset slots and write value to accumulator
+        """
+        self.write_slots(position, (0.0, 0.0, value))
+        return value
+
+    def inc_slot(self, positions, value):
+        """Increase active slot, only it is written by increments
+        """
+        active = self.get_active_index()
+        self.write_slot(positions[2], active, self.read_slot(positions[2], active) + value)
+        return self.read_key_value(positions[2])
+
+    def inc_value(self, key, value):
+        """Increase key value in active slot
+
+        :param key: key string
+        :param value: key value
+        """
+        with self.lock():
+            try:
+                self.validate_actuality()
+                positions, created = self.get_key_position(self.serialize_key(key), value)
+                if created:
+                    return value
+                return self.inc_slot(positions, value)
+            except Exception as e:
+                logger.error(e, exc_info=True)
+                return 0
+
+    def inc_items(self, items):
+
+        with self.lock():
+            self.validate_actuality()
+
+            for key, value in items:
+                try:
+                    positions, created = self.get_key_position(self.serialize_key(key), value)
+                    if not created:
+                        self.inc_slot(positions, value)
+                except Exception as e:
+                    logger.error(e, exc_info=True)
+                    return 0
+
+    def write_value(self, key, value):
+        with self.scrape_lock():
+            return super(UWSGIDoubleBufferStorage, self).write_value(key, value)
+
+    def write_items(self, items):
+        with self.scrape_lock():
+            return super(UWSGIDoubleBufferStorage, self).write_items(items)
+
+    def get_value(self, key):
+        with self.scrape_lock():
+            return super(UWSGIDoubleBufferStorage, self).get_value(key)
+
+    def apply_changes(self, writes, incs, vectors=()):
+        if not writes:
+            return super(UWSGIDoubleBufferStorage, self).apply_changes(writes, incs, vectors)
+        # Scrape lock is taken before sharedarea lock everywhere
+        with self.scrape_lock():
+            return super(UWSGIDoubleBufferStorage, self).apply_changes(writes, incs, vectors)
+
+    def remove_items(self, keys):
+        with self.scrape_lock():
+            return super(UWSGIDoubleBufferStorage, self).remove_items(keys)
+
+    def drain(self, positions, inactive):
+        """Move inactive slot values into accumulators
+
+        Called under scrape lock only.
+
+        :param positions: list of (serialized key, value position)
+        :return: list of (serialized key, accumulator value)
+        """
+        items = []
+        for key, position in positions:
+            accumulator = self.read_slot(position, self.ACCUMULATOR) + self.read_slot(position, inactive)
+            self.write_slot(position, self.ACCUMULATOR, accumulator)
+            self.write_slot(position, inactive, 0.0)
+            items.append((key, accumulator))
+        return items
+
+    def get_items(self):
+        with self.scrape_lock():
+            with self.lock():
+                self.validate_actuality()
+                inactive = self.flip()
+                # Keys are append only, positions stay valid until removal under scrape lock
+                positions = [(key, x[2]) for key, x in self._positions.items()]
+
+            items = self.drain(positions, inactive)
+
+        for key, value in items:
+            yield self.unserialize_key(key), value
+
+
+class UWSGIVectorStorage(UWSGIStorage):
+    """UWSGI storage that keeps composite values in one slot
+
+    Sum, count and buckets of histogram series or sum and count of summary
+    series are doubles of one area entry behind composite key, see
+    `pyprometheus.storage.expand_vector_key`. Observation makes one key lookup
+    and one write of the slot, histogram with 15 buckets takes one key
+    instead of 17. Entry is::
+
+        4 bytes int key size
+        4 bytes int number of doubles
+        n bytes marshaled key
+        8 bytes float for every double
+
+    Area layout differs from `UWSGIStorage`, don't share one sharedarea between them.
+    """
+
+    KEY_SLOTS_SIZE = 4
+
+    def __init__(self, *args, **kwargs):
+        # Serialized composite key -> positions of entry
+        self._vectors = {}
+        # Serialized composite key -> expanded series keys
+        self._vector_series = {}
+        # Serialized series key -> positions of its double and serialized composite key
+        self._slots = {}
+        self._vector_structs = {}
+        super(UWSGIVectorStorage, self).__init__(*args, **kwargs)
+
+    def get_vector_struct(self, size):
+        try:
+            return self._vector_structs[size]
+        except KeyError:
+            self._vector_structs[size] = value = struct.Struct("={0}d".format(size).encode())
+            return value
+
+    def get_key_size(self, key):
+        return super(UWSGIVectorStorage, self).get_key_size(key) + self.KEY_SLOTS_SIZE
+
+    def get_binary_string(self, key, value):
+        return self.get_entry_string(key, [value])
+
+    def get_entry_string(self, key, values):
+        item_template = "=ii{0}s{1}d".format(len(key), len(values)).encode()
+
+        return struct.pack(item_template, len(key), len(values), key, *values)
+
+    def append_key(self, key, init_value=0.0):
+        return self.append_entry(key, [init_value])
+
+    def append_entry(self, key, values, series_keys=None):
+        """Write key with values to the end of area without sign update
+
+        :param key: serialized key string
+        :param values: list of initial doubles
+        :param series_keys: expanded series keys of composite key
+        """
+        value = self.get_entry_string(key, values)
+
+        position = self._used + self.AREA_SIZE_POSITION
+
+        self.m[self.get_slice(position, len(value))] = value
+
+        self.update_area_size(self._used + len(value))
+        positions = [position, position + self.KEY_SIZE_SIZE + self.KEY_SLOTS_SIZE,
+                     self._used - self.KEY_VALUE_SIZE * len(values), self._used]
+        self.index_entry(key, positions, series_keys)
+        return positions
+
+    def index_entry(self, key, positions, series_keys=None):
+        if positions[3] - positions[2] == self.KEY_VALUE_SIZE:
+            self._positions[key] = positions
+            return
+
+        self._vectors[key] = positions
+        self._vector_series[key] = series_keys = series_keys or expand_vector_key(self.unserialize_key(key))
+        for i, series_key in enumerate(series_keys):
+            value_position = positions[2] + i * self.KEY_VALUE_SIZE
+            self._slots[self.serialize_key(series_key)] = [positions[0], positions[1], value_position,
+                                                           value_position + self.KEY_VALUE_SIZE, key]
+
+    def read_item(self, position):
+        """Read key info from given position
+
+        :return: key size, (key, first double), positions
+        """
+        key_size = self.read_key_size(position)
+        slots = self.read_key_size(position + self.KEY_SIZE_SIZE)
+
+        key_string_position = position + self.KEY_SIZE_SIZE + self.KEY_SLOTS_SIZE
+
+        key = self.read_key_string(key_string_position, key_size)
+
+        key_value_position = key_string_position + key_size
+
+        key_value = self.read_key_value(key_value_position)
+        return (key_size,
+                (key, key_value),
+                (key_string_position - self.KEY_SIZE_SIZE - self.KEY_SLOTS_SIZE, key_string_position,
+                 key_value_position, key_value_position + self.KEY_VALUE_SIZE * slots))
+
+    def load_exists_positions(self):
+        """Load all keys and composite keys from memory
+        """
+        self._syncs += 1
+        self._used = self.get_area_size()
+        self._sign = self.get_area_sign()
+        self._vectors.clear()
+        self._vector_series.clear()
+        self._slots.clear()
+
+        for _, (key, _), positions in self.read_memory():
+            self.index_entry(key, list(positions))
+
+    def get_key_position(self, key, init_value=0.0):
+        try:
+            return self._positions[key], False
+        except KeyError:
+            pass
+
+        try:
+            return self._slots[key], False
+        except KeyError:
+            return (self.init_key(key, init_value=init_value), True)
+
+    def get_value(self, key):
+        """Read value from shared memory
+
+        Missing key is not created, so series of not observed composite
+        value don't take separate keys.
+        """
+        with self.lock():
+            try:
+                self.validate_actuality()
+                serialized_key = self.serialize_key(key)
+                positions = self._positions.get(serialized_key) or self._slots.get(serialized_key)
+                if positions is None:
+                    return 0.0
+                return self.read_key_value(positions[2])
+            except Exception as e:
+                logger.error(e, exc_info=True)
+                return 0
+
+    def read_vector(self, positions):
+        vector_struct = self.get_vector_struct((positions[3] - positions[2]) // self.KEY_VALUE_SIZE)
+        return vector_struct, vector_struct.unpack(self.m[self.get_slice(positions[2], vector_struct.size)])
+
+    def inc_vector(self, key, values, series_keys=None):
+        """Increment all doubles of composite key by one lookup
+
+        :param key: composite key
+        :param values: increments in order of expanded series keys
+        :param series_keys: expanded series keys kept by value
+        """
+        with self.lock():
+            try:
+                self.validate_actuality()
+                serialized_key = self.serialize_key(key)
+                positions = self._vectors.get(serialized_key)
+
+                if positions is None:
+                    series_keys = series_keys or expand_vector_key(key)
+                    if self.serialize_key(series_keys[0]) in self._positions:
+                        # Series were created as separate keys
+                        return self.inc_items(zip(series_keys, values))
+
+                    self.append_entry(serialized_key, [float(x) for x in values], series_keys)
+                    self.update_area_sign()
+                    return
+
+                vector_struct, current = self.read_vector(positions)
+                self.m[self.get_slice(positions[2], vector_struct.size)] = vector_struct.pack(
+                    *[x + y for x, y in zip(current, values)])
+            except Exception as e:
+                logger.error(e, exc_info=True)
+
+    def inc_vectors(self, items):
+        with self.lock():
+            for key, values, series_keys in items:
+                self.inc_vector(key, values, series_keys)
+
+    def init_keys(self, keys, vectors=()):
+        """Create missing keys and composite keys entries by one sign update
+
+        :return: number of created entries
+        """
+        created = 0
+        with self.lock():
+            self.validate_actuality()
+            for key in keys:
+                serialized_key = self.serialize_key(key)
+                if serialized_key not in self._positions and serialized_key not in self._slots:
+                    self.append_entry(serialized_key, [0.0])
+                    created += 1
+
+            for key in vectors:
+                serialized_key = self.serialize_key(key)
+                series_keys = expand_vector_key(key)
+                if serialized_key in self._vectors or self.serialize_key(series_keys[0]) in self._positions:
+                    continue
+                self.append_entry(serialized_key, [0.0] * len(series_keys), series_keys)
+                created += 1
+
+            if created:
+                self.update_area_sign()
+        return created
+
+    def get_items(self):
+        with self.rlock():
+            self.validate_actuality()
+
+        for key, position in self._positions.items():
+            yield self.unserialize_key(key), self.read_key_value(position[2])
+
+        for key, positions in self._vectors.items():
+            for series_key, value in zip(self._vector_series[key], self.read_vector(positions)[1]):
+                yield series_key, value
+
+    def remove_items(self, keys):
+        """Remove keys from sharedarea
+
+        Removing any series of composite key removes all its series.
+        """
+        with self.lock():
+            self.validate_actuality()
+            serialized_keys = set(self.serialize_key(key) for key in keys)
+            removed = serialized_keys & set(self._positions)
+            removed_series = [key for key in serialized_keys if key in self._slots]
+            removed_vectors = set(self._slots[key][4] for key in removed_series)
+
+            for key in keys:
+                self._keys_cache.pop(key, None)
+
+            if not removed and not removed_vectors:
+                return 0
+
+            entries = [(key, [self.read_key_value(positions[2])], positions[0], None)
+                       for key, positions in self._positions.items() if key not in removed]
+            entries.extend((key, list(self.read_vector(positions)[1]), positions[0], self._vector_series[key])
+                           for key, positions in self._vectors.items() if key not in removed_vectors)
+
+            self._positions.clear()
+            self._vectors.clear()
+            self._vector_series.clear()
+            self._slots.clear()
+            self.update_area_size(self.HEADER_SIZE)
+
+            for key, values, _, series_keys in sorted(entries, key=lambda x: x[2]):
+                self.append_entry(key, values, series_keys)
+
+            self.update_area_sign()
+            return len(removed) + len(removed_series)
+
+    def get_serialized_keys(self):
+        return chain(self._positions, self._vectors, self._slots)
+
+    def __len__(self):
+        return len(self._positions) + len(self._slots)
+
+    def clear(self):
+        super(UWSGIVectorStorage, self).clear()
+        self._vectors.clear()
+        self._vector_series.clear()
+        self._slots.clear()
+
+
+class UWSGIShardedStorage(BaseStorage):
+    """Spread keys across multiple uwsgi sharedareas
+
+    Experimental: contention reduction is not measured on multi-core hosts yet.
+
+    Every sharedarea has own lock and sign, so busy metrics don't block
+    unrelated ones. Keys are sharded by crc32 of metric name or of whole key.
+    Scrape reads shards in parallel threads and merges items::
+
+        # uwsgi --sharedarea=100 --sharedarea=100 --sharedarea=100 --sharedarea=100
+        storage = UWSGIShardedStorage([0, 1, 2, 3])
+    """
+
+    shared = True
+
+    NAME = "name"
+    KEY = "key"
+
+    def __init__(self, sharedarea_ids, namespace="", stats=False, labels={},
+                 storage_class=UWSGIStorage, shard_by=NAME):
+        self._shards = [storage_class(sharedarea_id, namespace=namespace, stats=stats, labels=labels)
+                        for sharedarea_id in sharedarea_ids]
+        self._shard_by = shard_by
+        # Metric name -> shard index, bounded by number of metrics
+        self._name_shards = {}
+        self._pool = None
+        self._pool_pid = None
+
+    @property
+    def shards(self):
+        return self._shards
+
+    def get_shard_index(self, value):
+        if not isinstance(value, bytes):
+            value = value.encode("utf-8")
+        return (zlib.crc32(value) & 0xffffffff) % len(self._shards)
+
+    def get_shard(self, key):
+        if self._shard_by != self.NAME:
+            return self._shards[self.get_shard_index(marshal.dumps(key))]
+        try:
+            return self._shards[self._name_shards[key[1]]]
+        except KeyError:
+            self._name_shards[key[1]] = index = self.get_shard_index(key[1])
+            return self._shards[index]
+
+    def group_by_shard(self, items):
+        groups = {}
+        for item in items:
+            groups.setdefault(self.get_shard(item[0]), []).append(item)
+        return groups.items()
+
+    def inc_value(self, key, value):
+        return self.get_shard(key).inc_value(key, value)
+
+    def write_value(self, key, value):
+        return self.get_shard(key).write_value(key, value)
+
+    def get_value(self, key):
+        return self.get_shard(key).get_value(key)
+
+    def inc_items(self, items):
+        for shard, shard_items in self.group_by_shard(items):
+            shard.inc_items(shard_items)
+
+    def write_items(self, items):
+        for shard, shard_items in self.group_by_shard(items):
+            shard.write_items(shard_items)
+
+    def inc_vector(self, key, values, series_keys=None):
+        # Series of composite key are in one shard only if sharded by name
+        if self._shard_by == self.NAME:
+            return self.get_shard(key).inc_vector(key, values, series_keys)
+        return super(UWSGIShardedStorage, self).inc_vector(key, values, series_keys)
+
+    def apply_changes(self, writes, incs, vectors=()):
+        if vectors and self._shard_by != self.NAME:
+            # Series of composite keys are spread by their own keys
+            incs, vectors = list(incs) + expand_vectors(vectors), ()
+
+        changes = {}
+        for shard, shard_writes in self.group_by_shard(writes):
+            changes[shard] = (shard_writes, [], [])
+        for shard, shard_incs in self.group_by_shard(incs):
+            changes.setdefault(shard, ([], [], []))[1].extend(shard_incs)
+        for shard, shard_vectors in self.group_by_shard(vectors):
+            changes.setdefault(shard, ([], [], []))[2].extend(shard_vectors)
+        for shard, (shard_writes, shard_incs, shard_vectors) in changes.items():
+            shard.apply_changes(shard_writes, shard_incs, shard_vectors)
+
+    def init_keys(self, keys, vectors=()):
+        if vectors and self._shard_by != self.NAME:
+            keys, vectors = list(keys) + [key for x in vectors for key in expand_vector_key(x)], ()
+
+        changes = {}
+        for shard, shard_keys in self.group_by_shard([(key, ) for key in keys]):
+            changes[shard] = ([x[0] for x in shard_keys], [])
+        for shard, shard_vectors in self.group_by_shard([(key, ) for key in vectors]):
+            changes.setdefault(shard, ([], []))[1].extend(x[0] for x in shard_vectors)
+        for shard, (shard_keys, shard_vectors) in changes.items():
+            shard.init_keys(shard_keys, shard_vectors)
+
+    def remove_items(self, keys):
+        for shard, shard_keys in self.group_by_shard([(key, ) for key in keys]):
+            shard.remove_items([x[0] for x in shard_keys])
+
+    def get_items(self):
+        if len(self._shards) == 1:
+            return self._shards[0].get_items()
+
+        # Pool threads don't survive fork
+        if self._pool is None or self._pool_pid != os.getpid():
+            self._pool, self._pool_pid = ThreadPool(len(self._shards)), os.getpid()
+
+        return chain.from_iterable(self._pool.map(lambda shard: list(shard.get_items()), self._shards))
+
+    def __len__(self):
+        return sum(len(shard) for shard in self._shards)
+
+    def clear(self):
+        for shard in self._shards:
+            shard.clear()
+
 
 class UWSGIFlushStorage(LocalMemoryStorage):
     """Storage wrapper for UWSGI storage that update couters inmemory and flush into uwsgi sharedarea
+
+    Composite values increments are buffered by composite keys and flushed
+    with `inc_vector`, so `UWSGIVectorStorage` keeps them in one slot.
     """
+
+    shared = True
+
     SHAREDAREA_ID = int(os.environ.get("PROMETHEUS_UWSGI_SHAREDAREA", 0))
 
-    def __init__(self, sharedarea_id=UWSGIStorage.SHAREDAREA_ID, namespace="", stats=False, labels={}):
-        self._uwsgi_storage = UWSGIStorage(sharedarea_id, namespace=namespace, stats=stats, labels=labels)
+    def __init__(self, sharedarea_id=UWSGIStorage.SHAREDAREA_ID, namespace="", stats=False, labels={},
+                 storage_class=UWSGIStorage):
+        self._uwsgi_storage = storage_class(sharedarea_id, namespace=namespace, stats=stats, labels=labels)
         self._flush = 0
         self._get_items = 0
         self._clear = 0
+        # Composite key -> (increments, series keys)
+        self._vectors = {}
+        # Series key -> (composite key, index of increment)
+        self._vector_slots = {}
         super(UWSGIFlushStorage, self).__init__()
 
     @property
     def persistent_storage(self):
         return self._uwsgi_storage
 
+    def init_keys(self, keys, vectors=()):
+        return self._uwsgi_storage.init_keys(keys, vectors)
+
+    def prepare_fork(self):
+        self.flush()
+
+    def after_fork_in_child(self):
+        super(UWSGIFlushStorage, self).after_fork_in_child()
+        # Changes made before fork are flushed by parent
+        self.clear_pending()
+
+    def inc_vector(self, key, values, series_keys=None):
+        with self._lock:
+            try:
+                pending = self._vectors[key][0]
+            except KeyError:
+                series_keys = series_keys or expand_vector_key(key)
+                self._vectors[key] = (list(values), series_keys)
+                for index, series_key in enumerate(series_keys):
+                    self._vector_slots[series_key] = (key, index)
+                return
+            for index, value in enumerate(values):
+                pending[index] += value
+
+    def apply_changes(self, writes, incs, vectors=()):
+        super(UWSGIFlushStorage, self).apply_changes(writes, incs)
+        for key, values, series_keys in vectors:
+            self.inc_vector(key, values, series_keys)
+
+    def get_value(self, key):
+        with self._lock:
+            # Reading don't add keys, they would be flushed apart from composite keys
+            value = self._storage.get(key, 0.0)
+            if key in self._vector_slots:
+                vector_key, index = self._vector_slots[key]
+                value += self._vectors[vector_key][0][index]
+            return value
+
+    def clear_pending(self):
+        self._storage.clear()
+        self._vectors.clear()
+        self._vector_slots.clear()
+
     def flush(self):
-        items = list(super(UWSGIFlushStorage, self).get_items())
-        self._uwsgi_storage.inc_items(items)
-        super(UWSGIFlushStorage, self).clear()
+        with self._lock:
+            incs = list(self._storage.items())
+            vectors = [(key, values, series_keys) for key, (values, series_keys) in self._vectors.items()]
+            self.clear_pending()
+        self._uwsgi_storage.apply_changes((), incs, vectors)
 
     def get_items(self):
         return self._uwsgi_storage.get_items()
 
+    def get_changed_items(self, since=None):
+        return self._uwsgi_storage.get_changed_items(since)
+
+    def remove_items(self, keys):
+        super(UWSGIFlushStorage, self).remove_items(keys)
+        with self._lock:
+            for key in keys:
+                vector_key = self._vector_slots.get(key, (None, ))[0]
+                if vector_key in self._vectors:
+                    for series_key in self._vectors.pop(vector_key)[1]:
+                        self._vector_slots.pop(series_key, None)
+        self._uwsgi_storage.remove_items(keys)
+
     def __len__(self):
-        return super(UWSGIFlushStorage, self).__len__()
+        return super(UWSGIFlushStorage, self).__len__() + len(self._vector_slots)
 
     def clear(self):
         self._uwsgi_storage.clear()
-        super(UWSGIFlushStorage, self).clear()
+        with self._lock:
+            self.clear_pending()
+
+
+class UWSGIMuleStorage(BufferedStorage):
+    """Storage that sends workers deltas to uwsgi mule
+
+    Request workers never lock sharedarea, changes are sent to mule `mule_id`
+    by `uwsgi.mule_msg` as marshaled batches. Mule is the single owner
+    of values, it applies batches with `UWSGIMuleAggregator`.
+
+    In workers `get_value` and `get_items` return not flushed changes only.
+    """
+
+    MULE_ID = int(os.environ.get("PROMETHEUS_UWSGI_MULE", 1))
+
+    MESSAGE_PREFIX = b"pyprometheus:"
+
+    # Less than uwsgi mule message buffer
+    MAX_MESSAGE_SIZE = 64000
+
+    def __init__(self, mule_id=MULE_ID, flush_interval=1.0, max_pending=10000, max_message_size=MAX_MESSAGE_SIZE,
+                 autoflush=True):
+        self._mule_id = mule_id
+        self._max_message_size = max_message_size
+        # Values applied in mule
+        self._values = LocalMemoryStorage()
+        self._sent = 0
+        self._failed = 0
+        self._dropped = 0
+        self.detect_mule()
+        super(UWSGIMuleStorage, self).__init__(max_pending, flush_interval, autoflush)
+
+    @property
+    def is_mule(self):
+        """Current process is the values owner mule
+        """
+        return self._is_mule
+
+    def detect_mule(self):
+        """Check once per process that it is the values owner mule
+
+        Called on init, after fork and by `UWSGIMuleAggregator`.
+        """
+        self._is_mule = uwsgi.mule_id() == self._mule_id
+        return self._is_mule
+
+    def inc_value(self, key, value):
+        if self._is_mule:
+            return self._values.inc_value(key, value)
+        return super(UWSGIMuleStorage, self).inc_value(key, value)
+
+    def write_value(self, key, value):
+        if self._is_mule:
+            return self._values.write_value(key, value)
+        return super(UWSGIMuleStorage, self).write_value(key, value)
+
+    def apply_changes(self, writes, incs, vectors=()):
+        if self._is_mule:
+            return self._values.apply_changes(writes, incs, vectors)
+        return super(UWSGIMuleStorage, self).apply_changes(writes, incs, vectors)
+
+    def get_value(self, key):
+        if self._is_mule:
+            return self._values.get_value(key)
+        return super(UWSGIMuleStorage, self).get_value(key)
+
+    def get_items(self):
+        if self._is_mule:
+            return self._values.get_items()
+        with self._lock:
+            return list(self._writes.items()) + list(self._incs.items())
+
+    def get_changed_items(self, since=None):
+        if self._is_mule:
+            return self._values.get_changed_items(since)
+        return super(UWSGIMuleStorage, self).get_changed_items(since)
+
+    def remove_items(self, keys):
+        super(UWSGIMuleStorage, self).remove_items(keys)
+        self._values.remove_items(keys)
+
+    def __len__(self):
+        if self._is_mule:
+            return len(self._values)
+        return super(UWSGIMuleStorage, self).__len__()
+
+    def clear(self):
+        super(UWSGIMuleStorage, self).clear()
+        self._values.clear()
+
+    def after_fork_in_child(self):
+        super(UWSGIMuleStorage, self).after_fork_in_child()
+        self._values.clear()
+        self.detect_mule()
+
+    def encode(self, writes, incs):
+        """Encode changes into messages not bigger than max message size
+
+        Writes and increments are split as one list of records,
+        record bigger than max message size is dropped.
+        """
+        message = self.MESSAGE_PREFIX + marshal.dumps((writes, incs), 2)
+        if len(message) <= self._max_message_size:
+            return [message]
+
+        size = len(writes) + len(incs)
+        if size <= 1:
+            self._dropped += size
+            logger.error("Dropped metrics change bigger than {0} bytes: {1!r}".format(
+                self._max_message_size, (writes or incs)[0][0] if size else None))
+            return []
+
+        half = size // 2
+        if half <= len(writes):
+            return self.encode(writes[:half], []) + self.encode(writes[half:], incs)
+        half -= len(writes)
+        return self.encode(writes, incs[:half]) + self.encode([], incs[half:])
+
+    def decode(self, message):
+        """Decode message to (writes, incs) or None if message is not a batch
+        """
+        if not message or not message.startswith(self.MESSAGE_PREFIX):
+            return None
+        return marshal.loads(message[len(self.MESSAGE_PREFIX):])
+
+    def flush(self):
+        if not self._is_mule:
+            super(UWSGIMuleStorage, self).flush()
+
+    def send(self, writes, incs):
+        """Send changes to mule
+
+        Changes are kept to next flush if mule queue rejects them.
+        """
+        for message in self.encode(list(writes.items()), list(incs.items())):
+            try:
+                sent = uwsgi.mule_msg(message, self._mule_id)
+            except Exception as e:
+                logger.warning("Failed to send metrics to mule {0}: {1}".format(self._mule_id, e))
+                sent = False
+            # uwsgi returns None if message was not queued
+            if not sent:
+                self._failed += 1
+                self.restore(*self.decode(message))
+            else:
+                self._sent += 1
+
+    def apply(self, message):
+        """Apply batch in mule
+
+        :return: True if message is metrics batch
+        """
+        batch = self.decode(message)
+        if batch is None:
+            return False
+
+        writes, incs = batch
+        self._values.apply_changes(writes, incs)
+        return True
+
+
+class ThreadingWSGIServer(ThreadingMixIn, WSGIServer):
+    daemon_threads = True
+
+
+class QuietWSGIRequestHandler(WSGIRequestHandler):
+
+    def log_message(self, format, *args):
+        logger.debug(format, *args)
+
+
+class UWSGIMuleExposition(object):
+    """Serve metrics from uwsgi mule instead of request workers
+
+    Mule reads sharedarea through registry storage and owns its own
+    HTTP listener, so scrapes never occupy request workers.
+    Mule script example::
+
+        # uwsgi --mule=metrics_mule.py
+        from myapp.metrics import registry
+        from pyprometheus.contrib.uwsgi_features import UWSGIMuleExposition
+
+        UWSGIMuleExposition(registry, ("0.0.0.0", 9100)).serve_forever()
+    """
+
+    def __init__(self, registry, address=("0.0.0.0", 9100), min_interval=0):
+        self._registry = registry
+        self._address = address
+        self._app = MetricsWSGIApp(registry, min_interval=min_interval)
+        self._server = None
+
+    @property
+    def server(self):
+        return self._server
+
+    def make_server(self):
+        self._server = make_server(self._address[0], self._address[1], self._app,
+                                   server_class=ThreadingWSGIServer,
+                                   handler_class=QuietWSGIRequestHandler)
+        return self._server
+
+    def serve_forever(self):
+        if self._server is None:
+            self.make_server()
+        logger.info("Serve metrics from {0} on {1}:{2}".format(
+            UWSGIStorage.get_unique_id(), *self._server.server_address))
+        self._server.serve_forever()
+
+    def shutdown(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+
+class UWSGIMuleAggregator(object):
+    """Mule loop that applies workers batches of `UWSGIMuleStorage`
+
+    and serves exposition from the same mule. Mule script example::
+
+        # uwsgi --mule=metrics_mule.py
+        from myapp.metrics import registry
+        from pyprometheus.contrib.uwsgi_features import UWSGIMuleAggregator
+
+        UWSGIMuleAggregator(registry, ("0.0.0.0", 9100)).serve_forever()
+
+    Exposition runs in thread, so mule requires `--enable-threads`.
+    Messages that are not metrics batches are passed to `on_message`.
+    """
+
+    def __init__(self, registry, address=("0.0.0.0", 9100), min_interval=0, on_message=None, timeout=1):
+        self._storage = registry.storage
+        self._storage.detect_mule()
+        self._exposition = UWSGIMuleExposition(registry, address, min_interval) if address else None
+        self._on_message = on_message
+        self._timeout = timeout
+        self._running = False
+        self._applied = 0
+
+    @property
+    def exposition(self):
+        return self._exposition
+
+    def receive(self, timeout=-1):
+        """Receive and apply one message
+
+        :return: False if no message received before timeout
+        """
+        message = uwsgi.mule_get_msg(timeout=timeout)
+        if message is None:
+            return False
+
+        if self._storage.apply(message):
+            self._applied += 1
+        elif self._on_message is not None:
+            self._on_message(message)
+        return True
+
+    def serve_forever(self):
+        self._storage.detect_mule()
+        if self._exposition is not None:
+            self._exposition.make_server()
+            thread = threading.Thread(target=self._exposition.serve_forever)
+            thread.daemon = True
+            thread.start()
+
+        self._running = True
+        while self._running:
+            self.receive(self._timeout)
+
+    def shutdown(self):
+        self._running = False
+        if self._exposition is not None:
+            self._exposition.shutdown()
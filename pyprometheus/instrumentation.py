@@ -0,0 +1,230 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+pyprometheus.instrumentation
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+Opt-in collector of the library own costs
+
+:copyright: (c) 2017 by Alexandr Lispython.
+:license: , see LICENSE for more details.
+:github: http://github.com/Lispython/pyprometheus
+"""
+from bisect import bisect_left
+from functools import wraps
+from threading import Lock
+from timeit import default_timer
+
+from pyprometheus.const import TYPES
+from pyprometheus.metrics import Counter, Gauge, Histogram
+
+
+DURATION_BUCKETS = (0.000001, 0.000005, 0.00001, 0.00005, 0.0001, 0.0005,
+                    0.001, 0.005, 0.01, 0.05, 0.1, float("inf"))
+
+
+class HistogramData(object):
+    """Lightweight histogram accumulator
+
+    Keeps not cumulative bucket counts, cumulated on collect.
+    `+Inf` bucket is added if buckets have no one.
+    """
+
+    def __init__(self, buckets):
+        buckets = tuple(buckets)
+        if not buckets or buckets[-1] != float("inf"):
+            buckets += (float("inf"), )
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[min(bisect_left(self.buckets, value), len(self.counts) - 1)] += 1
+        self.sum += value
+        self.count += 1
+
+    def get_cumulative_counts(self):
+        total = 0
+        for bucket, count in zip(self.buckets, self.counts):
+            total += count
+            yield bucket, total
+
+
+class Instrumentation(object):
+    """Collector of scrape, storage operations and sharedarea lock stats
+
+    Register it to measure registry and its storage::
+
+        instrumentation = Instrumentation(registry)
+
+    Registry renders report scrape duration, series and bytes.
+    Storage operations are wrapped to count them and their latency by op type.
+    `UWSGIStorage` reports lock wait and hold time and rescans.
+    """
+
+    STORAGE_OPS = ("inc_value", "write_value", "get_value", "inc_items",
+                   "inc_vector", "write_items", "apply_changes", "init_keys",
+                   "get_items", "remove_items")
+
+    def __init__(self, registry, namespace="pyprometheus", labels={}, storage=True, buckets=DURATION_BUCKETS):
+        self._namespace = namespace
+        self._labels = tuple(sorted(labels.items(), key=lambda x: x[0]))
+        self._buckets = tuple(sorted(buckets))
+        self._lock = Lock()
+
+        self._scrapes = HistogramData(Histogram.DEFAULT_BUCKETS)
+        self._last_scrape = {"series": 0, "bytes": 0}
+        self._ops = {}
+        self._locks = {}
+        self._rescans = {}
+
+        self._collectors = self.declare_metrics()
+
+        registry.register(self)
+        registry.instrumentation = self
+
+        if storage:
+            self.instrument_storage(registry.storage)
+
+    @property
+    def uid(self):
+        return "instrumentation:{0}".format(self._namespace)
+
+    @property
+    def text_export_header(self):
+        return "# {0} stats metrics".format(self.__class__.__name__)
+
+    def metric_name(self, name):
+        """Make metric name with namespace
+
+        :param name:
+        """
+        return ":".join([self._namespace, name])
+
+    def declare_metrics(self):
+        return {
+            "scrape_duration": Histogram(self.metric_name("scrape_duration_seconds"), "Registry render duration", self._labels),
+            "scrape_series": Gauge(self.metric_name("scrape_series"), "Series rendered by last scrape", self._labels),
+            "scrape_bytes": Gauge(self.metric_name("scrape_bytes"), "Bytes rendered by last scrape", self._labels),
+            "storage_op_duration": Histogram(self.metric_name("storage_operation_duration_seconds"), "Storage operations duration", ("storage", "op") + self._labels),
+            "lock_wait": Histogram(self.metric_name("sharedarea_lock_wait_seconds"), "Sharedarea lock wait time", ("sharedarea", "lock") + self._labels),
+            "lock_hold": Histogram(self.metric_name("sharedarea_lock_hold_seconds"), "Sharedarea lock hold time", ("sharedarea", "lock") + self._labels),
+            "rescans": Counter(self.metric_name("sharedarea_rescans_total"), "Sharedarea keys rescans", ("sharedarea", ) + self._labels)
+        }
+
+    def observe(self, data, key, value):
+        with self._lock:
+            try:
+                histogram = data[key]
+            except KeyError:
+                histogram = data[key] = HistogramData(self._buckets)
+            histogram.observe(value)
+
+    def observe_scrape(self, duration, series, size):
+        """Record registry render
+
+        :param duration: render seconds
+        :param series: number of rendered series
+        :param size: rendered bytes
+        """
+        with self._lock:
+            self._scrapes.observe(duration)
+            self._last_scrape = {"series": series, "bytes": size}
+
+    def observe_op(self, storage, op, duration):
+        self.observe(self._ops, (storage.__class__.__name__, op), duration)
+
+    def observe_lock(self, sharedarea_id, lock, wait, hold):
+        """Record sharedarea lock
+
+        :param lock: `write` or `read`
+        :param wait: seconds waited for lock
+        :param hold: seconds lock was held
+        """
+        self.observe(self._locks, (sharedarea_id, lock, "wait"), wait)
+        self.observe(self._locks, (sharedarea_id, lock, "hold"), hold)
+
+    def inc_rescans(self, sharedarea_id):
+        with self._lock:
+            self._rescans[sharedarea_id] = self._rescans.get(sharedarea_id, 0) + 1
+
+    def instrument_storage(self, storage):
+        """Wrap storage operations to measure them
+
+        Wrappers are set on storage instance, not instrumented storages
+        have no overhead.
+        """
+        for op in self.STORAGE_OPS:
+            method = getattr(storage, op, None)
+            if method is not None:
+                setattr(storage, op, self.wrap_op(storage, op, method))
+
+        for area_storage in [storage, getattr(storage, "persistent_storage", None)] + list(getattr(storage, "shards", [])):
+            if hasattr(area_storage, "_instrumentation"):
+                area_storage._instrumentation = self
+        return storage
+
+    def wrap_op(self, storage, op, method):
+        observe_op = self.observe_op
+
+        if op == "get_items":
+            @wraps(method)
+            def wrapper(*args, **kwargs):
+                start = default_timer()
+                try:
+                    return list(method(*args, **kwargs))
+                finally:
+                    observe_op(storage, op, default_timer() - start)
+            return wrapper
+
+        @wraps(method)
+        def wrapper(*args, **kwargs):
+            start = default_timer()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                observe_op(storage, op, default_timer() - start)
+        return wrapper
+
+    def build_histogram(self, metric, labels, data):
+        items = [((TYPES.HISTOGRAM_SUM, metric.name, "_sum", labels), data.sum),
+                 ((TYPES.HISTOGRAM_COUNTER, metric.name, "_count", labels), data.count)]
+        for bucket, count in data.get_cumulative_counts():
+            items.append(((TYPES.HISTOGRAM_BUCKET, metric.name, "_bucket", (("bucket", bucket), ) + labels), count))
+        metric.add_sample(labels, metric.build_sample(labels, items))
+
+    def collect(self):
+        with self._lock:
+            metrics = list(self.build_metrics())
+        return iter(metrics)
+
+    def build_metrics(self):
+        metric = self._collectors["scrape_duration"]
+        self.build_histogram(metric, self._labels, self._scrapes)
+        yield metric
+
+        for name in ("series", "bytes"):
+            metric = self._collectors["scrape_" + name]
+            metric.add_sample(self._labels, metric.build_sample(self._labels, (
+                ((TYPES.GAUGE, metric.name, "", self._labels), self._last_scrape[name]), )))
+            yield metric
+
+        metric = self._collectors["storage_op_duration"]
+        for (storage, op), data in sorted(self._ops.items()):
+            self.build_histogram(metric, self._labels + (("op", op), ("storage", storage)), data)
+        yield metric
+
+        for name in ("wait", "hold"):
+            metric = self._collectors["lock_" + name]
+            for (sharedarea_id, lock, kind), data in sorted(self._locks.items()):
+                if kind == name:
+                    self.build_histogram(metric, self._labels + (("lock", lock), ("sharedarea", sharedarea_id)), data)
+            yield metric
+
+        metric = self._collectors["rescans"]
+        for sharedarea_id, value in sorted(self._rescans.items()):
+            labels = self._labels + (("sharedarea", sharedarea_id), )
+            metric.add_sample(labels, metric.build_sample(labels, (
+                ((TYPES.COUNTER, metric.name, "", labels), value), )))
+        yield metric
@@ -11,6 +11,8 @@ Prometheus instrumentation library for Python applications
 :github: http://github.com/Lispython/pyprometheus
 """
 
+import time
+
 from pyprometheus.const import TYPES
 from pyprometheus.utils import escape_str
 from pyprometheus.values import (MetricValue, GaugeValue,
@@ -28,12 +30,14 @@ class BaseMetric(object):
 
     PARENT_METHODS = set()
 
-    def __init__(self, name, doc, labels=[], registry=None):
+    def __init__(self, name, doc, labels=[], registry=None, ttl=None):
         self._name = name
         self._doc = doc
         self._labelnames = tuple(sorted(labels))
         self.validate_labelnames(labels)
         self._storage = None
+        # Seconds after which idle label sets are evicted
+        self._ttl = ttl
 
         if registry is not None:
             self.add_to_registry(registry)
@@ -72,6 +76,10 @@ class BaseMetric(object):
     def uid(self):
         return "{0}-{1}".format(self._name, str(self._labelnames))
 
+    @property
+    def ttl(self):
+        return self._ttl
+
     def add_to_registry(self, registry):
         """Add metric to registry
         """
@@ -79,13 +87,107 @@ class BaseMetric(object):
         self._storage = registry.storage
         return self
 
-    def labels(self, *args, **kwargs):
+    def get_label_values(self, args, kwargs):
         if args and isinstance(args[0], dict):
-            label_values = self.value_class.prepare_labels(args[0])[0]
-        else:
-            label_values = self.value_class.prepare_labels(kwargs)[0]
-        return self._labels_cache.setdefault((label_values, self.value_class.TYPE),
-                                             self.value_class(self, label_values=label_values))
+            return self.value_class.prepare_labels(args[0])[0]
+        return self.value_class.prepare_labels(kwargs)[0]
+
+    def labels(self, *args, **kwargs):
+        label_values = self.get_label_values(args, kwargs)
+        try:
+            return self._labels_cache[(label_values, self.value_class.TYPE)]
+        except KeyError:
+            return self._labels_cache.setdefault((label_values, self.value_class.TYPE),
+                                                 self.value_class(self, label_values=label_values))
+
+    def preregister(self, label_sets=None, init=True):
+        """Create `labels` children and their storage keys for known label sets
+
+        All keys, including histogram buckets, are created by one storage
+        operation, so `UWSGIStorage` updates area sign once::
+
+            latency.preregister([{"handler": "/"}, {"handler": "/api"}])
+
+        :param label_sets: list of label values dicts, metric without labels
+                           creates its single value by default
+        :param init: create storage keys, False to create them with `registry.warmup`
+        :return: list of values
+        """
+        if label_sets is None:
+            label_sets = [{}]
+        values = [self.labels(label_values) for label_values in label_sets]
+        if init and self._storage is not None:
+            self._storage.init_keys(*self.get_init_keys(values))
+        return values
+
+    def get_init_keys(self, values=None):
+        """Get storage keys and composite keys of values
+
+        :param values: values list, all `labels` children by default
+        :return: (keys, composite keys)
+        """
+        if values is None:
+            values = list(self._labels_cache.values())
+            if not values and not self._labelnames:
+                values = [self.labels()]
+
+        keys, vectors = [], []
+        for value in values:
+            value_keys, value_vectors = value.init_keys
+            keys.extend(value_keys)
+            vectors.extend(value_vectors)
+        return keys, vectors
+
+    def remove(self, *args, **kwargs):
+        """Remove labeled series from labels cache and storage
+        """
+        label_values = self.get_label_values(args, kwargs)
+        value = self._labels_cache.pop((label_values, self.value_class.TYPE), None)
+        if value is None:
+            value = self.value_class(self, label_values=label_values)
+        self.remove_values([value])
+
+    def clear(self):
+        """Remove all known label sets from labels cache and storage
+        """
+        values = list(self._labels_cache.values())
+        self._labels_cache.clear()
+        self.remove_values(values)
+
+    def expire(self, now=None):
+        """Evict label sets that were not updated longer than ttl seconds
+
+        Only label sets created by this process through `labels` are tracked.
+        Values updated since previous call are considered updated now, so
+        update time has resolution of calls interval.
+
+        Values of shared storages are written by other processes too, expired
+        label sets are dropped from labels cache only and storage keys are kept.
+        """
+        if self._ttl is None:
+            return 0
+
+        now = now or time.time()
+        deadline = now - self._ttl
+        expired = [(key, value) for key, value in list(self._labels_cache.items())
+                   if value.stamp(now) < deadline]
+
+        for key, _ in expired:
+            self._labels_cache.pop(key, None)
+
+        if not getattr(self._storage, "shared", False):
+            self.remove_values([value for _, value in expired])
+        return len(expired)
+
+    def remove_values(self, values):
+        """Remove storage keys of given value objects
+        """
+        if not values or self._storage is None:
+            return
+        keys = []
+        for value in values:
+            keys.extend(value.keys)
+        self._storage.remove_items(keys)
 
     @property
     def text_export_header(self):
@@ -164,9 +266,9 @@ class Summary(BaseMetric):
 
     PARENT_METHODS = set(("observe", "value", "time"))
 
-    def __init__(self, name, doc, labels=[], quantiles=False, registry=None):
+    def __init__(self, name, doc, labels=[], quantiles=False, registry=None, ttl=None):
         self._quantiles = list(sorted(quantiles)) if quantiles else []
-        super(Summary, self).__init__(name, doc, labels, registry)
+        super(Summary, self).__init__(name, doc, labels, registry, ttl)
 
     @property
     def quantiles(self):
@@ -206,9 +308,9 @@ class Histogram(BaseMetric):
 
     PARENT_METHODS = set(("observe", "value", "time"))
 
-    def __init__(self, name, doc, labels=[], buckets=DEFAULT_BUCKETS, registry=None):
+    def __init__(self, name, doc, labels=[], buckets=DEFAULT_BUCKETS, registry=None, ttl=None):
         self._buckets = list(sorted(buckets)) if buckets else []
-        super(Histogram, self).__init__(name, doc, labels, registry)
+        super(Histogram, self).__init__(name, doc, labels, registry, ttl)
 
     @property
     def buckets(self):
@@ -11,6 +11,21 @@ Prometheus instrumentation library for Python applications
 :github: http://github.com/Lispython/pyprometheus
 """
 
+from threading import Lock
+
+
+class Snapshot(object):
+    """Consumer state for `BaseRegistry.get_changes`
+
+    Keeps storage marker and last seen values to calculate deltas.
+    """
+
+    def __init__(self):
+        self.marker = None
+        self.values = {}
+
+    def __len__(self):
+        return len(self.values)
 
 
 class BaseRegistry(object):
@@ -18,23 +33,54 @@ class BaseRegistry(object):
     """
     def __init__(self, storage={}):
         self._collectors = {}
+        # Collectors are registered by receiver threads of daemons while scraping
+        self._lock = Lock()
         self._storage = storage
+        # Set by `pyprometheus.instrumentation.Instrumentation`
+        self.instrumentation = None
 
     @property
     def storage(self):
         return self._storage
 
+    def batch(self):
+        """Context to apply all metrics changes of current thread at once::
+
+            with registry.batch():
+                requests.labels(handler="/").inc()
+                latency.labels(handler="/").observe(0.1)
+        """
+        return self._storage.transaction()
+
+    def warmup(self):
+        """Create storage keys of all metrics at once
+
+        Keys are created for metrics without labels and for label sets
+        declared by `metric.preregister(..., init=False)` or used by `labels`.
+        """
+        keys, vectors = [], []
+        for uid, collector in self.collectors():
+            if hasattr(collector, "get_init_keys"):
+                collector_keys, collector_vectors = collector.get_init_keys()
+                keys.extend(collector_keys)
+                vectors.extend(collector_vectors)
+
+        if keys or vectors:
+            self._storage.init_keys(keys, vectors)
+
     def register(self, collector):
         """Add collector to registry
         """
-        if collector.uid in self._collectors:
-            raise RuntimeError(u"Collector {0} already registered".format(collector.uid))
-        self._collectors[collector.uid] = collector
+        with self._lock:
+            if collector.uid in self._collectors:
+                raise RuntimeError(u"Collector {0} already registered".format(collector.uid))
+            self._collectors[collector.uid] = collector
 
     def unregister(self, collector):
         """Remove collector from registry
         """
-        self._collectors.pop(collector.uid, None)
+        with self._lock:
+            self._collectors.pop(collector.uid, None)
 
     def collect(self, clean=True):
         """Get all metrics from all registered collectos
@@ -52,8 +98,49 @@ class BaseRegistry(object):
             else:
                 yield collector.build_samples(data.get(collector.name, []))
 
+    def expire(self):
+        """Evict idle label sets from collectors with ttl
+
+        Collect doesn't change storage, call it periodically
+        from scrape handler or background job.
+        """
+        for uid, collector in self.collectors():
+            if getattr(collector, "ttl", None) is not None:
+                collector.expire()
+
+    def get_changes(self, snapshot=None):
+        """Get storage items changed since snapshot
+
+        Snapshot is updated in place, pass it to next call.
+
+        :param snapshot: `Snapshot` from previous call or None
+        :return: (snapshot, [(key, value, delta), ...])
+        """
+        snapshot = snapshot or Snapshot()
+        marker, items, complete = self._storage.get_changed_items(snapshot.marker)
+        values = snapshot.values
+        changes = []
+
+        if complete:
+            # Keys removed from storage are dropped from snapshot
+            keys = set(key for key, _ in items)
+            for key in [x for x in values if x not in keys]:
+                del values[key]
+
+        for key, value in items:
+            previous = values.get(key)
+            if previous is None or previous != value:
+                changes.append((key, value, value - (previous or 0)))
+                values[key] = value
+
+        snapshot.marker = marker
+        return snapshot, changes
+
     def collectors(self):
-        return self._collectors.items()
+        """Get snapshot of registered (uid, collector) pairs
+        """
+        with self._lock:
+            return list(self._collectors.items())
 
     def is_registered(self, collector):
         """Check that collector already exists
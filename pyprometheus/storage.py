@@ -12,15 +12,239 @@ Prometheus instrumentation library for Python applications
 """
 
 
+import atexit
+import os
 from collections import defaultdict
+from contextlib import contextmanager
 from itertools import groupby
-from threading import Lock
+from logging import getLogger
+from threading import Event, Lock, Thread, local
+from weakref import WeakSet
 
 from pyprometheus.const import TYPES
 
 
+logger = getLogger("pyprometheus.storage")
+
+
+# Guards counters of active transactions
+_transactions_lock = Lock()
+
+
+def expand_vector_key(key):
+    """Get series keys of composite value key
+
+    Histogram key is `(HISTOGRAM, name, labels, buckets)` with series
+    sum, count and buckets, summary key is `(SUMMARY, name, labels)`
+    with series sum and count. Values keep their expanded keys and pass
+    them to storages, so it is not called on observation.
+    """
+    if key[0] == TYPES.HISTOGRAM:
+        _, name, labels, buckets = key
+        keys = [(TYPES.HISTOGRAM_SUM, name, "_sum", labels),
+                (TYPES.HISTOGRAM_COUNTER, name, "_count", labels)]
+        keys.extend((TYPES.HISTOGRAM_BUCKET, name, "_bucket",
+                     tuple(sorted(labels + (("bucket", bucket), ), key=lambda x: x[0]))) for bucket in buckets)
+    elif key[0] == TYPES.SUMMARY:
+        _, name, labels = key
+        keys = [(TYPES.SUMMARY_SUM, name, "_sum", labels),
+                (TYPES.SUMMARY_COUNTER, name, "_count", labels)]
+    else:
+        raise ValueError("Invalid composite key {0!r}".format(key))
+    return keys
+
+
+def expand_vectors(items):
+    """Convert composite keys increments to series increments
+
+    :param items: list of (composite key, increments, series keys or None)
+    """
+    incs = []
+    for key, values, series_keys in items:
+        incs.extend(zip(series_keys or expand_vector_key(key), values))
+    return incs
+
+
+# Storages with fork hooks and pid of process hooks were called for
+_fork_storages = WeakSet()
+_fork_pid = os.getpid()
+
+
+def register_fork_hooks(storage):
+    """Call storage fork hooks on fork of current process
+    """
+    _fork_storages.add(storage)
+    return storage
+
+
+def call_fork_hooks(name):
+    for storage in list(_fork_storages):
+        try:
+            getattr(storage, name)()
+        except Exception as e:
+            logger.error(e, exc_info=True)
+
+
+def prepare_fork():
+    """Flush buffers and build keys indexes of storages
+
+    It is not called on `os.fork`, forks of multiprocessing and subprocess
+    don't pay for flushes and area scans. Call it in uwsgi master after
+    application is loaded or before starting workers processes, children
+    inherit ready indexes copy-on-write.
+    """
+    call_fork_hooks("prepare_fork")
+
+
+def before_fork():
+    call_fork_hooks("before_fork")
+
+
+def after_fork_in_parent():
+    call_fork_hooks("after_fork_in_parent")
+
+
+def after_fork_in_child():
+    """Reset locks and process local buffers of storages in child
+
+    Safe to call more than once in process.
+    """
+    global _fork_pid, _transactions_lock
+    if _fork_pid == os.getpid():
+        return
+    _fork_pid = os.getpid()
+    _transactions_lock = Lock()
+    call_fork_hooks("after_fork_in_child")
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(before=before_fork, after_in_parent=after_fork_in_parent,
+                        after_in_child=after_fork_in_child)
+
+
+_flush_threads = WeakSet()
+
+
+class FlushThread(object):
+    """Daemon thread that calls `flush` every `interval` seconds
+
+    Buffering storages use it to send changes without waiting for next write.
+    `flush` is called once more by `stop` and on interpreter exit.
+    """
+
+    def __init__(self, flush, interval):
+        self._flush = flush
+        self._interval = interval
+        self._stopped = Event()
+        self._thread = None
+        _flush_threads.add(self)
+
+    def start(self):
+        self._stopped.clear()
+        self._thread = Thread(target=self.run)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def run(self):
+        while not self._stopped.wait(self._interval):
+            self.flush()
+
+    def flush(self):
+        try:
+            self._flush()
+        except Exception as e:
+            logger.error(e, exc_info=True)
+
+    def stop(self):
+        """Stop thread and flush changes left
+        """
+        self._stopped.set()
+        if self._thread is not None and self._thread.is_alive():
+            self._thread.join()
+        self._thread = None
+        self.flush()
+
+    def after_fork_in_child(self):
+        # Thread is not copied to child
+        if self._thread is not None and not self._stopped.is_set():
+            self.start()
+
+
+@atexit.register
+def stop_flush_threads():
+    for flush_thread in list(_flush_threads):
+        flush_thread.stop()
+
+
+class StorageTransaction(object):
+    """Changes of one thread applied to storage at once on exit
+    """
+
+    def __init__(self, storage):
+        self._storage = storage
+        self._writes = {}
+        self._incs = {}
+        self._vectors = {}
+        # Series key -> (composite key, index) of pending composite increments
+        self._vector_slots = {}
+        self.depth = 0
+
+    def inc_value(self, key, value):
+        if key in self._writes:
+            self._writes[key] += value
+        else:
+            self._incs[key] = self._incs.get(key, 0) + value
+
+    def write_value(self, key, value):
+        self._incs.pop(key, None)
+        self._writes[key] = value
+        return value
+
+    def get_value(self, key):
+        if key in self._writes:
+            return self._writes[key]
+        value = self._storage.get_value(key) + self._incs.get(key, 0)
+        if key in self._vector_slots:
+            vector_key, index = self._vector_slots[key]
+            value += self._vectors[vector_key][0][index]
+        return value
+
+    def inc_items(self, items):
+        for key, value in items:
+            self.inc_value(key, value)
+
+    def inc_vector(self, key, values, series_keys=None):
+        try:
+            pending = self._vectors[key][0]
+        except KeyError:
+            series_keys = series_keys or expand_vector_key(key)
+            self._vectors[key] = (list(values), series_keys)
+            for index, series_key in enumerate(series_keys):
+                self._vector_slots[series_key] = (key, index)
+            return
+        for index, value in enumerate(values):
+            pending[index] += value
+
+    def commit(self):
+        writes, incs = list(self._writes.items()), list(self._incs.items())
+        vectors = [(key, values, series_keys) for key, (values, series_keys) in self._vectors.items()]
+        self._writes.clear()
+        self._incs.clear()
+        self._vectors.clear()
+        self._vector_slots.clear()
+        if writes or incs or vectors:
+            self._storage.apply_changes(writes, incs, vectors)
+
+
 class BaseStorage(object):
 
+    # Number of threads in transaction, checked by values before lookup of thread transaction
+    _transactions = 0
+
+    # Values are written by other processes, metrics idle expiry don't remove them
+    shared = False
+
     def inc_value(self, key, amount):
         raise NotImplementedError("inc_value")
 
@@ -33,9 +257,131 @@ class BaseStorage(object):
     def get_items(self):
         raise NotImplementedError("get_items")
 
+    def remove_items(self, keys):
+        raise NotImplementedError("remove_items")
+
+    def get_changed_items(self, since=None):
+        """Get items changed since marker
+
+        Storages without change tracking return all items,
+        registry compares them with previous values.
+
+        :param since: marker from previous call or None
+        :return: (marker, items, True if items are all storage items)
+        """
+        return None, list(self.get_items()), True
+
     def __len__(self):
         raise NotImplementedError("len")
 
+    def prepare_fork(self):
+        """Flush pending changes and build indexes, see `prepare_fork`
+        """
+
+    def before_fork(self):
+        """Take locks to fork storage in consistent state
+        """
+
+    def after_fork_in_parent(self):
+        pass
+
+    def after_fork_in_child(self):
+        """Reset locks and process local buffers
+        """
+
+    def inc_items(self, items):
+        """Increment many keys by one storage operation
+
+        Storages override it to update all keys under one lock,
+        composite values use it to apply observation at once.
+
+        :param items: list of (key, amount)
+        """
+        for key, value in items:
+            self.inc_value(key, value)
+
+    def write_items(self, items):
+        """Write many keys by one storage operation
+
+        :param items: list of (key, value)
+        """
+        for key, value in items:
+            self.write_value(key, value)
+
+    def inc_vector(self, key, values, series_keys=None):
+        """Increment series of composite value by one storage operation
+
+        Storages without composite slots increment expanded series keys.
+
+        :param key: composite key, see `expand_vector_key`
+        :param values: increments in order of expanded series keys
+        :param series_keys: expanded series keys kept by value, expanded from key if None
+        """
+        self.inc_items(list(zip(series_keys or expand_vector_key(key), values)))
+
+    def inc_vectors(self, items):
+        """Increment series of many composite values
+
+        :param items: list of (composite key, increments, series keys or None)
+        """
+        self.inc_items(expand_vectors(items))
+
+    def init_keys(self, keys, vectors=()):
+        """Create keys and composite keys with zero values at once
+
+        Storages with append only index override it to create all
+        missing keys by one index update.
+
+        :param keys: series keys
+        :param vectors: composite keys, see `expand_vector_key`
+        """
+        vectors = [(key, expand_vector_key(key)) for key in vectors]
+        self.apply_changes((), [(key, 0) for key in keys],
+                           [(key, [0] * len(series_keys), series_keys) for key, series_keys in vectors])
+
+    def apply_changes(self, writes, incs, vectors=()):
+        """Apply writes then increments
+
+        Storages override it to take lock once.
+
+        :param vectors: list of (composite key, increments, series keys or None)
+        """
+        self.write_items(writes)
+        self.inc_items(incs)
+        if vectors:
+            self.inc_vectors(vectors)
+
+    @contextmanager
+    def transaction(self):
+        """Collect changes of current thread and apply them at once on exit
+
+        Changes are applied on exception too. Nested transactions
+        are joined to outer one.
+        """
+        thread_local = self.__dict__.get("_local") or self.__dict__.setdefault("_local", local())
+        transaction = getattr(thread_local, "transaction", None)
+        if transaction is None:
+            thread_local.transaction = transaction = StorageTransaction(self)
+            with _transactions_lock:
+                self._transactions += 1
+
+        transaction.depth += 1
+        try:
+            yield transaction
+        finally:
+            transaction.depth -= 1
+            if not transaction.depth:
+                thread_local.transaction = None
+                with _transactions_lock:
+                    self._transactions -= 1
+                transaction.commit()
+
+    def get_transaction(self):
+        """Get transaction of current thread or storage itself
+        """
+        thread_local = self.__dict__.get("_local")
+        return getattr(thread_local, "transaction", None) or self
+
     def __repr__(self):
         return u"<{0}: {1} items>".format(self.__class__.__name__, len(self))
 
@@ -85,14 +431,39 @@ class LocalMemoryStorage(BaseStorage):
     def __init__(self):
         self._storage = defaultdict(float)
         self._lock = Lock()
+        # Keys generation of last change, tracked after first `get_changed_items`
+        self._changes = None
+        self._generation = 0
+        # Markers not newer than generation of last removal get all items
+        self._removed = 0
+        self._fork_locked = False
+        register_fork_hooks(self)
+
+    def before_fork(self):
+        # Values are not changed by other threads while forking
+        self._lock.acquire()
+        self._fork_locked = True
+
+    def after_fork_in_parent(self):
+        if self._fork_locked:
+            self._fork_locked = False
+            self._lock.release()
+
+    def after_fork_in_child(self):
+        self._fork_locked = False
+        self._lock = Lock()
 
     def inc_value(self, key, value):
         with self._lock:
             self._storage[key] += value
+            if self._changes is not None:
+                self._changes[key] = self._generation
 
     def write_value(self, key, value):
         with self._lock:
             self._storage[key] = value
+            if self._changes is not None:
+                self._changes[key] = self._generation
 
     def get_value(self, key):
         with self._lock:
@@ -101,13 +472,244 @@ class LocalMemoryStorage(BaseStorage):
     def get_items(self):
         return self._storage.items()
 
+    def remove_items(self, keys):
+        """Remove given keys from storage
+        """
+        with self._lock:
+            for key in keys:
+                self._storage.pop(key, None)
+            self.track_removal(keys)
+
+    def track_removal(self, keys):
+        if self._changes is not None:
+            for key in keys:
+                self._changes.pop(key, None)
+            self._removed = self._generation
+
+    def get_changed_items(self, since=None):
+        """Get items changed since marker
+
+        Changes are tracked after first call. Next call after keys
+        removal gets all items, so consumers drop removed keys.
+        """
+        with self._lock:
+            self._generation += 1
+            if since is None or self._changes is None or since <= self._removed:
+                if self._changes is None:
+                    self._changes = {}
+                return self._generation, list(self._storage.items()), True
+            return self._generation, [(key, self._storage[key]) for key, generation in self._changes.items()
+                                      if generation >= since], False
+
     def __len__(self):
         return len(self._storage)
 
     def __repr__(self):
         return u"<{0}: {1} items>".format(self.__class__.__name__, len(self))
 
+    def inc_items(self, items):
+        with self._lock:
+            changes, generation = self._changes, self._generation
+            for key, value in items:
+                self._storage[key] += value
+                if changes is not None:
+                    changes[key] = generation
+
+    def inc_vector(self, key, values, series_keys=None):
+        keys = series_keys or expand_vector_key(key)
+        with self._lock:
+            changes, generation = self._changes, self._generation
+            for key, value in zip(keys, values):
+                self._storage[key] += value
+                if changes is not None:
+                    changes[key] = generation
+
+    def write_items(self, items):
+        with self._lock:
+            changes, generation = self._changes, self._generation
+            for key, value in items:
+                self._storage[key] = value
+                if changes is not None:
+                    changes[key] = generation
+
+    def apply_changes(self, writes, incs, vectors=()):
+        if vectors:
+            incs = list(incs) + expand_vectors(vectors)
+
+        with self._lock:
+            changes, generation = self._changes, self._generation
+            for key, value in writes:
+                self._storage[key] = value
+                if changes is not None:
+                    changes[key] = generation
+
+            for key, value in incs:
+                self._storage[key] += value
+                if changes is not None:
+                    changes[key] = generation
+
     def clear(self):
         """Remove all items from storage
         """
         self._storage.clear()
+        if self._changes is not None:
+            self._changes.clear()
+            self._removed = self._generation
+
+
+class BufferedStorage(BaseStorage):
+    """Base of client storages that buffer changes in process and `send` them
+
+    Increments are summed per key and writes keep last value until flush.
+    Writes flush only when `max_pending` keys are buffered, interval flushes
+    are made by `FlushThread`, also at exit. Flushes are serialized, so
+    writes of one key are sent in order.
+    """
+
+    # Values are owned by other process
+    shared = True
+
+    def __init__(self, max_pending=10000, flush_interval=1.0, autoflush=True):
+        self._max_pending = max_pending
+        self._flush_interval = flush_interval
+        self._lock = Lock()
+        self._flush_lock = Lock()
+        self._incs = {}
+        self._writes = {}
+        self._flush_thread = None
+        if autoflush and flush_interval is not None:
+            self._flush_thread = FlushThread(self.flush, flush_interval).start()
+        register_fork_hooks(self)
+
+    def inc_value(self, key, value):
+        with self._lock:
+            if key in self._writes:
+                self._writes[key] += value
+            else:
+                self._incs[key] = self._incs.get(key, 0) + value
+            pending = len(self._incs) + len(self._writes)
+        self.check_flush(pending)
+
+    def write_value(self, key, value):
+        with self._lock:
+            self._incs.pop(key, None)
+            self._writes[key] = value
+            pending = len(self._incs) + len(self._writes)
+        self.check_flush(pending)
+        return value
+
+    def apply_changes(self, writes, incs, vectors=()):
+        if vectors:
+            incs = list(incs) + expand_vectors(vectors)
+
+        with self._lock:
+            for key, value in writes:
+                self._incs.pop(key, None)
+                self._writes[key] = value
+
+            for key, value in incs:
+                if key in self._writes:
+                    self._writes[key] += value
+                else:
+                    self._incs[key] = self._incs.get(key, 0) + value
+            pending = len(self._incs) + len(self._writes)
+        self.check_flush(pending)
+
+    def inc_items(self, items):
+        self.apply_changes((), items)
+
+    def write_items(self, items):
+        self.apply_changes(items, ())
+
+    def inc_vector(self, key, values, series_keys=None):
+        self.apply_changes((), (), ((key, values, series_keys), ))
+
+    def get_value(self, key):
+        """Get pending not flushed value
+        """
+        with self._lock:
+            if key in self._writes:
+                return self._writes[key]
+            return self._incs.get(key, 0.0)
+
+    def remove_items(self, keys):
+        with self._lock:
+            for key in keys:
+                self._incs.pop(key, None)
+                self._writes.pop(key, None)
+
+    def __len__(self):
+        return len(self._incs) + len(self._writes)
+
+    def clear(self):
+        with self._lock:
+            self._incs.clear()
+            self._writes.clear()
+
+    def check_flush(self, pending):
+        if pending >= self._max_pending:
+            self.flush()
+
+    def take_changes(self):
+        """Swap buffers
+
+        :return: (writes, incs) dicts
+        """
+        with self._lock:
+            writes, self._writes = self._writes, {}
+            incs, self._incs = self._incs, {}
+        return writes, incs
+
+    def restore(self, writes, incs):
+        """Return not sent changes before changes made since flush
+
+        :param writes: dict or list of (key, value)
+        :param incs: dict or list of (key, value)
+        """
+        writes = writes.items() if isinstance(writes, dict) else writes
+        incs = incs.items() if isinstance(incs, dict) else incs
+        with self._lock:
+            for key, value in writes:
+                if key not in self._writes:
+                    self._writes[key] = value + self._incs.pop(key, 0.0)
+
+            for key, value in incs:
+                if key in self._writes:
+                    continue
+                self._incs[key] = self._incs.get(key, 0) + value
+
+    def flush(self):
+        """Send buffered changes
+        """
+        with self._flush_lock:
+            writes, incs = self.take_changes()
+            if writes or incs:
+                self.send(writes, incs)
+
+    def send(self, writes, incs):
+        """Send changes, keep not sent ones by `restore`
+
+        :param writes: dict of key -> value
+        :param incs: dict of key -> increment
+        """
+        raise NotImplementedError("send")
+
+    def stop(self):
+        """Stop flush thread and send changes left
+        """
+        if self._flush_thread is not None:
+            self._flush_thread.stop()
+        else:
+            self.flush()
+
+    def prepare_fork(self):
+        self.flush()
+
+    def after_fork_in_child(self):
+        # Changes made before fork are sent by parent
+        self._lock = Lock()
+        self._flush_lock = Lock()
+        self._incs.clear()
+        self._writes.clear()
+        if self._flush_thread is not None:
+            self._flush_thread.after_fork_in_child()
@@ -10,9 +10,16 @@ Prometheus instrumentation library for Python applications
 :license: , see LICENSE for more details.
 :github: http://github.com/Lispython/pyprometheus
 """
+import errno
+import socket
 import sys
 import time
 
+try:
+    xrange = xrange
+except Exception:
+    xrange = range
+
 
 def import_storage(path):
     try:
@@ -23,6 +30,27 @@ def import_storage(path):
         return sys.modules[path]
 
 
+def recv_batch(sock, batch_size, timeout, buffer_size=65535):
+    """Wait for datagram and drain up to `batch_size` queued datagrams
+
+    :return: list of packets, empty if nothing received before timeout
+    """
+    sock.settimeout(timeout)
+    try:
+        packets = [sock.recv(buffer_size)]
+    except socket.timeout:
+        return []
+
+    sock.setblocking(False)
+    try:
+        for _ in xrange(batch_size - 1):
+            packets.append(sock.recv(buffer_size))
+    except socket.error as e:
+        if e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK):
+            raise
+    return packets
+
+
 def escape_str(value):
     return value.replace("\\", r"\\").replace("\n", r"\n").replace("\"", r"\"")
 
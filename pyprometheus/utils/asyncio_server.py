@@ -0,0 +1,207 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+pyprometheus.utils.asyncio_server
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+Asyncio HTTP server to expose registry metrics. Requires python 3.7+
+
+:copyright: (c) 2017 by Alexandr Lispython.
+:license: , see LICENSE for more details.
+:github: http://github.com/Lispython/pyprometheus
+"""
+import asyncio
+from logging import getLogger
+
+from pyprometheus.const import CONTENT_TYPE
+from pyprometheus.utils.exposition import registry_to_text_chunks
+
+
+logger = getLogger("pyprometheus.asyncio_server")
+
+
+class MetricsServer(object):
+    """HTTP/1.1 server that streams registry in text format
+
+    Registry rendering runs in executor, so event loop of application
+    that embeds server is not blocked by large registries.
+    Collect is not reentrant, so only `max_scrapes` scrapes render at once,
+    others wait up to `timeout` seconds and get 503.
+    """
+
+    MAX_HEADERS_SIZE = 16 * 1024
+
+    def __init__(self, registry, host="0.0.0.0", port=9100, path="/metrics",
+                 timeout=30, keepalive_timeout=75, max_scrapes=1,
+                 chunk_size=64 * 1024, executor=None):
+        self._registry = registry
+        self._host = host
+        self._port = port
+        self._path = path
+        self._timeout = timeout
+        self._keepalive_timeout = keepalive_timeout
+        self._chunk_size = chunk_size
+        self._executor = executor
+        self._max_scrapes = max_scrapes
+        # Created by `start` in running loop, python < 3.10 binds it to loop on init
+        self._scrapes = None
+        self._server = None
+
+    @property
+    def sockets(self):
+        return self._server.sockets if self._server else []
+
+    async def start(self):
+        self._scrapes = asyncio.Semaphore(self._max_scrapes)
+        self._server = await asyncio.start_server(
+            self.handle_connection, self._host, self._port, limit=self.MAX_HEADERS_SIZE)
+        return self
+
+    async def close(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    async def serve_forever(self):
+        if self._server is None:
+            await self.start()
+        async with self._server:
+            await self._server.serve_forever()
+
+    async def handle_connection(self, reader, writer):
+        try:
+            keepalive = True
+            timeout = self._timeout
+            while keepalive:
+                try:
+                    head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), timeout)
+                except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, asyncio.TimeoutError):
+                    break
+
+                method, path, version, headers = self.parse_request(head)
+                if method is None:
+                    await self.send_response(writer, 400, b"Bad request\n", version, False)
+                    break
+
+                await self.discard_body(reader, headers)
+
+                connection = headers.get("connection", "").lower()
+                keepalive = (version == "HTTP/1.1" and connection != "close") or \
+                            (version == "HTTP/1.0" and connection == "keep-alive")
+
+                if path.split("?", 1)[0] != self._path:
+                    await self.send_response(writer, 404, b"Not found\n", version, keepalive)
+                elif method not in ("GET", "HEAD"):
+                    await self.send_response(writer, 405, b"Method not allowed\n", version, keepalive)
+                else:
+                    await self.send_metrics(writer, method, version, keepalive)
+
+                timeout = self._keepalive_timeout
+        except (ConnectionError, asyncio.TimeoutError):
+            pass
+        except Exception as e:
+            logger.error(e, exc_info=True)
+        finally:
+            writer.close()
+
+    def parse_request(self, head):
+        """Parse request line and headers
+
+        :param head: bytes of request head
+        """
+        lines = head.decode("latin-1").split("\r\n")
+        try:
+            method, path, version = lines[0].split(" ")
+        except ValueError:
+            return None, None, "HTTP/1.0", {}
+
+        headers = {}
+        for line in lines[1:]:
+            if ":" in line:
+                name, value = line.split(":", 1)
+                headers[name.strip().lower()] = value.strip()
+        return method.upper(), path, version.upper(), headers
+
+    async def discard_body(self, reader, headers):
+        length = int(headers.get("content-length", 0) or 0)
+        if length:
+            await asyncio.wait_for(reader.readexactly(length), self._timeout)
+
+    async def send_response(self, writer, status, body, version, keepalive, content_type="text/plain"):
+        writer.write(self.format_head(status, version, keepalive, [
+            ("Content-Type", content_type),
+            ("Content-Length", str(len(body)))]) + body)
+        await asyncio.wait_for(writer.drain(), self._timeout)
+
+    def format_head(self, status, version, keepalive, headers):
+        reason = {200: "OK", 400: "Bad Request", 404: "Not Found",
+                  405: "Method Not Allowed", 503: "Service Unavailable"}[status]
+        lines = ["{0} {1} {2}".format("HTTP/1.1" if version == "HTTP/1.1" else "HTTP/1.0", status, reason)]
+        lines.extend("{0}: {1}".format(name, value) for name, value in headers)
+        lines.append("Connection: {0}".format("keep-alive" if keepalive else "close"))
+        return ("\r\n".join(lines) + "\r\n\r\n").encode("latin-1")
+
+    async def send_metrics(self, writer, method, version, keepalive):
+        try:
+            await asyncio.wait_for(self._scrapes.acquire(), self._timeout)
+        except asyncio.TimeoutError:
+            await self.send_response(writer, 503, b"Too many scrapes\n", version, keepalive)
+            return
+
+        try:
+            loop = asyncio.get_event_loop()
+            chunks = registry_to_text_chunks(self._registry)
+
+            if version != "HTTP/1.1":
+                # HTTP/1.0 clients do not support chunked encoding
+                body = await loop.run_in_executor(self._executor, "".join, chunks)
+                body = body.encode("utf-8")
+                writer.write(self.format_head(200, version, keepalive, [
+                    ("Content-Type", CONTENT_TYPE),
+                    ("Content-Length", str(len(body)))]))
+                if method != "HEAD":
+                    writer.write(body)
+                await asyncio.wait_for(writer.drain(), self._timeout)
+                return
+
+            writer.write(self.format_head(200, version, keepalive, [
+                ("Content-Type", CONTENT_TYPE),
+                ("Transfer-Encoding", "chunked")]))
+
+            if method == "HEAD":
+                await asyncio.wait_for(writer.drain(), self._timeout)
+                return
+
+            while True:
+                data = await loop.run_in_executor(self._executor, self.read_chunk, chunks)
+                if not data:
+                    break
+                writer.write("{0:x}\r\n".format(len(data)).encode("latin-1") + data + b"\r\n")
+                await asyncio.wait_for(writer.drain(), self._timeout)
+
+            writer.write(b"0\r\n\r\n")
+            await asyncio.wait_for(writer.drain(), self._timeout)
+        finally:
+            self._scrapes.release()
+
+    def read_chunk(self, chunks):
+        """Render text format chunks up to `chunk_size` bytes
+
+        :param chunks: iterator from `registry_to_text_chunks`
+        """
+        output = []
+        size = 0
+        for chunk in chunks:
+            chunk = chunk.encode("utf-8")
+            output.append(chunk)
+            size += len(chunk)
+            if size >= self._chunk_size:
+                break
+        return b"".join(output)
+
+
+async def start_server(registry, host="0.0.0.0", port=9100, **kwargs):
+    """Start metrics server in running event loop
+    """
+    return await MetricsServer(registry, host, port, **kwargs).start()
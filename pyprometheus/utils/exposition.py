@@ -11,21 +11,61 @@ Helpers to export registry to another formats
 :github: http://github.com/Lispython/pyprometheus
 """
 import os
+import time
 from datetime import datetime
+from threading import Condition
+from timeit import default_timer
 
-from pyprometheus.const import CREDITS
+from pyprometheus.const import CREDITS, CONTENT_TYPE
 
 
-def registry_to_text(registry):
+def registry_to_text(registry, timestamp=True):
     """Get all registry metrics and convert to text format
     """
-    output = [CREDITS.format(dt=datetime.utcnow().isoformat())]
+    return "".join(registry_to_text_chunks(registry, timestamp))
+
+
+def registry_to_text_chunks(registry, timestamp=True):
+    """Get all registry metrics and yield text format chunks per collector
+    """
+    instrumentation = getattr(registry, "instrumentation", None)
+    if instrumentation is not None:
+        for chunk in instrumented_text_chunks(registry, instrumentation, timestamp):
+            yield chunk
+        return
+
+    yield CREDITS.format(dt=datetime.utcnow().isoformat())
+    for collector, samples in registry.get_samples():
+        output = ["", collector.text_export_header]
+        for sample in samples:
+            output.append(sample.get_export_str(timestamp))
+        yield "\n".join(output)
+    yield "\n"
+
+
+def instrumented_text_chunks(registry, instrumentation, timestamp=True):
+    """Yield text format chunks and report render duration, series and size
+    """
+    start = default_timer()
+    series = size = 0
+    chunk = CREDITS.format(dt=datetime.utcnow().isoformat())
+    duration = default_timer() - start
+    yield chunk
+    size += len(chunk.encode("utf-8"))
+
     for collector, samples in registry.get_samples():
-        output.append(collector.text_export_header)
+        start = default_timer()
+        output = ["", collector.text_export_header]
         for sample in samples:
-            output.append(sample.export_str)
-    output.append("")
-    return "\n".join(output)
+            output.append(sample.get_export_str(timestamp))
+            series += len(sample.flatten())
+        chunk = "\n".join(output)
+        duration += default_timer() - start
+        yield chunk
+        size += len(chunk.encode("utf-8"))
+
+    yield "\n"
+    instrumentation.observe_scrape(duration, series, size + 1)
 
 
 def write_to_textfile(registry, path):
@@ -38,3 +78,79 @@ def write_to_textfile(registry, path):
         f.write(registry_to_text(registry))
 
     os.rename(tmp_filename, path)
+
+
+class SingleFlightRenderer(object):
+    """Render registry once for all concurrent callers
+
+    Callers that come while registry is rendered wait for the in-flight
+    render and reuse its bytes. Output is reused without render
+    for `min_interval` seconds.
+    """
+
+    def __init__(self, registry, min_interval=0, render=registry_to_text):
+        self._registry = registry
+        self._min_interval = min_interval
+        self._render = render
+        self._cond = Condition()
+        self._rendering = False
+        self._generation = 0
+        self._result = (None, None)
+        self._rendered_at = 0
+
+    def render(self):
+        """Get rendered registry bytes
+        """
+        with self._cond:
+            output, error = self._result
+            if output is not None and time.time() - self._rendered_at < self._min_interval:
+                return output
+
+            if self._rendering:
+                generation = self._generation
+                while self._generation == generation:
+                    self._cond.wait()
+                output, error = self._result
+                if error is not None:
+                    raise error
+                return output
+
+            self._rendering = True
+
+        output, error = None, None
+        try:
+            output = self._render(self._registry)
+            if not isinstance(output, bytes):
+                output = output.encode("utf-8")
+        except Exception as e:
+            error = e
+
+        with self._cond:
+            self._rendering = False
+            self._generation += 1
+            self._result = (output, error)
+            if error is None:
+                self._rendered_at = time.time()
+            self._cond.notify_all()
+
+        if error is not None:
+            raise error
+        return output
+
+
+class MetricsWSGIApp(object):
+    """WSGI application to expose registry in text format
+
+    Concurrent scrapes share one render, see `SingleFlightRenderer`
+    """
+
+    def __init__(self, registry, min_interval=0):
+        self._renderer = SingleFlightRenderer(registry, min_interval)
+
+    def __call__(self, environ, start_response):
+        body = self._renderer.render()
+        start_response("200 OK", [("Content-Type", CONTENT_TYPE),
+                                  ("Content-Length", str(len(body)))])
+        if environ.get("REQUEST_METHOD") == "HEAD":
+            return []
+        return [body]
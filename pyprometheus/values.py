@@ -30,6 +30,9 @@ class MetricValue(object):
 
         self._labels, self._label_values = self.prepare_labels(label_values)
         self._value = value
+        # Set by `stamp`, time is read only for metrics with ttl
+        self._updated_at = None
+        self._touched = False
 
     @staticmethod
     def prepare_labels(label_values):
@@ -43,6 +46,10 @@ class MetricValue(object):
     def metric(self):
         return self._metric
 
+    @property
+    def labels(self):
+        return self._labels
+
     def set_value(self, value):
         self._value = value
 
@@ -66,14 +73,57 @@ class MetricValue(object):
     def key(self):
         return (self.TYPE, self._metric.name, self.POSTFIX, self._labels)
 
+    @property
+    def keys(self):
+        """All storage keys used by value
+        """
+        return [self.key]
+
+    @property
+    def init_keys(self):
+        """Storage keys and composite keys to create for value ahead
+        """
+        return [self.key], []
+
+    def flatten(self):
+        """Get list of single values for composite value
+        """
+        return [self]
+
+    @property
+    def updated_at(self):
+        return self._updated_at
+
+    def touch(self):
+        """Mark value as updated for metrics with idle expiry
+
+        Time is not read on write, `stamp` sets it for marked values.
+        """
+        self._touched = True
+
+    def stamp(self, now):
+        """Set update time of new value or value marked since previous stamp
+        """
+        if self._touched or self._updated_at is None:
+            self._touched = False
+            self._updated_at = now
+        return self._updated_at
+
     def inc(self, amount=1):
-        return self._metric._storage.inc_value(self.key, amount)
+        self.touch()
+        storage = self._metric._storage
+        if storage._transactions:
+            storage = storage.get_transaction()
+        return storage.inc_value(self.key, amount)
 
     def get(self):
         # Do not lookup storage if value 0
         if self._value is not None:
             return self._value
-        return self._metric._storage.get_value(self.key)
+        storage = self._metric._storage
+        if storage._transactions:
+            storage = storage.get_transaction()
+        return storage.get_value(self.key)
 
     @property
     def value(self):
@@ -81,6 +131,13 @@ class MetricValue(object):
 
     @property
     def export_str(self):
+        return self.get_export_str()
+
+    def get_export_str(self, timestamp=True):
+        if not timestamp:
+            return "{name}{postfix}{{{labels}}} {value}".format(
+                name=escape_str(self._metric.name), postfix=self.POSTFIX,
+                labels=self.export_labels, value=float(self.value))
         return "{name}{postfix}{{{labels}}} {value} {timestamp}".format(
             name=escape_str(self._metric.name), postfix=self.POSTFIX,
             labels=self.export_labels, timestamp=int(time.time() * 1000), value=float(self.value))
@@ -113,7 +170,11 @@ class GaugeValue(MetricValue):
         self.inc(-amount)
 
     def set(self, value):
-        self._metric._storage.write_value(self.key, value)
+        self.touch()
+        storage = self._metric._storage
+        if storage._transactions:
+            storage = storage.get_transaction()
+        storage.write_value(self.key, value)
         return value
 
     @property
@@ -203,6 +264,10 @@ class SummaryValue(MetricValue):
         else:
             self._quantiles = []
 
+        # Sum and count are incremented as one composite value
+        self._vector_key = (self.TYPE, self._metric.name, self._labels)
+        self._series_keys = [self._sum.key, self._count.key]
+
     def __repr_value__(self):
         return u"sum={sum} / count={count} = {value} [{quantiles}]".format(
             **{
@@ -214,8 +279,11 @@ class SummaryValue(MetricValue):
         )
 
     def observe(self, amount):
-        self._sum.inc(amount)
-        self._count.inc()
+        self.touch()
+        storage = self._metric._storage
+        if storage._transactions:
+            storage = storage.get_transaction()
+        storage.inc_vector(self._vector_key, (amount, 1), self._series_keys)
 
         # TODO: calculate quantiles
         # for quantile, value in self._quantiles:
@@ -229,8 +297,18 @@ class SummaryValue(MetricValue):
             "quantiles": self._quantiles}
 
     @property
-    def export_str(self):
-        return "\n".join([self._sum.export_str, self._count.export_str] + [quantile.export_str for quantile in self._quantiles])
+    def keys(self):
+        return [self._sum.key, self._count.key] + [quantile.key for quantile in self._quantiles]
+
+    @property
+    def init_keys(self):
+        return [], [self._vector_key]
+
+    def get_export_str(self, timestamp=True):
+        return "\n".join([x.get_export_str(timestamp) for x in self.flatten()])
+
+    def flatten(self):
+        return [self._sum, self._count] + self._quantiles
 
     def time(self):
         return TimerManager(self)
@@ -292,6 +370,11 @@ class HistogramValue(MetricValue):
         self._buckets = (value.pop("buckets", []) or [HistogramBucketValue(self._metric, label_values=self._label_values, bucket=bucket)
                                                       for bucket in sorted(self._metric.buckets)])
 
+        self._thresholds = [bucket.bucket_threshold for bucket in self._buckets]
+        # Sum, count and buckets are incremented as one composite value
+        self._vector_key = (self.TYPE, self._metric.name, self._labels, tuple(self._thresholds))
+        self._series_keys = [self._sum.key, self._count.key] + [bucket.key for bucket in self._buckets]
+
     def __repr_value__(self):
         return u"sum={sum} / count={count} = {value} [{buckets}]".format(
             **{
@@ -303,12 +386,20 @@ class HistogramValue(MetricValue):
             }
         )
 
-    def observe(self, amount):
-        self._sum.inc(amount)
-        self._count.inc()
+    def observe(self, amount, weight=1):
+        """Update sum, count and buckets by one storage operation
 
-        for bucket in self._buckets:
-            bucket.inc(int(amount < bucket.bucket_threshold))
+        :param weight: number of observations of amount, sampled sources
+                       pass inverse of sample rate
+        """
+        self.touch()
+        values = [amount * weight, weight]
+        values.extend(weight if amount < threshold else 0 for threshold in self._thresholds)
+
+        storage = self._metric._storage
+        if storage._transactions:
+            storage = storage.get_transaction()
+        storage.inc_vector(self._vector_key, values, self._series_keys)
 
     @property
     def value(self):
@@ -319,8 +410,18 @@ class HistogramValue(MetricValue):
         }
 
     @property
-    def export_str(self):
-        return "\n".join([self._sum.export_str, self._count.export_str] + [bucket.export_str for bucket in self._buckets])
+    def keys(self):
+        return [self._sum.key, self._count.key] + [bucket.key for bucket in self._buckets]
+
+    @property
+    def init_keys(self):
+        return [], [self._vector_key]
+
+    def get_export_str(self, timestamp=True):
+        return "\n".join([x.get_export_str(timestamp) for x in self.flatten()])
+
+    def flatten(self):
+        return [self._sum, self._count] + self._buckets
 
     def time(self):
         return TimerManager(self)
@@ -61,7 +61,7 @@ setup(
     url='https://github.com/Lispython/pyprometheus',
     description='Prometheus python client and instrumentation library',
     long_description=read_description(),
-    packages=find_packages(exclude=("tests", "tests.*",)),
+    packages=find_packages(exclude=("tests", "tests.*", "benchmarks", "benchmarks.*")),
     zip_safe=False,
     extras_require={
         'tests': tests_require,
@@ -0,0 +1,219 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+from multiprocessing import Process
+
+from pyprometheus.contrib.aggregator import (AggregatorServer, AggregatorStorage, decode_packet,
+                                             encode_record, INC, WRITE, MAGIC)
+from pyprometheus.metrics import Counter, Gauge, Histogram
+from pyprometheus.registry import BaseRegistry
+from pyprometheus.storage import LocalMemoryStorage
+from pyprometheus.utils.exposition import registry_to_text
+
+try:
+    from urllib.request import urlopen
+except ImportError:
+    from urllib2 import urlopen
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+def test_aggregator_encoding():
+    key = (13, "metric_histogram_name", "_bucket", (("bucket", float("inf")), ("label1", "value1")))
+    packet = MAGIC + encode_record(INC, key, 1.5) + encode_record(WRITE, (2, "gauge", "", ()), 3)
+
+    assert decode_packet(packet) == [(INC, key, 1.5), (WRITE, (2, "gauge", "", ()), 3.0)]
+
+
+def test_aggregator_handle_packets(tmpdir):
+    storage = LocalMemoryStorage()
+    registry = BaseRegistry(storage=storage)
+    server = AggregatorServer(registry, str(tmpdir.join("aggregator.sock")))
+    counter_key = (3, "counter_metric_name", "", ())
+    gauge_key = (2, "gauge_metric_name", "", ())
+
+    applied = []
+    apply_changes = storage.apply_changes
+
+    def counting_apply_changes(writes, incs, vectors=()):
+        applied.append((sorted(writes), sorted(incs)))
+        return apply_changes(writes, incs, vectors)
+
+    storage.apply_changes = counting_apply_changes
+
+    server.handle_packets([
+        MAGIC + encode_record(INC, counter_key, 1) + encode_record(WRITE, gauge_key, 5),
+        MAGIC + encode_record(INC, counter_key, 2) + encode_record(INC, gauge_key, 1),
+        MAGIC + encode_record(INC, (99, "invalid", "", ()), 1),
+        b"broken"])
+
+    # Batch is applied by one storage operation
+    assert applied == [([(gauge_key, 6)], [(counter_key, 3)])]
+    assert server.errors == 2
+    assert dict(storage.get_items()) == {counter_key: 3, gauge_key: 6}
+
+
+def test_aggregator_declare_while_scraping(tmpdir):
+    registry = BaseRegistry(storage=LocalMemoryStorage())
+    server = AggregatorServer(registry, str(tmpdir.join("aggregator.sock")))
+    errors = []
+    done = threading.Event()
+
+    def scrape():
+        while not done.is_set():
+            try:
+                registry_to_text(registry)
+            except Exception as e:
+                errors.append(e)
+
+    threads = [threading.Thread(target=scrape) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    try:
+        for x in range(500):
+            server.handle_packets([MAGIC + encode_record(INC, (3, "counter_{0}".format(x), "", ()), 1)])
+    finally:
+        done.set()
+        for thread in threads:
+            thread.join()
+
+    assert errors == []
+    assert len(registry) == 500
+
+
+def test_aggregator_server(tmpdir):
+    path = str(tmpdir.join("aggregator.sock"))
+    registry = BaseRegistry(storage=LocalMemoryStorage())
+    gauge = Gauge("gauge_metric_name", "gauge doc", ("label1", ), registry=registry)
+    server = AggregatorServer(registry, path, timeout=0.05).start()
+
+    storage = AggregatorStorage(path, max_packet_size=200, flush_interval=3600)
+    client = BaseRegistry(storage=storage)
+    client_gauge = Gauge("gauge_metric_name", "gauge doc", ("label1", ), registry=client)
+    histogram = Histogram("histogram_metric_name", "histogram doc", ("label1", ),
+                          buckets=(0.1, 1, float("inf")), registry=client)
+
+    client_gauge.labels(label1="value1").set(10)
+    client_gauge.labels(label1="value1").inc(2)
+    for _ in range(10):
+        histogram.labels(label1="value1").observe(0.5)
+    storage.flush()
+
+    assert storage.sent > 1
+    assert wait_for(lambda: server.packets == storage.sent)
+    server.stop()
+
+    assert gauge.labels(label1="value1").value == 12
+    # Histogram is declared by daemon from keys with client buckets
+    text = registry_to_text(registry)
+    assert "histogram_metric_name_count{label1=\"value1\"} 10.0" in text
+    assert "histogram_metric_name_bucket{le=\"1\", label1=\"value1\"} 10.0" in text
+    assert "histogram_metric_name_bucket{le=\"0.1\", label1=\"value1\"} 0.0" in text
+
+
+def test_aggregator_storage_fallback(tmpdir):
+    path = str(tmpdir.join("aggregator.sock"))
+    storage = AggregatorStorage(path, max_packet_size=100, flush_interval=3600)
+    counter = Counter("counter_metric_name", "counter doc", ("label1", ), registry=BaseRegistry(storage=storage))
+    key = (3, "counter_metric_name", "", (("label1", "value1"), ))
+
+    # Daemon is not running
+    counter.labels(label1="value1").inc(3)
+    storage.flush()
+    assert not storage.available
+    assert dict(storage.get_items()) == {key: 3}
+
+    # Daemon does not read, its queue gets full
+    receiver = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    receiver.bind(path)
+    for i in range(100):
+        counter.labels(label1=str(i)).inc()
+        storage.flush()
+    assert storage.available
+    assert storage.deferred > 1
+
+    receiver.setblocking(False)
+    totals = {}
+
+    def receive():
+        try:
+            while True:
+                for _, key, value in decode_packet(receiver.recv(65535)):
+                    totals[key] = totals.get(key, 0) + value
+        except socket.error:
+            pass
+
+    while len(storage.fallback):
+        receive()
+        storage.flush()
+    receive()
+    receiver.close()
+
+    assert totals[key] == 3
+    assert len(totals) == 101
+    assert sum(totals.values()) == 103
+
+
+def test_aggregator_storage_autoflush(tmpdir):
+    path = str(tmpdir.join("aggregator.sock"))
+    receiver = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    receiver.bind(path)
+    receiver.settimeout(5)
+
+    storage = AggregatorStorage(path, flush_interval=0.01)
+    key = (3, "counter_metric_name", "", ())
+    try:
+        # Sent by flush thread without next write
+        storage.inc_value(key, 2)
+        assert decode_packet(receiver.recv(65535)) == [(INC, key, 2)]
+
+        storage.inc_value(key, 1)
+        storage.stop()
+        assert len(storage) == 0
+        assert decode_packet(receiver.recv(65535)) == [(INC, key, 1)]
+    finally:
+        storage.stop()
+        receiver.close()
+
+
+def test_aggregator_daemon(tmpdir, iterations, num_workers):
+    path = str(tmpdir.join("aggregator.sock"))
+    daemon = subprocess.Popen([sys.executable, "-m", "pyprometheus.contrib.aggregator",
+                               "--socket", path, "--address", "127.0.0.1:0"],
+                              stdout=subprocess.PIPE, cwd=os.path.dirname(os.path.dirname(__file__)))
+    try:
+        port = int(daemon.stdout.readline().decode().strip().rsplit(":", 1)[1])
+
+        storage = AggregatorStorage(path, flush_interval=0.01)
+        counter = Counter("counter_metric_name", "counter doc", ("label1", ), registry=BaseRegistry(storage=storage))
+
+        def writer():
+            for _ in range(iterations):
+                counter.labels(label1="value1").inc()
+            storage.flush()
+
+        workers = [Process(target=writer) for _ in range(num_workers)]
+        for p in workers:
+            p.start()
+        for p in workers:
+            p.join()
+
+        expected = "counter_metric_name{{label1=\"value1\"}} {0}".format(float(iterations * num_workers))
+
+        def scrape():
+            return urlopen("http://127.0.0.1:{0}/metrics".format(port)).read().decode("utf-8")
+
+        assert wait_for(lambda: expected in scrape())
+    finally:
+        daemon.terminate()
+        daemon.wait()
@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import sys
+
+import pytest
+
+if sys.version_info < (3, 7):
+    pytest.skip("asyncio server requires python 3.7+", allow_module_level=True)
+
+import asyncio  # noqa: E402
+import http.client  # noqa: E402
+import socket  # noqa: E402
+import threading  # noqa: E402
+
+from pyprometheus.metrics import Counter  # noqa: E402
+from pyprometheus.registry import BaseRegistry  # noqa: E402
+from pyprometheus.storage import LocalMemoryStorage  # noqa: E402
+from pyprometheus.utils.asyncio_server import MetricsServer  # noqa: E402
+from pyprometheus.utils.exposition import registry_to_text  # noqa: E402
+
+
+def run_server(server):
+    loop = asyncio.new_event_loop()
+    loop.run_until_complete(server.start())
+    thread = threading.Thread(target=loop.run_forever)
+    thread.daemon = True
+    thread.start()
+    return loop, server.sockets[0].getsockname()[1]
+
+
+def test_asyncio_metrics_server():
+    registry = BaseRegistry(storage=LocalMemoryStorage())
+    counter = Counter("counter_metric_name", "counter_metric_name doc", ("label1", ), registry=registry)
+
+    for x in range(1000):
+        counter.labels(label1="value{0}".format(x)).inc(x)
+
+    server = MetricsServer(registry, "127.0.0.1", 0, chunk_size=1024, timeout=1)
+    # Semaphore is created in loop that runs server
+    assert server._scrapes is None
+    loop, port = run_server(server)
+
+    try:
+        connection = http.client.HTTPConnection("127.0.0.1", port)
+
+        for _ in range(2):
+            connection.request("GET", "/metrics")
+            response = connection.getresponse()
+            assert response.status == 200
+            assert response.getheader("Transfer-Encoding") == "chunked"
+            body = response.read().decode("utf-8")
+
+            # Same connection is reused for next request
+            assert not response.will_close
+            assert [x.split(" ")[:-1] for x in body.split("\n")[4:]] == \
+                [x.split(" ")[:-1] for x in registry_to_text(registry).split("\n")[4:]]
+
+        connection.request("GET", "/other")
+        response = connection.getresponse()
+        assert response.status == 404
+        response.read()
+
+        connection.close()
+
+        # Idle connection is closed after timeout
+        sock = socket.create_connection(("127.0.0.1", port))
+        sock.settimeout(5)
+        assert sock.recv(1) == b""
+        sock.close()
+    finally:
+        asyncio.run_coroutine_threadsafe(server.close(), loop).result()
+        loop.call_soon_threadsafe(loop.stop)
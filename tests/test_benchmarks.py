@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import json
+
+from benchmarks import hotpath, scrape, stress
+from benchmarks.utils import REFERENCE, compare_results, parse_tolerance
+
+
+def test_hotpath_benchmarks(tmpdir):
+    output = tmpdir.join("results.json")
+
+    assert hotpath.main(["-n", "10", "-r", "2", "-s", "local", "-s", "uwsgi", "-o", str(output)]) == 0
+
+    results = json.loads(output.read())["results"]
+    assert set(results) == set("{0}.{1}".format(storage, name)
+                               for storage in ("local", "uwsgi") for name in hotpath.BENCHMARKS) | set([REFERENCE])
+    assert all(x["ns_per_op"] > 0 for x in results.values())
+    assert results[REFERENCE]["repeat"] == 4
+
+
+def test_compare_results():
+    baseline = {"local.counter_inc": {"ns_per_op": 100.0},
+                "uwsgi.counter_inc": {"ns_per_op": 100.0},
+                "local.gauge_set": {"ns_per_op": 100.0}}
+    results = {"local.counter_inc": {"ns_per_op": 130.0},
+               "uwsgi.counter_inc": {"ns_per_op": 130.0},
+               "local.labels_hit": {"ns_per_op": 100.0}}
+
+    report = compare_results(results, baseline, 0.2, [parse_tolerance("uwsgi.*=0.5")])
+
+    assert [(name, regressed) for name, _, _, _, regressed in report] == [
+        ("local.counter_inc", True), ("uwsgi.counter_inc", False)]
+    assert parse_tolerance("0.3") == ("*", 0.3)
+
+    # Run on two times slower machine is not regressed
+    baseline[REFERENCE] = {"ns_per_op": 50.0}
+    results[REFERENCE] = {"ns_per_op": 100.0}
+    results["local.counter_inc"]["ns_per_op"] = 230.0
+
+    report = compare_results(results, baseline, 0.2)
+    assert [(name, ratio, regressed) for name, _, _, ratio, regressed in report] == [
+        ("local.counter_inc", 1.15, False), ("uwsgi.counter_inc", 0.65, False)]
+
+
+def test_scrape_benchmark(tmpdir):
+    output = tmpdir.join("scrape.json")
+
+    assert scrape.main(["--size", "1000", "-r", "1", "-o", str(output)]) == 0
+
+    result = json.loads(output.read())["results"]["local.1000"]
+    assert 900 < result["series"] <= 1000
+    assert result["output_bytes"] > 0
+    if scrape.tracemalloc is not None:
+        assert result["allocated_bytes"] >= result["output_bytes"]
+        assert result["allocated_blocks"] > 0
+    assert result["render_seconds"] >= result["collect_seconds"] > 0
+
+
+def test_stress_harness():
+    for storage in ("uwsgi", "uwsgi_flush", "uwsgi_sharded"):
+        result = stress.run(workers=3, ops=200, storage=storage, flush_every=50, shards=3)
+
+        assert result["failed_workers"] == 0
+        assert result["correct"], (result["expected"], result["actual"])
+        assert result["expected"]["created"] > 0
+
+    result = stress.run(workers=3, ops=200, storage="uwsgi_double_buffer", scrape_interval=0.001)
+    assert result["correct"], (result["expected"], result["actual"])
+    assert result["scrapes"] > 0
@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import threading
+import time
+
+from pyprometheus.metrics import Counter
+from pyprometheus.registry import BaseRegistry
+from pyprometheus.storage import LocalMemoryStorage
+from pyprometheus.utils.exposition import MetricsWSGIApp, SingleFlightRenderer, registry_to_text
+
+try:
+    xrange = xrange
+except Exception:
+    xrange = range
+
+
+def test_single_flight_renderer():
+    registry = BaseRegistry(storage=LocalMemoryStorage())
+    counter = Counter("counter_metric_name", "counter_metric_name doc", registry=registry)
+    counter.inc(1)
+
+    renders = []
+
+    def render(registry):
+        renders.append(1)
+        time.sleep(0.3)
+        return registry_to_text(registry)
+
+    renderer = SingleFlightRenderer(registry, render=render)
+    outputs = []
+
+    workers = [threading.Thread(target=lambda: outputs.append(renderer.render())) for _ in xrange(10)]
+    for x in workers:
+        x.start()
+    for x in workers:
+        x.join()
+
+    assert len(renders) == 1
+    assert len(set(outputs)) == 1
+    assert b"counter_metric_name{} 1.0" in outputs[0]
+
+    renderer.render()
+    assert len(renders) == 2
+
+    renderer = SingleFlightRenderer(registry, min_interval=60, render=render)
+    renderer.render()
+    renderer.render()
+    assert len(renders) == 3
+
+
+def test_metrics_wsgi_app():
+    registry = BaseRegistry(storage=LocalMemoryStorage())
+    counter = Counter("counter_metric_name", "counter_metric_name doc", registry=registry)
+    counter.inc(1)
+
+    app = MetricsWSGIApp(registry)
+    responses = []
+
+    def start_response(status, headers):
+        responses.append((status, dict(headers)))
+
+    body = b"".join(app({"REQUEST_METHOD": "GET"}, start_response))
+
+    assert responses[0][0] == "200 OK"
+    assert responses[0][1]["Content-Length"] == str(len(body))
+    assert b"counter_metric_name{} 1.0" in body
@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import pickle
+import socket
+import struct
+import threading
+import time
+
+from pyprometheus.const import TYPES
+from pyprometheus.contrib.graphite import GraphitePusher
+from pyprometheus.metrics import Counter, Histogram
+from pyprometheus.registry import BaseRegistry
+from pyprometheus.storage import LocalMemoryStorage
+
+try:
+    xrange = xrange
+except Exception:
+    xrange = range
+
+
+class CarbonServer(threading.Thread):
+
+    def __init__(self):
+        super(CarbonServer, self).__init__()
+        self.daemon = True
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.bind(("127.0.0.1", 0))
+        self.socket.listen(5)
+        self.address = self.socket.getsockname()
+        self.received = []
+
+    def run(self):
+        while True:
+            try:
+                connection, _ = self.socket.accept()
+            except socket.error:
+                return
+            chunks = []
+            while True:
+                data = connection.recv(65536)
+                if not data:
+                    break
+                chunks.append(data)
+            connection.close()
+            self.received.append(b"".join(chunks))
+
+    def wait(self, connections):
+        while len(self.received) < connections:
+            time.sleep(0.01)
+        return self.received
+
+
+class CountingSocket(object):
+
+    def __init__(self, sock):
+        self._sock = sock
+        self.sends = 0
+
+    def sendall(self, data):
+        self.sends += 1
+        return self._sock.sendall(data)
+
+    def close(self):
+        return self._sock.close()
+
+
+def read_pickle_frames(data):
+    datapoints = []
+    while data:
+        size = struct.unpack("!L", data[:4])[0]
+        datapoints.extend(pickle.loads(data[4:4 + size]))
+        data = data[4 + size:]
+    return datapoints
+
+
+def test_graphite_format():
+    registry = BaseRegistry(storage=LocalMemoryStorage())
+    histogram = Histogram("histogram_metric_name", "histogram_metric_name doc", ("label1", ),
+                          buckets=(0.5, float("inf")), registry=registry)
+
+    histogram.labels(label1="value 1").observe(0.4)
+
+    pusher = GraphitePusher(("127.0.0.1", 2003), registry, prefix="app.")
+
+    assert pusher.format_sample(histogram.labels(label1="value 1"), timestamp=10) == [
+        ("app.histogram_metric_name_sum;label1=value_1", (10, 0.4)),
+        ("app.histogram_metric_name_count;label1=value_1", (10, 1.0)),
+        ("app.histogram_metric_name_bucket;le=0.5;label1=value_1", (10, 1.0)),
+        ("app.histogram_metric_name_bucket;le=+Inf;label1=value_1", (10, 1.0))]
+
+    pusher = GraphitePusher(("127.0.0.1", 2003), registry, tags=False)
+    assert pusher.format_sample(histogram.labels(label1="value.1"), timestamp=10)[0] == \
+        ("histogram_metric_name_sum.label1.value_1", (10, 0.0))
+
+
+def test_graphite_pusher():
+    storage = LocalMemoryStorage()
+    registry = BaseRegistry(storage=storage)
+    Counter("counter_metric_name", "counter_metric_name doc", ("label1", ), registry=registry)
+
+    for x in xrange(100000):
+        storage.write_value((TYPES.COUNTER, "counter_metric_name", "", (("label1", str(x)), )), x)
+
+    server = CarbonServer()
+    server.start()
+
+    for protocol in (GraphitePusher.PLAINTEXT, GraphitePusher.PICKLE):
+        pusher = GraphitePusher(server.address, registry, protocol=protocol, batch_size=5000)
+        sock = pusher._socket = CountingSocket(pusher.connect())
+
+        assert pusher.push(timestamp=10) == 100000
+        assert sock.sends == 20
+
+        pusher.close()
+
+    plaintext, pickled = server.wait(2)
+
+    lines = plaintext.decode("utf-8").splitlines()
+    assert len(lines) == 100000
+    assert "counter_metric_name;label1=1 1.0 10" in lines
+
+    datapoints = read_pickle_frames(pickled)
+    assert len(datapoints) == 100000
+    assert ("counter_metric_name;label1=1", (10, 1.0)) in datapoints
+
+
+def test_graphite_reconnect():
+    registry = BaseRegistry(storage=LocalMemoryStorage())
+    counter = Counter("counter_metric_name", "counter_metric_name doc", registry=registry)
+    counter.inc(1)
+
+    server = CarbonServer()
+    server.start()
+
+    pusher = GraphitePusher(server.address, registry)
+    assert pusher.push(timestamp=10) == 1
+
+    # Broken connection is replaced with new one
+    pusher._socket.close()
+    assert pusher.push(timestamp=10) == 1
+    pusher.close()
@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import socket
+import threading
+import time
+
+from pyprometheus.contrib.influxdb import InfluxDBPusher
+from pyprometheus.metrics import Counter, Histogram
+from pyprometheus.registry import BaseRegistry
+from pyprometheus.storage import LocalMemoryStorage
+
+try:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+except ImportError:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+
+
+class InfluxDBHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length")))
+        self.server.requests.append((self.path, body))
+        self.send_response(204)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+def make_registry():
+    registry = BaseRegistry(storage=LocalMemoryStorage())
+    counter = Counter("requests total", "Requests", ("code", "path"), registry=registry)
+    histogram = Histogram("latency", "Latency", ("path", ), buckets=(0.5, float("inf")), registry=registry)
+
+    for x in range(100):
+        counter.labels(code="200", path="/page,{0}".format(x)).inc(x)
+
+    histogram.labels(path="/").observe(0.2)
+    histogram.labels(path="/").observe(0.7)
+    return registry
+
+
+def test_influxdb_udp_pusher():
+    receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    receiver.bind(("127.0.0.1", 0))
+    receiver.settimeout(5)
+
+    pusher = InfluxDBPusher(receiver.getsockname(), make_registry(), prefix="app_")
+
+    assert pusher.push(timestamp=10) == 101
+
+    lines = []
+    while len(lines) < 101:
+        packet = receiver.recv(65535)
+        assert len(packet) <= 1400
+        lines.extend(packet.decode("utf-8").splitlines())
+
+    assert "app_requests\\ total,code=200,path=/page\\,1 value=1.0 10" in lines
+    assert "app_latency,path=/ sum=0.8999999999999999,count=2.0,0.5=1.0,+Inf=2.0 10" in lines
+    pusher.close()
+
+
+def test_influxdb_udp_timestamp():
+    receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    receiver.bind(("127.0.0.1", 0))
+    receiver.settimeout(5)
+
+    registry = BaseRegistry(storage=LocalMemoryStorage())
+    Counter("hits", "Hits", registry=registry).inc()
+
+    started = time.time()
+    for precision, multiplier in ((None, 10 ** 9), ("s", 1)):
+        pusher = InfluxDBPusher(receiver.getsockname(), registry, precision=precision)
+        assert pusher.push() == 1
+
+        timestamp = int(receiver.recv(65535).decode("utf-8").split()[-1])
+        assert int(started * multiplier) <= timestamp <= int(time.time() * multiplier)
+        pusher.close()
+
+
+def test_influxdb_http_pusher():
+    server = HTTPServer(("127.0.0.1", 0), InfluxDBHandler)
+    server.requests = []
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+
+    try:
+        pusher = InfluxDBPusher(server.server_address, make_registry(), protocol=InfluxDBPusher.HTTP,
+                                database="metrics", batch_size=1024)
+        assert pusher.push(timestamp=10) == 101
+        pusher.close()
+    finally:
+        server.shutdown()
+        server.server_close()
+        thread.join()
+
+    assert len(server.requests) > 1
+    assert all(path == "/write?db=metrics&precision=ms" for path, _ in server.requests)
+    assert sum(len(body.splitlines()) for _, body in server.requests) == 101
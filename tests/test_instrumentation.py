@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from pyprometheus.contrib.uwsgi_features import UWSGIStorage
+from pyprometheus.instrumentation import Instrumentation, HistogramData
+from pyprometheus.metrics import Counter, Histogram
+from pyprometheus.registry import BaseRegistry
+from pyprometheus.storage import LocalMemoryStorage
+from pyprometheus.utils.exposition import registry_to_text
+
+
+def get_lines(output, prefix):
+    return [x.rsplit(" ", 1)[0] for x in output.split("\n") if x.startswith(prefix)]
+
+
+def test_histogram_data():
+    data = HistogramData((0.1, 1, float("inf")))
+    for value in (0.05, 0.1, 0.5, 5):
+        data.observe(value)
+
+    assert list(data.get_cumulative_counts()) == [(0.1, 2), (1, 3), (float("inf"), 4)]
+    assert data.count == 4
+
+    data = HistogramData((0.1, 1))
+    for value in (0.05, 0.5, 5, 50):
+        data.observe(value)
+
+    assert list(data.get_cumulative_counts()) == [(0.1, 1), (1, 2), (float("inf"), 4)]
+
+
+def test_instrumentation_local_storage():
+    registry = BaseRegistry(storage=LocalMemoryStorage())
+    instrumentation = Instrumentation(registry, namespace="lib")
+
+    counter = Counter("counter_metric_name", "Counter", ("label", ), registry=registry)
+    histogram = Histogram("histogram_metric_name", "Histogram", buckets=(1, float("inf")), registry=registry)
+
+    for x in range(10):
+        counter.labels(label="value").inc()
+    histogram.observe(0.5)
+
+    output = registry_to_text(registry)
+    assert instrumentation._last_scrape["series"] == len([x for x in output.split("\n") if x and not x.startswith("#")])
+    assert instrumentation._last_scrape["bytes"] == len(output.encode("utf-8"))
+
+    output = registry_to_text(registry)
+
+    assert "lib:scrape_duration_seconds_count{} 1.0" in get_lines(output, "lib:scrape_duration_seconds_count")
+    assert get_lines(output, "lib:storage_operation_duration_seconds_count") == [
+        "lib:storage_operation_duration_seconds_count{op=\"get_items\", storage=\"LocalMemoryStorage\"} 2.0",
+        "lib:storage_operation_duration_seconds_count{op=\"inc_value\", storage=\"LocalMemoryStorage\"} 10.0",
+        "lib:storage_operation_duration_seconds_count{op=\"inc_vector\", storage=\"LocalMemoryStorage\"} 1.0"]
+
+
+def test_instrumentation_uwsgi_storage():
+    registry = BaseRegistry(storage=UWSGIStorage(0))
+    Instrumentation(registry, namespace="lib")
+
+    counter = Counter("counter_metric_name", "Counter", ("label", ), registry=registry)
+    counter.labels(label="value").inc()
+
+    # Other process adds key and changes area sign
+    UWSGIStorage(0).inc_value((3, "other_metric_name", "", ()), 1)
+
+    counter.labels(label="value").inc()
+
+    output = registry_to_text(registry)
+
+    assert get_lines(output, "lib:sharedarea_rescans_total") == ["lib:sharedarea_rescans_total{sharedarea=\"0\"} 1.0"]
+    assert get_lines(output, "lib:sharedarea_lock_wait_seconds_count") == [
+        "lib:sharedarea_lock_wait_seconds_count{lock=\"read\", sharedarea=\"0\"} 1.0",
+        "lib:sharedarea_lock_wait_seconds_count{lock=\"write\", sharedarea=\"0\"} 2.0"]
+    assert len(get_lines(output, "lib:sharedarea_lock_hold_seconds_count")) == 2
@@ -358,3 +358,103 @@ def test_metric_methods(storage_cls):
 
     assert metric.value["sum"].value > 3
     assert metric.value["count"].value == 3
+
+
+@pytest.mark.parametrize("storage_cls", [LocalMemoryStorage, UWSGIStorage])
+def test_metric_remove_labels(storage_cls):
+    storage = storage_cls()
+
+    registry = BaseRegistry(storage=storage)
+
+    metric = Counter("counter_metric_name", "counter_metric_name doc", ("label1", ), registry=registry)
+    histogram = Histogram("histogram_metric_name", "histogram_metric_name doc", ("label1", ),
+                          buckets=(0.5, 1, float("inf")), registry=registry)
+
+    metric.labels(label1="value1").inc(2)
+    metric.labels(label1="value2").inc(3)
+    histogram.labels(label1="value1").observe(0.7)
+
+    assert len(storage) == 1 + 1 + 5
+
+    metric.remove(label1="value1")
+
+    assert len(storage) == 1 + 5
+    assert metric.labels(label1="value1").get() == 0
+    assert metric.labels(label1="value2").get() == 3
+
+    histogram.clear()
+
+    assert len(storage) == 2
+    assert histogram.labels(label1="value1").value["count"].value == 0
+
+    metric.clear()
+    assert len(metric._labels_cache) == 0
+
+
+@pytest.mark.parametrize("storage_cls", [LocalMemoryStorage, UWSGIStorage])
+def test_metric_ttl(storage_cls):
+    storage = storage_cls()
+
+    registry = BaseRegistry(storage=storage)
+
+    metric = Gauge("gauge_metric_name", "gauge_metric_name doc", ("label1", ), registry=registry, ttl=60)
+    summary = Summary("summary_metric_name", "summary_metric_name doc", ("label1", ), registry=registry, ttl=60)
+
+    assert metric.ttl == 60
+
+    metric.labels(label1="idle").set(1)
+    metric.labels(label1="active").set(2)
+    summary.labels(label1="idle").observe(1)
+
+    now = time.time()
+
+    # Values updated since previous expire are stamped with its time
+    assert metric.expire(now - 90) == 0
+    assert summary.expire(now - 90) == 0
+    assert metric.labels(label1="idle").updated_at == now - 90
+
+    metric.labels(label1="active").set(3)
+
+    assert metric.expire(now) == 1
+    assert summary.expire(now) == 1
+
+    assert list(metric._labels_cache.keys()) == [((("label1", "active"),), metric.value_class.TYPE)]
+    # Shared storages keep keys written by other processes
+    assert len(storage) == (4 if storage.shared else 1)
+
+    metric.labels(label1="idle").set(1)
+    assert metric.labels(label1="idle").updated_at is None
+
+    # Collect doesn't evict idle label sets
+    list(registry.collect())
+    assert len(storage) == (4 if storage.shared else 2)
+
+    registry.expire()
+    assert len(storage) == (4 if storage.shared else 2)
+
+
+@pytest.mark.parametrize("storage_cls", [LocalMemoryStorage, UWSGIStorage])
+def test_metric_preregister(storage_cls):
+    storage = storage_cls()
+    registry = BaseRegistry(storage=storage)
+    histogram = Histogram("histogram_metric_name", "histogram doc", ("label1", ), buckets=(1, float("inf")), registry=registry)
+    counter = Counter("counter_metric_name", "counter doc", registry=registry)
+
+    values = histogram.preregister([{"label1": "value1"}, {"label1": "value2"}])
+    assert values == [histogram.labels(label1="value1"), histogram.labels(label1="value2")]
+    assert len(storage) == 8
+
+    keys = dict(storage.get_items())
+    for value in values:
+        assert set(value.keys) <= set(keys)
+        assert all(keys[key] == 0 for key in value.keys)
+
+    counter.preregister()
+    assert counter.value == 0
+    assert len(storage) == 9
+
+    # Existing values are kept
+    histogram.labels(label1="value1").observe(0.5)
+    histogram.preregister([{"label1": "value1"}])
+    assert histogram.labels(label1="value1").value["count"].value == 1
+    assert len(storage) == 9
@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import gzip
+import threading
+import time
+
+import pytest
+
+from pyprometheus.contrib.pushgateway import PushgatewayClient, PushgatewayError, PushgatewayPusher
+from pyprometheus.metrics import Counter
+from pyprometheus.registry import BaseRegistry
+from pyprometheus.storage import LocalMemoryStorage
+
+try:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+except ImportError:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class PushgatewayHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def handle_request(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length) if length else b""
+        if self.headers.get("Content-Encoding") == "gzip":
+            body = gzip.GzipFile(fileobj=__import__("io").BytesIO(body)).read()
+
+        self.server.requests.append((self.command, self.path, self.client_address, body))
+
+        status = 400 if "fail" in self.path else 202
+        self.send_response(status)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    do_PUT = do_POST = do_DELETE = handle_request
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def pushgateway():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), PushgatewayHandler)
+    server.requests = []
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+    thread.join()
+
+
+def test_pushgateway_client(pushgateway):
+    registry = BaseRegistry(storage=LocalMemoryStorage())
+    counter = Counter("counter_metric_name", "counter_metric_name doc", ("label1", ), registry=registry)
+    counter.labels(label1="value1").inc(3)
+
+    client = PushgatewayClient("127.0.0.1:{0}".format(pushgateway.server_address[1]), registry, "batch/job")
+    registry.register(client)
+
+    assert client.push({"instance": "host1"}) == 202
+    assert client.pushadd({"instance": "host1"}) == 202
+    assert client.delete({"instance": ""}) == 202
+
+    with pytest.raises(PushgatewayError):
+        client.push({"instance": "fail"})
+
+    assert client.push() == 202
+
+    methods = [x[0] for x in pushgateway.requests]
+    assert methods == ["PUT", "POST", "DELETE", "PUT", "PUT"]
+
+    assert pushgateway.requests[0][1] == "/metrics/job@base64/YmF0Y2gvam9i/instance/host1"
+    assert pushgateway.requests[2][1] == "/metrics/job@base64/YmF0Y2gvam9i/instance@base64/="
+
+    # All requests use one connection
+    assert len(set(x[2] for x in pushgateway.requests)) == 1
+
+    body = pushgateway.requests[0][3].decode("utf-8")
+    assert "counter_metric_name{label1=\"value1\"} 3.0\n" in body
+
+    body = pushgateway.requests[4][3].decode("utf-8")
+    assert "pushgateway:push_failures_total{method=\"PUT\"} 1.0" in body
+    assert "pushgateway:push_duration_seconds_count{method=\"PUT\"} 2.0" in body
+
+    client.close()
+
+
+def test_pushgateway_pusher(pushgateway):
+    registry = BaseRegistry(storage=LocalMemoryStorage())
+
+    client = PushgatewayClient("127.0.0.1:{0}".format(pushgateway.server_address[1]), registry, "job", gzip=False)
+
+    pusher = PushgatewayPusher(client, interval=0.05, jitter=0.01)
+    pusher.start()
+    time.sleep(0.5)
+    pusher.stop()
+    client.close()
+
+    assert len(pushgateway.requests) > 3
@@ -0,0 +1,333 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import hashlib
+import threading
+import time
+
+import pytest
+
+from pyprometheus.contrib.redis_storage import RedisStorage, RedisConnectionPool, RedisConnectionError
+from pyprometheus.metrics import Counter, Gauge, Histogram
+from pyprometheus.registry import BaseRegistry
+from pyprometheus.utils.exposition import registry_to_text
+
+try:
+    import socketserver
+except ImportError:
+    import SocketServer as socketserver
+
+
+class FakeRedisHandler(socketserver.StreamRequestHandler):
+    """Speaks RESP protocol for commands used by `RedisStorage`
+    """
+
+    def read_command(self):
+        line = self.rfile.readline()
+        if not line:
+            return None
+        args = []
+        for _ in range(int(line[1:])):
+            size = int(self.rfile.readline()[1:])
+            args.append(self.rfile.read(size + 2)[:-2])
+        return args
+
+    def encode(self, value):
+        if value is None:
+            return b"$-1\r\n"
+        if isinstance(value, Exception):
+            return "-{0}\r\n".format(value).encode()
+        if isinstance(value, int):
+            return ":{0}\r\n".format(value).encode()
+        if isinstance(value, list):
+            return "*{0}\r\n".format(len(value)).encode() + b"".join(self.encode(x) for x in value)
+        return "${0}\r\n".format(len(value)).encode() + value + b"\r\n"
+
+    def handle(self):
+        server = self.server
+        # Commands queued after MULTI
+        queued = None
+        while True:
+            args = self.read_command()
+            if args is None:
+                return
+            command = args[0].decode().upper()
+            if command == server.drop_on:
+                # Connection breaks before command, queued commands are discarded
+                return
+            with server.lock:
+                server.commands.append(command)
+                if command == "MULTI":
+                    queued, response = [], b"OK"
+                elif command == "EXEC":
+                    response = [server.execute(x.decode().upper(), y) for x, y in queued]
+                    queued = None
+                elif queued is not None:
+                    queued.append((args[0], args[1:]))
+                    response = b"QUEUED"
+                else:
+                    response = server.execute(command, args[1:])
+                self.wfile.write(self.encode(response))
+
+
+class FakeRedisServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        socketserver.TCPServer.__init__(self, ("127.0.0.1", 0), FakeRedisHandler)
+        self.lock = threading.Lock()
+        self.hashes = {}
+        self.scripts = {}
+        self.commands = []
+        self.drop_on = None
+
+    def hincrbyfloat(self, key, field, value):
+        data = self.hashes.setdefault(key, {})
+        data[field] = repr(float(data.get(field, b"0")) + float(value)).encode()
+        return data[field]
+
+    def execute(self, command, args):
+        if command in ("PING", "AUTH", "SELECT"):
+            return b"OK"
+        elif command == "HSET":
+            data = self.hashes.setdefault(args[0], {})
+            new = len([x for x in args[1::2] if x not in data])
+            data.update(zip(args[1::2], args[2::2]))
+            return new
+        elif command == "HGET":
+            return self.hashes.get(args[0], {}).get(args[1])
+        elif command == "HINCRBYFLOAT":
+            return self.hincrbyfloat(*args)
+        elif command == "HDEL":
+            data = self.hashes.get(args[0], {})
+            return len([data.pop(x) for x in args[1:] if x in data])
+        elif command == "HLEN":
+            return len(self.hashes.get(args[0], {}))
+        elif command == "DEL":
+            return int(self.hashes.pop(args[0], None) is not None)
+        elif command == "HSCAN":
+            fields = sorted(self.hashes.get(args[0], {}).items())
+            cursor, count = int(args[1]), int(args[3])
+            page = fields[cursor:cursor + count]
+            cursor = cursor + count if cursor + count < len(fields) else 0
+            return [str(cursor).encode(), [x for item in page for x in item]]
+        elif command in ("EVAL", "EVALSHA"):
+            if command == "EVAL":
+                sha = hashlib.sha1(args[0]).hexdigest().encode()
+                self.scripts[sha] = args[0]
+            else:
+                sha = args[0]
+            if sha not in self.scripts:
+                return Exception("NOSCRIPT No matching script")
+            assert self.scripts[sha] == RedisStorage.INC_SCRIPT.encode()
+            key, argv = args[2], args[3:]
+            for field, value in zip(argv[::2], argv[1::2]):
+                self.hincrbyfloat(key, field, value)
+            return len(argv) // 2
+        return Exception("ERR unknown command '{0}'".format(command))
+
+
+@pytest.yield_fixture
+def redis_server():
+    server = FakeRedisServer()
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_redis_storage(redis_server):
+    port = redis_server.server_address[1]
+    storage = RedisStorage(port=port, flush_interval=3600, scan_count=5)
+    registry = BaseRegistry(storage=storage)
+    counter = Counter("counter_metric_name", "counter doc", ("label1", ), registry=registry)
+    gauge = Gauge("gauge_metric_name", "gauge doc", registry=registry)
+    histogram = Histogram("histogram_metric_name", "histogram doc", ("label1", ),
+                          buckets=(0.1, 1, float("inf")), registry=registry)
+
+    for _ in range(10):
+        counter.labels(label1="value1").inc()
+        histogram.labels(label1="value1").observe(0.5)
+    gauge.set(5)
+    gauge.inc(2)
+
+    # Nothing is sent before flush
+    assert redis_server.commands == []
+    assert gauge.value == 7
+
+    storage.flush()
+    assert redis_server.commands == ["MULTI", "HSET"] + ["HINCRBYFLOAT"] * 6 + ["EXEC"]
+
+    assert counter.labels(label1="value1").value == 10
+
+    other = RedisStorage(port=port, flush_interval=3600, scan_count=5)
+    assert other.count() == 7
+    assert dict(other.get_items()) == dict(storage.get_items())
+    assert redis_server.commands.count("HSCAN") == 4
+
+    text = registry_to_text(registry)
+    assert "histogram_metric_name_bucket{le=\"1\", label1=\"value1\"} 10.0" in text
+
+    storage.remove_items([(2, "gauge_metric_name", "", ())])
+    assert other.count() == 6
+
+    storage.clear()
+    assert other.count() == 0
+
+
+def test_redis_storage_unbuffered(redis_server):
+    storage = RedisStorage(port=redis_server.server_address[1], flush_interval=None)
+    keys = [(13, "histogram_metric_name", "_bucket", (("bucket", x), )) for x in (0.1, 1, float("inf"))]
+
+    storage.inc_value(keys[0], 1)
+    storage.inc_items([(x, 1) for x in keys])
+    storage.inc_items([(x, 1) for x in keys])
+
+    # Script is loaded once by EVAL, then called by sha
+    assert redis_server.commands == ["HINCRBYFLOAT", "EVALSHA", "EVAL", "EVALSHA"]
+    assert dict(storage.get_items()) == {keys[0]: 3, keys[1]: 2, keys[2]: 2}
+
+    storage.write_items([(keys[0], 10)])
+    assert storage.get_value(keys[0]) == 10
+
+    # Histogram observation is one script call
+    histogram = Histogram("histogram_metric_name", "histogram doc", buckets=(0.1, 1, float("inf")),
+                          registry=BaseRegistry(storage=storage))
+    del redis_server.commands[:]
+    histogram.observe(0.5)
+    assert redis_server.commands == ["EVALSHA"]
+    assert histogram.value["count"].value == 1
+
+
+def test_redis_storage_unavailable(redis_server):
+    port = redis_server.server_address[1]
+    redis_server.shutdown()
+    redis_server.server_close()
+
+    storage = RedisStorage(port=port, flush_interval=3600)
+    key = (3, "counter_metric_name", "", ())
+
+    storage.inc_value(key, 1)
+    storage.flush()
+    storage.inc_value(key, 2)
+
+    # Changes are kept to next flush
+    assert len(storage._incs) == 1
+    assert storage._incs[key] == 3
+
+
+def test_redis_storage_flush_errors(redis_server):
+    storage = RedisStorage(port=redis_server.server_address[1], flush_interval=3600)
+    counter_key = (3, "counter_metric_name", "", ())
+    gauge_key = (2, "gauge_metric_name", "", ())
+
+    # Redis rejects HSET, increments are applied once
+    execute = redis_server.execute
+    redis_server.execute = lambda command, args: (Exception("ERR rejected") if command == "HSET"
+                                                  else execute(command, args))
+    storage.inc_value(counter_key, 1)
+    storage.write_value(gauge_key, 5)
+    storage.flush()
+    redis_server.execute = execute
+
+    assert storage._writes == {gauge_key: 5}
+    assert storage._incs == {}
+
+    # Any pipeline failure keeps all changes
+    storage.inc_value(counter_key, 2)
+    connection = storage.pool.connection
+    storage.pool.connection = lambda: (_ for _ in ()).throw(ValueError("broken"))
+    storage.flush()
+    storage.pool.connection = connection
+
+    assert storage._writes == {gauge_key: 5}
+    assert storage._incs == {counter_key: 2}
+
+    # Connection breaks in the middle of pipeline, transaction is discarded
+    redis_server.drop_on = "EXEC"
+    storage.flush()
+    redis_server.drop_on = None
+    assert storage._incs == {counter_key: 2}
+
+    storage.flush()
+    assert dict(storage.get_items()) == {counter_key: 3, gauge_key: 5}
+
+
+def test_redis_storage_autoflush(redis_server):
+    storage = RedisStorage(port=redis_server.server_address[1], flush_interval=0.01)
+    key = (3, "counter_metric_name", "", ())
+    try:
+        storage.inc_value(key, 1)
+
+        # Sent by flush thread without next write
+        deadline = time.time() + 5
+        while "HINCRBYFLOAT" not in redis_server.commands and time.time() < deadline:
+            time.sleep(0.01)
+        assert storage.count() == 1
+        assert len(storage) == 0
+
+        storage.inc_value(key, 2)
+        storage.stop()
+        assert storage._incs == {}
+        assert storage.get_value(key) == 3
+    finally:
+        storage.stop()
+
+
+def test_redis_storage_interval_flush_in_thread_only(redis_server):
+    storage = RedisStorage(port=redis_server.server_address[1], flush_interval=0.001, max_pending=2,
+                           autoflush=False)
+    key = (3, "counter_metric_name", "", ())
+
+    storage.inc_value(key, 1)
+    time.sleep(0.01)
+    storage.inc_value(key, 1)
+
+    # Writes don't send changes on interval
+    assert redis_server.commands == []
+    assert len(storage) == 1
+
+    storage.inc_value((3, "other_counter_metric_name", "", ()), 1)
+    assert redis_server.commands == ["MULTI"] + ["HINCRBYFLOAT"] * 2 + ["EXEC"]
+    assert len(storage) == 0
+
+
+def test_redis_storage_unbuffered_errors(redis_server):
+    storage = RedisStorage(port=redis_server.server_address[1], flush_interval=None)
+    key = (3, "counter_metric_name", "", ())
+    redis_server.shutdown()
+    redis_server.server_close()
+    storage.pool.disconnect()
+
+    # Errors are logged and not raised to application
+    storage.inc_value(key, 1)
+    storage.write_value(key, 1)
+    storage.inc_items([(key, 1)])
+    storage.write_items([(key, 1)])
+
+
+def test_redis_connection_pool(redis_server):
+    pool = RedisConnectionPool(port=redis_server.server_address[1], max_connections=2, timeout=0.05)
+
+    with pool.connection() as first:
+        with pool.connection() as second:
+            assert first is not second
+            with pytest.raises(RedisConnectionError):
+                pool.get_connection()
+        first.execute("PING")
+
+    # Waits for connection released by other thread
+    pool._timeout = 5
+    with pool.connection() as first:
+        second = pool.get_connection()
+        second.execute("PING")
+        thread = threading.Timer(0.05, pool.release, (second, ))
+        thread.start()
+        assert pool.get_connection() is second
+        thread.join()
+        pool.release(second)
+
+    with pool.connection() as connection:
+        assert connection is first
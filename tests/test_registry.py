@@ -129,3 +129,63 @@ def test_base_registry(storage_cls, measure_time):
                         filter(lambda x: x.startswith("# HELP"), [x for x in registry_to_text(registry).split("\n")]))
 
     assert len(metrics_count) == len(set(metrics_count))
+
+
+@pytest.mark.parametrize("storage_cls", [LocalMemoryStorage, UWSGIStorage])
+def test_registry_changes(storage_cls):
+    storage = storage_cls()
+    registry = BaseRegistry(storage=storage)
+
+    counter = Counter("metric_counter_name", "doc_counter", ("label1", ), registry=registry)
+    gauge = Gauge("metric_gauge_name", "doc_gauge", ("label1", ), registry=registry)
+
+    counter.labels(label1="value1").inc(2)
+    counter.labels(label1="value2").inc(3)
+    gauge.labels(label1="value1").set(10)
+
+    snapshot, changes = registry.get_changes()
+
+    assert len(changes) == 3
+    assert len(snapshot) == 3
+
+    snapshot, changes = registry.get_changes(snapshot)
+    assert changes == []
+
+    counter.labels(label1="value1").inc(5)
+    gauge.labels(label1="value1").set(4)
+    gauge.labels(label1="value2").set(1)
+
+    snapshot, changes = registry.get_changes(snapshot)
+
+    assert sorted(changes) == sorted([
+        (counter.labels(label1="value1").key, 7, 5),
+        (gauge.labels(label1="value1").key, 4, -6),
+        (gauge.labels(label1="value2").key, 1, 1)])
+
+    # Removed series are dropped from snapshot
+    counter.remove(label1="value2")
+    snapshot, changes = registry.get_changes(snapshot)
+    assert changes == []
+    assert counter.labels(label1="value2").key not in snapshot.values
+
+    gauge.clear()
+    snapshot, changes = registry.get_changes(snapshot)
+    assert sorted(snapshot.values) == [counter.labels(label1="value1").key]
+
+
+def test_registry_changes_tracking():
+    storage = LocalMemoryStorage()
+    registry = BaseRegistry(storage=storage)
+    counter = Counter("metric_counter_name", "doc_counter", registry=registry)
+
+    # Changes are not tracked before first get_changes
+    counter.inc()
+    assert storage._changes is None
+
+    snapshot, changes = registry.get_changes()
+    assert changes == [(counter.labels().key, 1, 1)]
+
+    counter.inc()
+    assert storage._changes == {counter.labels().key: snapshot.marker}
+    snapshot, changes = registry.get_changes(snapshot)
+    assert changes == [(counter.labels().key, 2, 1)]
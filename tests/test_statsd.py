@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import socket
+import threading
+import time
+
+from pyprometheus.contrib.statsd import StatsDServer, StatsDStorage
+from pyprometheus.metrics import Counter, Gauge, Histogram
+from pyprometheus.registry import BaseRegistry
+from pyprometheus.storage import LocalMemoryStorage
+from pyprometheus.utils.exposition import registry_to_text
+
+
+def test_statsd_parse():
+    storage = LocalMemoryStorage()
+    registry = BaseRegistry(storage=storage)
+    server = StatsDServer(registry, buckets=(0.1, 1, float("inf")))
+
+    applied = []
+    apply_changes = storage.apply_changes
+
+    def counting_apply_changes(writes, incs, vectors=()):
+        applied.append(len(vectors))
+        return apply_changes(writes, incs, vectors)
+
+    storage.apply_changes = counting_apply_changes
+
+    server.handle_packets([
+        b"requests.total:1|c|#env:prod,code:200\nrequests.total:1|c|@0.5|#env:prod,code:200",
+        b"queue:10|g\nqueue:-3|g\nqueue:+1|g",
+        b"latency:200|ms|#env:prod\nlatency:2|h|#env:prod\nlatency:50|ms|#env:prod",
+        b"broken\nqueue:1|x\nqueue:1|c"])
+
+    metrics = dict((metric.name, metric) for _, metric in registry.collectors())
+
+    assert metrics["requests_total"].labels(env="prod", code="200").value == 3
+    assert metrics["queue"].value == 8
+
+    value = metrics["latency"].labels(env="prod").value
+    assert value["count"].value == 3
+    assert value["sum"].value == 2.25
+    assert [x.value for x in value["buckets"]] == [1, 2, 3]
+
+    assert applied == [1]
+    assert server.errors == 3
+    assert len(server._cache) == 5
+
+
+def test_statsd_sample_rate():
+    registry = BaseRegistry(storage=LocalMemoryStorage())
+    server = StatsDServer(registry, buckets=(0.1, 1, float("inf")))
+
+    server.handle_packets([b"latency:200|ms|@0.5\nlatency:2|h|@0.25\nlatency:50|ms"])
+
+    value = dict((metric.name, metric) for _, metric in registry.collectors())["latency"].value
+    # Sampled observations are counted with inverse rate weight
+    assert value["count"].value == 7
+    assert value["sum"].value == 0.2 * 2 + 2 * 4 + 0.05
+    assert [x.value for x in value["buckets"]] == [1, 3, 7]
+
+
+def test_statsd_declare_while_scraping():
+    registry = BaseRegistry(storage=LocalMemoryStorage())
+    server = StatsDServer(registry)
+    errors = []
+    done = threading.Event()
+
+    def scrape():
+        while not done.is_set():
+            try:
+                registry_to_text(registry)
+            except Exception as e:
+                errors.append(e)
+
+    threads = [threading.Thread(target=scrape) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    try:
+        for x in range(500):
+            server.handle_packets(["hits_{0}:1|c".format(x).encode("utf-8")])
+    finally:
+        done.set()
+        for thread in threads:
+            thread.join()
+
+    assert errors == []
+    assert len(registry) == 500
+
+
+def test_statsd_server():
+    registry = BaseRegistry(storage=LocalMemoryStorage())
+    server = StatsDServer(registry, ("127.0.0.1", 0), timeout=0.05).start()
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    for _ in range(100):
+        sock.sendto(b"hits:1|c", server.address)
+
+    deadline = time.time() + 5
+    while server.packets < 100 and time.time() < deadline:
+        time.sleep(0.01)
+
+    server.stop()
+
+    metrics = dict((metric.name, metric) for _, metric in registry.collectors())
+    assert metrics["hits"].value == 100
+
+
+def test_statsd_storage():
+    receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    receiver.bind(("127.0.0.1", 0))
+    receiver.settimeout(5)
+
+    storage = StatsDStorage(receiver.getsockname(), prefix="app.", autoflush=False)
+    registry = BaseRegistry(storage=storage)
+
+    counter = Counter("requests_total", "Requests", ("code", ), registry=registry)
+    gauge = Gauge("queue_size", "Queue", registry=registry)
+    histogram = Histogram("latency", "Latency", buckets=(0.5, float("inf")), registry=registry)
+
+    for _ in range(10000):
+        counter.labels(code="200").inc()
+
+    gauge.inc(2)
+    gauge.dec(1)
+    histogram.observe(0.2)
+
+    assert counter.labels(code="200").value == 10000
+
+    storage.flush()
+
+    assert storage.sent == 1
+    lines = sorted(receiver.recv(65535).decode("utf-8").split("\n"))
+
+    assert lines == sorted([
+        "app.requests_total:10000|c|#code:200",
+        "app.queue_size:+1|g",
+        "app.latency_sum:0.2|c",
+        "app.latency_count:1|c",
+        "app.latency_bucket:1|c|#le:0.5",
+        "app.latency_bucket:1|c|#le:+Inf"])
+
+    gauge.set(float("inf"))
+    storage.flush()
+
+    assert receiver.recv(65535) == b"app.queue_size:inf|g"
+
+    # Negative value is not read as delta
+    gauge.set(-5)
+    storage.flush()
+
+    assert receiver.recv(65535) == b"app.queue_size:0|g\napp.queue_size:-5|g"
+
+    gauge.set(5)
+    gauge.inc(1)
+    storage.stop()
+
+    assert receiver.recv(65535) == b"app.queue_size:6|g"
+    assert len(storage) == 0
+
+
+def test_statsd_storage_autoflush():
+    receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    receiver.bind(("127.0.0.1", 0))
+    receiver.settimeout(5)
+
+    storage = StatsDStorage(receiver.getsockname(), flush_interval=0.01)
+    key = (3, "requests_total", "", ())
+    try:
+        # Sent by flush thread without next write
+        storage.inc_value(key, 2)
+        assert receiver.recv(65535) == b"requests_total:2|c"
+
+        storage.inc_value(key, 1)
+        storage.stop()
+        assert len(storage) == 0
+        assert receiver.recv(65535) == b"requests_total:1|c"
+    finally:
+        storage.stop()
+        receiver.close()
@@ -1,8 +1,15 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
-from pyprometheus.storage import BaseStorage, LocalMemoryStorage
+from pyprometheus.metrics import Counter, Gauge, Histogram, Summary
+from pyprometheus.registry import BaseRegistry
+from pyprometheus.const import TYPES
+from pyprometheus.storage import BaseStorage, BufferedStorage, LocalMemoryStorage, expand_vector_key
+import os
 import random
 import threading
+import time
+
+import pytest
 
 try:
     xrange = xrange
@@ -139,3 +146,185 @@ def test_local_storage_threading(measure_time, iterations, num_workers):
 
         for x in DATA:
             assert storage.get_value(x[0]) == x[1] * ITERATIONS * len(workers)
+
+
+def test_storage_transaction():
+    storage = LocalMemoryStorage()
+    registry = BaseRegistry(storage=storage)
+    counter = Counter("counter_metric_name", "counter doc", ("label1", ), registry=registry)
+    gauge = Gauge("gauge_metric_name", "gauge doc", registry=registry)
+    histogram = Histogram("histogram_metric_name", "histogram doc", buckets=(1, float("inf")), registry=registry)
+
+    counter.labels(label1="value1").inc(5)
+    applied = []
+    apply_changes = storage.apply_changes
+    storage.apply_changes = lambda writes, incs, vectors=(): applied.append((writes, incs, vectors)) or apply_changes(writes, incs, vectors)
+
+    with registry.batch():
+        counter.labels(label1="value1").inc()
+        gauge.set(10)
+        gauge.inc(2)
+        with registry.batch():
+            histogram.observe(0.5)
+
+        # Changes are visible in thread, but not applied to storage
+        assert counter.labels(label1="value1").value == 6
+        assert gauge.value == 12
+        assert histogram.value["count"].value == 1
+        assert storage.get_value(counter.labels(label1="value1").key) == 5
+
+        thread_values = []
+        thread = threading.Thread(target=lambda: thread_values.append(counter.labels(label1="value1").value))
+        thread.start()
+        thread.join()
+        assert thread_values == [5]
+
+    assert len(applied) == 1
+    assert counter.labels(label1="value1").value == 6
+    assert gauge.value == 12
+    assert histogram.value["count"].value == 1
+    assert [x.value for x in histogram.value["buckets"]] == [1, 1]
+    assert storage._transactions == 0
+
+    # Changes are applied on error
+    try:
+        with storage.transaction():
+            counter.labels(label1="value1").inc()
+            raise ValueError()
+    except ValueError:
+        pass
+    assert counter.labels(label1="value1").value == 7
+
+
+def test_base_storage_apply_changes():
+    class Storage(BaseStorage):
+        def __init__(self):
+            self.calls = []
+
+        def inc_value(self, key, value):
+            self.calls.append(("inc", key, value))
+
+        def write_value(self, key, value):
+            self.calls.append(("write", key, value))
+
+    storage = Storage()
+    with storage.transaction() as transaction:
+        transaction.inc_value("a", 1)
+        transaction.write_value("b", 2)
+        transaction.inc_value("b", 1)
+
+    assert storage.calls == [("write", "b", 3), ("inc", "a", 1)]
+
+
+def test_storage_inc_items():
+    storage = LocalMemoryStorage()
+
+    storage.inc_items([(x[0], x[1]) for x in DATA])
+    storage.inc_items([(x[0], x[1]) for x in DATA])
+    storage.write_items([(DATA[0][0], 1)])
+
+    assert storage.get_value(DATA[0][0]) == 1
+    assert storage.get_value(DATA[1][0]) == DATA[1][1] * 2
+
+    ops = []
+    storage.inc_value = lambda key, value: ops.append(key)
+    histogram = Histogram("histogram_metric_name", "histogram doc", buckets=(1, float("inf")),
+                          registry=BaseRegistry(storage=storage))
+    histogram.observe(0.5)
+
+    # Observation is one storage operation
+    assert ops == []
+    assert histogram.value["count"].value == 1
+    assert [x.value for x in histogram.value["buckets"]] == [1, 1]
+
+
+def test_expand_vector_key():
+    registry = BaseRegistry()
+    histogram = Histogram("histogram_metric_name", "histogram doc", ("label1", ), buckets=(1, float("inf")), registry=registry)
+    summary = Summary("summary_metric_name", "summary doc", ("label1", ), registry=registry)
+
+    value = histogram.labels(label1="value1")
+    assert expand_vector_key(value._vector_key) == value._sum.keys + value._count.keys + [x.key for x in value.value["buckets"]]
+
+    value = summary.labels(label1="value1")
+    assert expand_vector_key(value._vector_key) == [value._sum.key, value._count.key]
+
+    storage = BaseStorage()
+    calls = []
+    storage.inc_items = calls.append
+    storage.inc_vector(value._vector_key, (2, 1))
+    assert calls == [[(value._sum.key, 2), (value._count.key, 1)]]
+
+    # Values pass their own series keys
+    del calls[:]
+    storage.inc_vector(value._vector_key, (3, 1), ["sum", "count"])
+    assert calls == [[("sum", 3), ("count", 1)]]
+
+    histogram_value = histogram.labels(label1="value1")
+    assert histogram_value._series_keys == expand_vector_key(histogram_value._vector_key)
+    assert value._series_keys == expand_vector_key(value._vector_key)
+
+
+@pytest.mark.skipif(not hasattr(os, "register_at_fork"), reason="requires os.register_at_fork")
+def test_storage_fork_hooks():
+    storage = LocalMemoryStorage()
+    storage.inc_value(DATA[0][0], 1)
+
+    # Lock held by other thread at fork is not inherited locked
+    thread = threading.Thread(target=lambda: storage._lock.acquire() and time.sleep(0.2) or storage._lock.release())
+    thread.start()
+    time.sleep(0.05)
+
+    pid = os.fork()
+    if pid == 0:
+        code = 1
+        try:
+            storage.inc_value(DATA[0][0], 1)
+            code = 0 if storage.get_value(DATA[0][0]) == 2 and not storage._lock.locked() else 1
+        finally:
+            os._exit(code)
+
+    thread.join()
+    assert os.waitpid(pid, 0)[1] == 0
+    assert not storage._lock.locked()
+    assert storage.get_value(DATA[0][0]) == 1
+
+
+def test_buffered_storage():
+    class Storage(BufferedStorage):
+        def __init__(self):
+            self.sent = []
+            self.reject = False
+            super(Storage, self).__init__(max_pending=3, flush_interval=0.001, autoflush=False)
+
+        def send(self, writes, incs):
+            assert self._flush_lock.locked()
+            if self.reject:
+                self.inc_value(DATA[1][0], 1)
+                self.restore(writes, incs)
+                return
+            self.sent.append((writes, incs))
+
+    storage = Storage()
+    storage.inc_value(DATA[1][0], 1)
+    storage.write_value(DATA[0][0], 1)
+    storage.inc_value(DATA[0][0], 1)
+    time.sleep(0.01)
+
+    # Writes flush on max_pending keys only
+    assert storage.sent == []
+    assert storage.get_value(DATA[0][0]) == 2
+    assert len(storage) == 2
+
+    # Not sent changes are kept before changes made since flush
+    storage.reject = True
+    storage.flush()
+    assert storage.get_value(DATA[0][0]) == 2
+    assert storage.get_value(DATA[1][0]) == 2
+
+    storage.reject = False
+    storage.inc_vector((TYPES.SUMMARY, "metric_summary_name", ()), (1, 1))
+    assert storage.sent == [({DATA[0][0]: 2}, {DATA[1][0]: 2,
+                                               (TYPES.SUMMARY_SUM, "metric_summary_name", "_sum", ()): 1,
+                                               (TYPES.SUMMARY_COUNTER, "metric_summary_name", "_count", ()): 1})]
+    assert len(storage) == 0
@@ -2,17 +2,29 @@
 # -*- coding: utf-8 -*-
 import os
 import random
+import threading
+import time
 from multiprocessing import Process
 
+import pytest
 import uwsgi
-from pyprometheus.contrib.uwsgi_features import UWSGICollector, UWSGIStorage, UWSGIFlushStorage
+from pyprometheus.contrib.uwsgi_features import (UWSGICollector, UWSGIStorage, UWSGIFlushStorage, UWSGIMuleExposition,
+                                                 UWSGISeqlockStorage, UWSGIDoubleBufferStorage, UWSGIShardedStorage,
+                                                 UWSGIMuleStorage, UWSGIMuleAggregator, UWSGIVectorStorage)
+from pyprometheus.metrics import Counter, Histogram, Summary
 from pyprometheus.registry import BaseRegistry
+from pyprometheus.storage import prepare_fork
 from pyprometheus.utils.exposition import registry_to_text
 try:
     xrange = xrange
 except Exception:
     xrange = range
 
+try:
+    from urllib.request import urlopen
+except ImportError:
+    from urllib2 import urlopen
+
 
 def test_uwsgi_collector():
     registry = BaseRegistry()
@@ -216,6 +228,40 @@ def test_uwsgi_flush_storage():
         storage1.persistent_storage.get_value(x[0]) == x[1] * 10
 
 
+def test_uwsgi_flush_vector_storage():
+    m = uwsgi.sharedarea_memoryview(2)
+    m[:] = b"\x00" * len(m)
+
+    storage = UWSGIFlushStorage(2, storage_class=UWSGIVectorStorage)
+    registry = BaseRegistry(storage=storage)
+    histogram = Histogram("histogram_metric_name", "histogram doc", ("label1", ), buckets=(1, float("inf")),
+                          registry=registry)
+    summary = Summary("summary_metric_name", "summary doc", registry=registry)
+
+    for x in xrange(10):
+        histogram.labels(label1="value1").observe(x)
+        summary.observe(x)
+        assert histogram.labels(label1="value1").value["count"].value == x + 1
+        with registry.batch():
+            histogram.labels(label1="value2").observe(x)
+
+    assert storage.get_value(summary.labels()._count.key) == 10
+    storage.flush()
+    assert storage.get_value(summary.labels()._count.key) == 0
+
+    vector_storage = storage.persistent_storage
+    # Composite values are flushed into their slots
+    assert len(vector_storage._vectors) == 3
+    assert not vector_storage._positions
+    items = dict(vector_storage.get_items())
+    assert items[histogram.labels(label1="value1")._count.key] == 10
+    assert items[histogram.labels(label1="value2")._buckets[0].key] == 1
+    assert items[summary.labels()._sum.key] == 45
+
+    storage.flush()
+    assert dict(vector_storage.get_items()) == items
+
+
 def test_uwsgi_flush_storage_multiprocessing(measure_time, iterations, num_workers):
     storage = UWSGIFlushStorage(0)
     storage2 = UWSGIFlushStorage(0)
@@ -287,3 +333,491 @@ def test_uwsgi_storage_metrics(iterations):
 
     metric = collectors["namespace:num_keys"]
     assert metric.get_samples()[0].value == 20
+
+
+def test_uwsgi_mule_exposition():
+    registry = BaseRegistry(storage=UWSGIStorage(0))
+    counter = Counter("counter_metric_name", "counter_metric_name doc", ("label1", ), registry=registry)
+
+    counter.labels(label1="value1").inc(3)
+
+    exposition = UWSGIMuleExposition(registry, ("127.0.0.1", 0))
+    server = exposition.make_server()
+
+    thread = threading.Thread(target=exposition.serve_forever)
+    thread.start()
+
+    try:
+        body = urlopen("http://127.0.0.1:{0}/metrics".format(server.server_address[1])).read()
+        assert b"counter_metric_name{label1=\"value1\"} 3.0" in body
+    finally:
+        exposition.shutdown()
+        thread.join()
+
+
+def test_uwsgi_seqlock_storage(iterations):
+    storage = UWSGISeqlockStorage(0)
+    storage2 = UWSGISeqlockStorage(0)
+
+    for x in DATA:
+        storage.inc_value(x[0], x[1])
+
+    assert storage.read_sequence() % 2 == 0
+    assert storage.get_area_size() > storage.HEADER_SIZE
+
+    for x in DATA:
+        assert storage2.get_value(x[0]) == storage.get_value(x[0]) == x[1]
+
+    assert dict(storage2.get_items()) == dict((x[0], x[1]) for x in DATA)
+
+    # Writer stuck inside write section, readers fall back to read lock
+    storage.write_sequence(storage.read_sequence() + 1)
+    assert len(list(storage2.get_items())) == len(DATA)
+    assert storage2._retries == storage2.READ_RETRIES
+    storage.write_sequence(storage.read_sequence() + 1)
+
+    locks = getattr(uwsgi, "stats", {}).get("locks")
+    assert len(list(storage2.get_items())) == len(DATA)
+    assert getattr(uwsgi, "stats", {}).get("locks") == locks
+
+    metrics = dict((metric.name, metric) for metric in storage2.collect())
+    assert list(metrics[":read_retries"].get_samples())[0].value == storage2.READ_RETRIES
+
+
+def test_uwsgi_seqlock_storage_consistency(iterations):
+    storage = UWSGISeqlockStorage(0)
+    keys = [(3, "counter_{0}".format(x), "", ()) for x in xrange(10)]
+    storage.inc_items([(key, 0) for key in keys])
+
+    def writer():
+        writer_storage = UWSGISeqlockStorage(0)
+        for _ in xrange(iterations * 4):
+            writer_storage.inc_items([(key, 1) for key in keys])
+
+    p = Process(target=writer)
+    p.start()
+
+    snapshots = 0
+    while p.is_alive() or not snapshots:
+        values = [value for key, value in storage.get_items()]
+        assert len(set(values)) == 1, values
+        snapshots += 1
+
+    p.join()
+    assert [storage.get_value(key) for key in keys] == [iterations * 4] * len(keys)
+
+
+def test_uwsgi_seqlock_storage_histogram_consistency(iterations):
+    registry = BaseRegistry(storage=UWSGISeqlockStorage(0))
+    histogram = Histogram("histogram_metric_name", "histogram doc", buckets=(0.5, 1, float("inf")), registry=registry)
+    histogram.observe(0)
+
+    def writer():
+        writer_histogram = Histogram("histogram_metric_name", "histogram doc", buckets=(0.5, 1, float("inf")),
+                                     registry=BaseRegistry(storage=UWSGISeqlockStorage(0)))
+        for x in xrange(iterations * 4):
+            writer_histogram.observe(x % 2)
+
+    p = Process(target=writer)
+    p.start()
+
+    snapshots = 0
+    while p.is_alive() or not snapshots:
+        # Observation is applied by one storage operation, snapshot never sees it partially
+        values = dict(((key[0], dict(key[3]).get("bucket")), value) for key, value in registry.storage.get_items())
+        count = values[(12, None)]
+        assert count == values[(13, float("inf"))] == values[(13, 0.5)] + values[(11, None)], values
+        snapshots += 1
+
+    p.join()
+
+
+def test_uwsgi_double_buffer_storage():
+    storage = UWSGIDoubleBufferStorage(0)
+    storage2 = UWSGIDoubleBufferStorage(0)
+
+    for x in DATA:
+        storage.inc_value(x[0], x[1])
+        storage2.inc_value(x[0], x[1])
+
+    assert storage.get_active_index() == 0
+    assert dict(storage.get_items()) == dict((x[0], x[1] * 2) for x in DATA)
+    assert storage.get_active_index() == 1
+
+    # Increments don't wait for scrape drain
+    with storage.scrape_lock():
+        storage2.inc_value(DATA[0][0], 10)
+    storage2.write_value(DATA[1][0], 3)
+
+    assert storage.get_value(DATA[0][0]) == DATA[0][1] * 2 + 10
+    items = dict(storage2.get_items())
+    assert items[DATA[0][0]] == DATA[0][1] * 2 + 10
+    assert items[DATA[1][0]] == 3
+
+    storage.remove_items([DATA[2][0]])
+    items.pop(DATA[2][0])
+    assert dict(storage2.get_items()) == items
+    assert storage2.get_value(DATA[0][0]) == DATA[0][1] * 2 + 10
+
+
+def test_uwsgi_double_buffer_storage_multiprocessing(iterations, num_workers):
+    storage = UWSGIDoubleBufferStorage(0)
+    key = (3, "counter_metric_name", "", ())
+
+    def writer():
+        writer_storage = UWSGIDoubleBufferStorage(0)
+        for _ in xrange(iterations):
+            writer_storage.inc_value(key, 1)
+
+    workers = [Process(target=writer) for _ in xrange(num_workers)]
+    for p in workers:
+        p.start()
+
+    values = []
+    while any(p.is_alive() for p in workers):
+        values.append(dict(storage.get_items()).get(key, 0))
+
+    for p in workers:
+        p.join()
+
+    assert values == sorted(values)
+    assert dict(storage.get_items())[key] == iterations * num_workers
+
+
+def test_uwsgi_sharded_storage():
+    for sharedarea_id in (1, 2):
+        m = uwsgi.sharedarea_memoryview(sharedarea_id)
+        m[:] = b"\x00" * len(m)
+
+    storage = UWSGIShardedStorage([0, 1, 2], shard_by=UWSGIShardedStorage.KEY)
+    storage2 = UWSGIShardedStorage([0, 1, 2], shard_by=UWSGIShardedStorage.KEY)
+
+    for x in DATA:
+        storage.inc_value(x[0], x[1])
+    storage.inc_items([(x[0], x[1]) for x in DATA])
+
+    assert len([shard for shard in storage.shards if len(shard)]) > 1
+    assert len(storage) == len(set(x[0] for x in DATA))
+    assert dict(storage2.get_items()) == dict((x[0], x[1] * 2) for x in DATA)
+    assert storage2.get_value(DATA[0][0]) == DATA[0][1] * 2
+
+    storage2.remove_items([DATA[0][0]])
+    assert DATA[0][0] not in dict(storage.get_items())
+
+    by_name = UWSGIShardedStorage([0, 1, 2])
+    assert len(set(id(by_name.get_shard(x[0])) for x in DATA if x[0][1] == "metric_histogram_name")) == 1
+
+
+standin_mules = pytest.mark.skipif(not hasattr(uwsgi, "set_mule_id"), reason="requires uwsgi stand-in mules")
+
+
+@standin_mules
+def test_uwsgi_mule_storage():
+    storage = UWSGIMuleStorage(mule_id=1, flush_interval=3600)
+    registry = BaseRegistry(storage=storage)
+    aggregator = UWSGIMuleAggregator(registry, address=None)
+
+    # Writes don't ask uwsgi for process role
+    mule_id, uwsgi.mule_id = uwsgi.mule_id, None
+    try:
+        for x in DATA:
+            storage.inc_value(x[0], x[1])
+        storage.write_value(DATA[0][0], 100)
+        storage.inc_value(DATA[0][0], 1)
+    finally:
+        uwsgi.mule_id = mule_id
+
+    assert storage.get_value(DATA[0][0]) == 101
+    storage.flush()
+    assert len(storage) == 0
+    assert storage._sent == 1
+
+    uwsgi.set_mule_id(1)
+    assert not storage.is_mule
+    assert storage.detect_mule()
+    try:
+        assert aggregator.receive(timeout=1)
+        assert not aggregator.receive(timeout=0.01)
+        expected = dict((x[0], x[1]) for x in DATA)
+        expected[DATA[0][0]] = 101
+        assert dict(storage.get_items()) == expected
+
+        # Mule applies changes directly
+        storage.inc_value(DATA[0][0], 1)
+        assert storage.get_value(DATA[0][0]) == 102
+    finally:
+        uwsgi.set_mule_id(0)
+        storage.detect_mule()
+
+
+@standin_mules
+def test_uwsgi_mule_storage_split_and_restore():
+    storage = UWSGIMuleStorage(mule_id=1, flush_interval=3600, max_message_size=500)
+    key = DATA[1][0]
+
+    for x in DATA:
+        storage.inc_value(x[0], x[1])
+    assert len(storage.encode([], list(storage.get_items()))) > 1
+
+    def reject(message, mule_id):
+        storage.inc_value(key, 1)
+        return None
+
+    send, uwsgi.mule_msg = uwsgi.mule_msg, reject
+    try:
+        storage.flush()
+    finally:
+        uwsgi.mule_msg = send
+
+    assert storage._failed > 1
+    expected = dict((x[0], x[1]) for x in DATA)
+    expected[key] += storage._failed
+    assert dict(storage.get_items()) == expected
+
+
+def test_uwsgi_mule_storage_encode_limit():
+    storage = UWSGIMuleStorage(mule_id=1, flush_interval=3600, max_message_size=150, autoflush=False)
+    write = ((2, "g" * 60, "", ()), 1.0)
+    inc = ((3, "c" * 60, "", ()), 2.0)
+
+    # Writes and increments are split together
+    messages = storage.encode([write], [inc])
+    assert [storage.decode(x) for x in messages] == [([write], []), ([], [inc])]
+    assert all(len(x) <= 150 for x in messages)
+
+    # Record over limit is dropped
+    big = ((3, "c" * 200, "", ()), 1.0)
+    messages = storage.encode([write], [inc, big])
+    assert [storage.decode(x) for x in messages] == [([write], []), ([], [inc])]
+    assert storage._dropped == 1
+
+
+@standin_mules
+def test_uwsgi_mule_storage_autoflush():
+    storage = UWSGIMuleStorage(mule_id=1, flush_interval=0.01)
+    try:
+        storage.inc_value(DATA[0][0], 1)
+
+        # Flushed by thread without next write
+        deadline = time.time() + 5
+        while storage._sent < 1 and time.time() < deadline:
+            time.sleep(0.01)
+        assert storage._sent == 1
+        assert len(storage) == 0
+
+        storage.inc_value(DATA[0][0], 1)
+        storage.stop()
+        assert storage._sent == 2
+        assert len(storage) == 0
+    finally:
+        storage.stop()
+        uwsgi.set_mule_id(1)
+        while uwsgi.mule_get_msg(timeout=0.01):
+            pass
+        uwsgi.set_mule_id(0)
+
+
+@standin_mules
+def test_uwsgi_mule_storage_multiprocessing(iterations, num_workers):
+    storage = UWSGIMuleStorage(mule_id=1, flush_interval=0.01, max_pending=100)
+    registry = BaseRegistry(storage=storage)
+    counter = Counter("counter_metric_name", "counter_metric_name doc", ("label1", ), registry=registry)
+    aggregator = UWSGIMuleAggregator(registry, address=None, on_message=lambda x: None)
+    uwsgi.get_mule(1)
+
+    def writer():
+        for _ in xrange(iterations):
+            counter.labels(label1="value1").inc()
+        storage.flush()
+
+    workers = [Process(target=writer) for _ in xrange(num_workers)]
+    for p in workers:
+        p.start()
+
+    uwsgi.set_mule_id(1)
+    storage.detect_mule()
+    try:
+        while any(p.is_alive() for p in workers):
+            aggregator.receive(timeout=0.01)
+        while aggregator.receive(timeout=0.1):
+            pass
+
+        assert counter.labels(label1="value1").value == iterations * num_workers
+    finally:
+        uwsgi.set_mule_id(0)
+        storage.detect_mule()
+        for p in workers:
+            p.join()
+
+
+def test_uwsgi_storage_transaction():
+    storage = UWSGIStorage(0)
+    registry = BaseRegistry(storage=storage)
+    counter = Counter("counter_metric_name", "counter_metric_name doc", ("label1", ), registry=registry)
+    counter.labels(label1="value1").inc()
+
+    locks = []
+    wlock = uwsgi.sharedarea_wlock
+    uwsgi.sharedarea_wlock = lambda x: locks.append(x) or wlock(x)
+    try:
+        with registry.batch():
+            for x in DATA:
+                storage.get_transaction().inc_value(x[0], x[1])
+            counter.labels(label1="value1").inc(2)
+    finally:
+        uwsgi.sharedarea_wlock = wlock
+
+    assert locks == [0]
+    assert counter.labels(label1="value1").value == 3
+    assert dict(storage.get_items())[DATA[1][0]] == DATA[1][1]
+
+
+def test_uwsgi_vector_storage():
+    for sharedarea_id in (1, 2):
+        m = uwsgi.sharedarea_memoryview(sharedarea_id)
+        m[:] = b"\x00" * len(m)
+
+    storages = [UWSGIStorage(1), UWSGIVectorStorage(2)]
+    for storage in storages:
+        registry = BaseRegistry(storage=storage)
+        histogram = Histogram("histogram_metric_name", "histogram doc", ("label1", ), registry=registry)
+        summary = Summary("summary_metric_name", "summary doc", registry=registry)
+        counter = Counter("counter_metric_name", "counter doc", registry=registry)
+
+        for x in xrange(10):
+            histogram.labels(label1="value1").observe(x / 10.0)
+            histogram.labels(label1="value2").observe(x)
+            summary.observe(x)
+            counter.inc()
+
+    storage, vector_storage = storages
+    items = dict(storage.get_items())
+    assert dict(vector_storage.get_items()) == items
+    assert len(vector_storage) == len(storage)
+    # Two histograms series, summary and counter keys
+    assert vector_storage._used < storage._used / 2
+    assert len(vector_storage._vectors) == 3
+
+    storage2 = UWSGIVectorStorage(2)
+    assert dict(storage2.get_items()) == items
+    assert storage2.get_value(histogram.labels(label1="value1")._count.key) == 10
+    assert histogram.labels(label1="value1").value["count"].value == 10
+
+    # Reading not observed series don't create keys
+    assert histogram.labels(label1="value3").value["count"].value == 0
+    assert len(vector_storage) == len(storage)
+
+    assert storage2.remove_items([histogram.labels(label1="value1")._sum.key]) == 1
+    assert dict(vector_storage.get_items()) == dict(
+        (key, value) for key, value in items.items() if ("label1", "value1") not in key[3])
+    assert vector_storage.get_value(counter.labels().key) == 10
+
+
+def test_uwsgi_vector_storage_multiprocessing(iterations, num_workers):
+    storage = UWSGIVectorStorage(0)
+
+    def observer():
+        registry = BaseRegistry(storage=UWSGIVectorStorage(0))
+        histogram = Histogram("histogram_metric_name", "histogram doc", buckets=(0.5, float("inf")), registry=registry)
+        for x in xrange(iterations):
+            histogram.observe(0.25 if x % 2 else 1)
+
+    workers = [Process(target=observer) for _ in xrange(num_workers)]
+    for p in workers:
+        p.start()
+    for p in workers:
+        p.join()
+
+    items = dict(storage.get_items())
+    assert items[(12, "histogram_metric_name", "_count", ())] == iterations * num_workers
+    assert items[(13, "histogram_metric_name", "_bucket", (("bucket", 0.5), ))] == iterations // 2 * num_workers
+    assert items[(13, "histogram_metric_name", "_bucket", (("bucket", float("inf")), ))] == iterations * num_workers
+    assert len(storage._vectors) == 1
+
+
+def test_uwsgi_storage_fork_hooks():
+    storage = UWSGIStorage(0)
+    other = UWSGIStorage(0)
+    for x in DATA:
+        other.inc_value(x[0], x[1])
+
+    def child():
+        # Index and keys cache are built by parent before fork
+        syncs = storage._syncs
+        assert set(x[0] for x in DATA) <= set(storage._keys_cache)
+        assert storage.get_value(DATA[1][0]) == DATA[1][1]
+        assert storage._syncs == syncs
+
+    # Fork itself doesn't scan area
+    syncs = storage._syncs
+    p = Process(target=lambda: None)
+    p.start()
+    p.join()
+    assert storage._syncs == syncs
+    assert not storage._keys_cache
+
+    prepare_fork()
+    p = Process(target=child)
+    p.start()
+    p.join()
+    assert p.exitcode == 0
+    assert storage.is_actual
+
+
+@standin_mules
+def test_uwsgi_mule_storage_fork_hooks():
+    storage = UWSGIMuleStorage(mule_id=2, flush_interval=3600)
+    storage.inc_value(DATA[1][0], 5)
+
+    def child():
+        # Parent sends changes made before fork
+        assert len(storage) == 0
+        storage.inc_value(DATA[1][0], 1)
+        assert storage.get_value(DATA[1][0]) == 1
+
+    p = Process(target=child)
+    p.start()
+    p.join()
+    assert p.exitcode == 0
+    # Fork doesn't flush
+    assert storage._sent == 0
+    assert storage.get_value(DATA[1][0]) == 5
+
+    prepare_fork()
+    assert storage._sent == 1
+    assert len(storage) == 0
+
+
+def test_uwsgi_storage_warmup():
+    for sharedarea_id in (1, 2, 3, 4):
+        m = uwsgi.sharedarea_memoryview(sharedarea_id)
+        m[:] = b"\x00" * len(m)
+
+    for storage in (UWSGIStorage(1), UWSGIVectorStorage(2), UWSGIShardedStorage([3, 4])):
+        registry = BaseRegistry(storage=storage)
+        histogram = Histogram("histogram_metric_name", "histogram doc", ("label1", ), registry=registry)
+        summary = Summary("summary_metric_name", "summary doc", registry=registry)
+        counter = Counter("counter_metric_name", "counter doc", ("label1", ), registry=registry)
+
+        histogram.preregister([{"label1": "value{0}".format(x)} for x in xrange(10)], init=False)
+        counter.preregister([{"label1": "value{0}".format(x)} for x in xrange(10)], init=False)
+
+        signs = []
+        for shard in getattr(storage, "shards", [storage]):
+            shard.update_area_sign = (lambda update: lambda: signs.append(update()))(shard.update_area_sign)
+
+        registry.warmup()
+        # One sign update by sharedarea
+        shards = [shard for shard in getattr(storage, "shards", [storage]) if len(shard)]
+        assert len(signs) == len(shards)
+        assert len(storage) == 10 * (len(histogram.buckets) + 2) + 2 + 10
+
+        other = storage.__class__(*([[3, 4]] if isinstance(storage, UWSGIShardedStorage) else [storage._sharedarea_id]))
+        assert dict(other.get_items()) == dict(storage.get_items())
+
+        registry.warmup()
+        histogram.labels(label1="value1").observe(0.1)
+        summary.observe(1)
+        assert len(signs) == len(shards)
+        assert histogram.labels(label1="value1").value["count"].value == 1
+        assert other.get_value(summary.labels()._count.key) == 1